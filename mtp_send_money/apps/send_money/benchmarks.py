@@ -0,0 +1,155 @@
+import time
+
+from django.core import signing
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.utils import translation
+from django.utils.module_loading import import_string
+
+benchmarks = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark for the `benchmark` management command;
+    benchmarks accept the number of iterations to run and return a list of (description, value, unit) results
+    """
+    def decorator(func):
+        benchmarks[name] = func
+        return func
+
+    return decorator
+
+
+def time_per_call(iterations, func, *args, **kwargs):
+    """
+    Returns the mean number of microseconds func takes to run
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(*args, **kwargs)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+@benchmark('session')
+def session_benchmark(iterations):
+    """
+    Size of the session cookie at the end of the debit card journey and the time taken to read it
+    """
+    session_data = {
+        'payment_method': 'debit_card',
+        'prisoner_name': 'James Halls',
+        'prisoner_dob': '1992-12-05',
+        'prisoner_number': 'A1409AE',
+        'amount': '17.50',
+    }
+    salt = 'django.contrib.sessions.backends.signed_cookies'
+    results = []
+    for serializer in ('django.core.signing.JSONSerializer', 'send_money.session.CompactSessionSerializer'):
+        serializer_class = import_string(serializer)
+        cookie = signing.dumps(session_data, salt=salt, serializer=serializer_class, compress=True)
+        name = serializer.rsplit('.', 1)[1]
+        results.append((f'{name} cookie size', len(cookie), 'bytes'))
+        results.append((
+            f'{name} cookie read',
+            time_per_call(iterations, signing.loads, cookie, salt=salt, serializer=serializer_class),
+            'µs',
+        ))
+    return results
+
+
+@benchmark('templates')
+def template_benchmark(iterations):
+    """
+    Time taken to render pages with shared fragments rendered afresh and when cached
+    """
+    from send_money.templatetags.send_money import render_card_acceptance_signage
+
+    def render_uncached(template_name, request):
+        render_card_acceptance_signage.cache_clear()
+        cache.clear()
+        return render_to_string(template_name, request=request)
+
+    results = []
+    with translation.override('en-gb'):
+        for template_name in ('terms.html', 'send_money/user-agreement.html'):
+            request = RequestFactory().get('/en-gb/', HTTP_HOST='localhost')
+            results.append((
+                f'{template_name} with fragments rendered',
+                time_per_call(iterations, render_uncached, template_name, request) / 1000,
+                'ms',
+            ))
+            results.append((
+                f'{template_name} with fragments cached',
+                time_per_call(iterations, render_to_string, template_name, request=request) / 1000,
+                'ms',
+            ))
+    return results
+
+
+@benchmark('completion_attrs')
+def completion_attrs_benchmark(iterations):
+    """
+    Time taken to find MTP payment attributes to update from a GOV.UK payment using closures built on every call
+    and a precompiled plan
+    """
+    from send_money.payments import PaymentClient
+
+    def closure_attr_updates(payment, govuk_payment):
+        def get_attr(attr_name):
+            def wrapper(govuk_payment):
+                return govuk_payment.get(attr_name)
+            return wrapper
+
+        def get_card_details_attr_value(govuk_card_details_attr_name):
+            def wrapper(govuk_payment):
+                card_details = govuk_payment.get('card_details', {})
+                return card_details.get(govuk_card_details_attr_name)
+            return wrapper
+
+        attrs_mapping = [
+            ('email', get_attr('email')),
+            ('worldpay_id', get_attr('provider_id')),
+            ('cardholder_name', get_card_details_attr_value('cardholder_name')),
+            ('card_number_first_digits', get_card_details_attr_value('first_digits_card_number')),
+            ('card_number_last_digits', get_card_details_attr_value('last_digits_card_number')),
+            ('card_expiry_date', get_card_details_attr_value('expiry_date')),
+            ('card_brand', get_card_details_attr_value('card_brand')),
+            ('billing_address', get_card_details_attr_value('billing_address')),
+        ]
+        attr_updates = {}
+        for payment_attr_name, govuk_payment_attr_func in attrs_mapping:
+            payment_attr_value = payment.get(payment_attr_name)
+            if payment_attr_value:
+                continue
+            govuk_payment_attr_value = govuk_payment_attr_func(govuk_payment)
+            if not govuk_payment_attr_value or govuk_payment_attr_value == payment_attr_value:
+                continue
+            attr_updates[payment_attr_name] = govuk_payment_attr_value
+        return attr_updates
+
+    govuk_payment = {
+        'email': 'sender@outside.local',
+        'provider_id': '11112222-1111-2222-3333-111122223333',
+        'card_details': {
+            'cardholder_name': 'Jack Halls',
+            'first_digits_card_number': '100002',
+            'last_digits_card_number': '1111',
+            'expiry_date': '11/18',
+            'card_brand': 'Visa',
+            'billing_address': {'line1': '102 Petty France', 'city': 'London', 'postcode': 'SW1H9AJ'},
+        },
+    }
+    plan_attr_updates = PaymentClient().get_completion_payment_attr_updates
+    completed_payment = {'uuid': 'wargle-1111', **plan_attr_updates({}, govuk_payment)}
+    results = []
+    for description, payment in (('new payment', {'uuid': 'wargle-1111'}), ('completed payment', completed_payment)):
+        for implementation, func in (('closures', closure_attr_updates), ('plan', plan_attr_updates)):
+            assert func(payment, govuk_payment) == closure_attr_updates(payment, govuk_payment)
+            results.append((
+                f'{implementation} for {description}',
+                time_per_call(iterations, func, payment, govuk_payment),
+                'µs',
+            ))
+    return results
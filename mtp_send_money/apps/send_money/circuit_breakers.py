@@ -0,0 +1,193 @@
+import collections
+import enum
+import logging
+import threading
+import time
+
+from django.conf import settings
+import requests
+from requests.exceptions import RequestException
+
+from send_money.deadlines import DeadlineExceeded
+
+logger = logging.getLogger('mtp')
+
+
+class CircuitOpenError(RequestException):
+    """
+    Raised instead of making a request while a dependency is considered to be unavailable;
+    it's a RequestException so existing error handling treats it like a failed request
+    """
+
+
+class CircuitState(enum.Enum):
+    closed = 0
+    open = 1
+    half_open = 2
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a dependency once too many have failed recently.
+
+    While closed, calls are allowed and their outcomes tracked over a rolling window. If at least
+    CIRCUIT_BREAKER_MINIMUM_CALLS were made in the window and the proportion that failed reaches
+    CIRCUIT_BREAKER_FAILURE_RATE, the circuit opens and calls fail immediately with CircuitOpenError.
+    After CIRCUIT_BREAKER_RESET_TIMEOUT seconds, one probe call is allowed through (half-open):
+    if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = CircuitState.closed
+        self.outcomes = collections.deque()
+        self.opened_at = None
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+        self.rejections = 0
+
+    @property
+    def window(self):
+        return settings.CIRCUIT_BREAKER_WINDOW
+
+    @property
+    def reset_timeout(self):
+        return settings.CIRCUIT_BREAKER_RESET_TIMEOUT
+
+    def __repr__(self):
+        return f'<CircuitBreaker {self.name} {self.state.name}>'
+
+    def reset(self):
+        with self.lock:
+            self.state = CircuitState.closed
+            self.outcomes.clear()
+            self.opened_at = None
+            self.probing = False
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func if the circuit allows it, recording whether it failed
+
+        :raise CircuitOpenError: if the dependency is considered unavailable
+        """
+        self.before_call()
+        # outcome stays unknown if the call is interrupted (e.g. KeyboardInterrupt or GreenletExit)
+        failed = None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:  # noqa: B902
+            if not self.is_inconclusive(e):
+                failed = self.is_failure(e)
+            raise
+        else:
+            failed = self.is_failed_response(result)
+            return result
+        finally:
+            if failed is None:
+                self.abandon_call()
+            else:
+                self.after_call(failed=failed)
+
+    def abandon_call(self):
+        """
+        Forgets a call whose outcome says nothing about the dependency;
+        a half-open circuit stays half-open so that another probe is let through
+        """
+        with self.lock:
+            if self.state == CircuitState.half_open:
+                self.probing = False
+
+    def before_call(self):
+        with self.lock:
+            if self.state == CircuitState.open and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitState.half_open
+                self.probing = False
+            if self.state == CircuitState.half_open:
+                if self.probing:
+                    self.rejections += 1
+                    raise CircuitOpenError(f'{self.name} circuit is half-open and awaiting a probe')
+                self.probing = True
+            elif self.state == CircuitState.open:
+                self.rejections += 1
+                raise CircuitOpenError(f'{self.name} circuit is open')
+            self.calls += 1
+
+    def after_call(self, failed):
+        with self.lock:
+            now = time.monotonic()
+            if failed:
+                self.failures += 1
+            if self.state == CircuitState.half_open:
+                self.probing = False
+                if failed:
+                    self.trip(now)
+                else:
+                    logger.info(f'{self.name} circuit closed')
+                    self.state = CircuitState.closed
+                    self.outcomes.clear()
+                return
+
+            self.outcomes.append((now, failed))
+            while self.outcomes and now - self.outcomes[0][0] > self.window:
+                self.outcomes.popleft()
+            if self.state == CircuitState.closed and len(self.outcomes) >= settings.CIRCUIT_BREAKER_MINIMUM_CALLS:
+                failure_count = sum(1 for _, outcome_failed in self.outcomes if outcome_failed)
+                if failure_count / len(self.outcomes) >= settings.CIRCUIT_BREAKER_FAILURE_RATE:
+                    self.trip(now)
+
+    def trip(self, now):
+        logger.warning(f'{self.name} circuit opened')
+        self.state = CircuitState.open
+        self.opened_at = now
+        self.outcomes.clear()
+
+    @classmethod
+    def is_inconclusive(cls, exception):
+        """
+        Running out of the current request's time budget says nothing about the dependency
+        """
+        return isinstance(exception, DeadlineExceeded)
+
+    @classmethod
+    def is_failure(cls, exception):
+        """
+        Network problems and server errors count against the dependency;
+        client errors and running out of the current request's time budget do not
+        """
+        if not isinstance(exception, RequestException) or cls.is_inconclusive(exception):
+            return False
+        response = getattr(exception, 'response', None)
+        if response is None:
+            return True
+        return response.status_code >= 500
+
+    @classmethod
+    def is_failed_response(cls, result):
+        return isinstance(result, requests.Response) and result.status_code >= 500
+
+
+circuit_breakers_lock = threading.Lock()
+circuit_breakers = {}
+
+
+def get_circuit_breaker(name):
+    with circuit_breakers_lock:
+        if name not in circuit_breakers:
+            circuit_breakers[name] = CircuitBreaker(name)
+        return circuit_breakers[name]
+
+
+def reset_circuit_breakers():
+    with circuit_breakers_lock:
+        for circuit_breaker in circuit_breakers.values():
+            circuit_breaker.reset()
+
+
+def govuk_pay_circuit_breaker():
+    return get_circuit_breaker('govuk_pay')
+
+
+def mtp_api_circuit_breaker():
+    return get_circuit_breaker('mtp_api')
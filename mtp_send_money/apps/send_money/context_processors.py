@@ -1,8 +1,9 @@
 from django.conf import settings
-from django.urls import reverse
-from django.utils.translation import gettext
+from django.urls import get_script_prefix
 from mtp_common.analytics import AnalyticsPolicy
 
+from send_money.utils import get_support_links
+
 
 def analytics(request):
     return {
@@ -14,18 +15,7 @@ def analytics(request):
 def links(_):
     return {
         'site_url': settings.START_PAGE_URL,
-        'support_links': [
-            {
-                'url': reverse('terms'),
-                'title': gettext('Terms and conditions'),
-            },
-            {
-                'url': reverse('cookies'),
-                'title': gettext('Cookies'),
-            },
-            {
-                'url': reverse('help_area:help'),
-                'title': gettext('Help'),
-            },
-        ],
+        'support_links': get_support_links(),
+        # included in keys of cached fragments that contain links
+        'script_prefix': get_script_prefix(),
     }
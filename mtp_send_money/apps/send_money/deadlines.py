@@ -0,0 +1,157 @@
+import collections
+import contextlib
+import functools
+import math
+import threading
+import time
+
+from django.conf import settings
+from requests.exceptions import Timeout
+
+deadline_local = threading.local()
+
+
+class DeadlineExceeded(Timeout):
+    """
+    Raised instead of making an outbound call once the time budget of the current request is used up;
+    it's a requests Timeout so existing error handling treats it like a timed out call
+    """
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Limits the total time that outbound calls made within the block can take in this thread;
+    nested deadlines cannot extend an outer one
+    """
+    previous_expiry = getattr(deadline_local, 'expires_at', None)
+    expires_at = time.monotonic() + seconds
+    if previous_expiry is not None:
+        expires_at = min(expires_at, previous_expiry)
+    deadline_local.expires_at = expires_at
+    try:
+        yield
+    finally:
+        deadline_local.expires_at = previous_expiry
+
+
+def bind_deadline(func):
+    """
+    Wraps func so that it runs under the current thread's deadline when called in another thread,
+    e.g. when submitted to an executor
+    """
+    expires_at = getattr(deadline_local, 'expires_at', None)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous_expiry = getattr(deadline_local, 'expires_at', None)
+        deadline_local.expires_at = expires_at
+        try:
+            return func(*args, **kwargs)
+        finally:
+            deadline_local.expires_at = previous_expiry
+
+    return wrapper
+
+
+def get_remaining_time():
+    """
+    Returns the number of seconds left before the current deadline or None if there isn't one
+    """
+    expires_at = getattr(deadline_local, 'expires_at', None)
+    if expires_at is None:
+        return None
+    return max(expires_at - time.monotonic(), 0)
+
+
+class LatencyTracker:
+    """
+    Keeps the most recent latencies of calls to a dependency in order to derive timeouts from them
+    """
+
+    def __init__(self, name, size=200):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=size)
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def get_percentile(self, percentile):
+        with self.lock:
+            if len(self.latencies) < settings.ADAPTIVE_TIMEOUT_MINIMUM_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(math.ceil(len(latencies) * percentile / 100) - 1, len(latencies) - 1)
+        return latencies[max(index, 0)]
+
+    def get_timeout(self, maximum_timeout):
+        """
+        Returns a multiple of the latency percentile observed recently, bounded by the minimum adaptive timeout
+        and maximum_timeout; maximum_timeout is used until enough calls are recorded
+        """
+        latency = self.get_percentile(settings.ADAPTIVE_TIMEOUT_PERCENTILE)
+        if latency is None:
+            return maximum_timeout
+        timeout = max(latency * settings.ADAPTIVE_TIMEOUT_MULTIPLIER, settings.ADAPTIVE_TIMEOUT_MINIMUM)
+        return min(timeout, maximum_timeout)
+
+
+latency_trackers_lock = threading.Lock()
+latency_trackers = {}
+
+
+def get_latency_tracker(name):
+    with latency_trackers_lock:
+        if name not in latency_trackers:
+            latency_trackers[name] = LatencyTracker(name)
+        return latency_trackers[name]
+
+
+def get_timeout(name, maximum_timeout):
+    """
+    Returns the timeout to use for a call to dependency `name` considering its recent latency
+    and the remaining time before the current deadline
+
+    :raise DeadlineExceeded: if no time is left
+    """
+    return clamp_to_deadline(name, get_latency_tracker(name).get_timeout(maximum_timeout))
+
+
+def clamp_to_deadline(name, timeout):
+    """
+    Shortens timeout to the remaining time before the current deadline
+
+    :raise DeadlineExceeded: if no time is left
+    """
+    remaining_time = get_remaining_time()
+    if remaining_time is not None:
+        if remaining_time <= 0:
+            raise DeadlineExceeded(f'No time left to call {name}')
+        timeout = min(timeout, remaining_time)
+    return timeout
+
+
+def timed_call(name, maximum_timeout, func, *args, within_deadline=True, **kwargs):
+    """
+    Calls func passing in a `timeout` derived for dependency `name` and records how long it took;
+    calls made with within_deadline=False, such as ones that change state, are given maximum_timeout
+    regardless of recent latency and the current deadline so that a slow success is not reported as a failure
+    """
+    tracker = get_latency_tracker(name)
+    if within_deadline:
+        unclamped_timeout = tracker.get_timeout(maximum_timeout)
+        timeout = clamp_to_deadline(name, unclamped_timeout)
+    else:
+        timeout = unclamped_timeout = maximum_timeout
+    start = time.monotonic()
+    try:
+        result = func(*args, timeout=timeout, **kwargs)
+    except Timeout:
+        # a timeout cut short by the deadline says nothing about the dependency's latency
+        if timeout >= unclamped_timeout:
+            tracker.record(time.monotonic() - start)
+        raise
+    tracker.record(time.monotonic() - start)
+    return result
@@ -1,2 +1,13 @@
 class GovUkPaymentStatusException(Exception):
     pass
+
+
+class GovUkPaymentNotSettledException(GovUkPaymentStatusException):
+    pass
+
+
+class PaymentUpdateError(Exception):
+    def __init__(self, payment_ref, errors):
+        super().__init__(f'Payment {payment_ref} could not be updated: {errors}')
+        self.payment_ref = payment_ref
+        self.errors = errors
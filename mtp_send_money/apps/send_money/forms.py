@@ -14,6 +14,8 @@ from mtp_common.forms.fields import SplitDateField
 from oauthlib.oauth2 import OAuth2Error, TokenExpiredError
 from requests.exceptions import RequestException
 
+from send_money.circuit_breakers import mtp_api_circuit_breaker
+from send_money.deadlines import timed_call
 from send_money.models import PaymentMethodBankTransferDisabled
 from send_money.utils import (
     serialise_amount, unserialise_amount, serialise_date, unserialise_date,
@@ -26,8 +28,28 @@ logger = logging.getLogger('mtp')
 
 class SendMoneyForm(GARequestErrorReportingMixin, forms.Form):
 
+    @classmethod
+    def get_request_forms(cls, request):
+        """
+        Returns the forms built from the session during this request keyed by form class
+        """
+        if not hasattr(request, 'send_money_forms'):
+            request.send_money_forms = {}
+        return request.send_money_forms
+
     @classmethod
     def unserialise_from_session(cls, request):
+        """
+        Returns the form built from values saved in the session;
+        it's shared for the rest of the request so that it's only cleaned, including API lookups, once
+        """
+        request_forms = cls.get_request_forms(request)
+        if cls not in request_forms:
+            request_forms[cls] = cls.build_from_session(request)
+        return request_forms[cls]
+
+    @classmethod
+    def build_from_session(cls, request):
         session = request.session
 
         def get_value(f):
@@ -66,6 +88,9 @@ class SendMoneyForm(GARequestErrorReportingMixin, forms.Form):
         for field in getattr(cls, 'additional_fields_to_deserialize', []):
             session[field] = getattr(self, field, self.cleaned_data.get(field))
 
+        # forms built from the session earlier in this request are now out of date
+        self.get_request_forms(self.request).pop(cls, None)
+
 
 class PaymentMethodChoiceForm(SendMoneyForm):
     additional_fields_to_deserialize = ('payment_method',)
@@ -132,14 +157,20 @@ class PrisonerDetailsForm(SendMoneyForm):
     def lookup_prisoner(self, **filters):
         session = self.get_api_session()
         try:
-            return session.get('/prisoner_validity/', params=filters).json()
+            return timed_call(
+                'mtp_api', settings.API_TIMEOUT,
+                session.get, '/prisoner_validity/', params=filters,
+            ).json()
         except TokenExpiredError:
             pass
         except RequestException as e:
-            if e.response.status_code != 401:
+            if e.response is None or e.response.status_code != 401:
                 raise
         session = self.get_api_session(reconnect=True)
-        return session.get('/prisoner_validity/', params=filters).json()
+        return timed_call(
+            'mtp_api', settings.API_TIMEOUT,
+            session.get, '/prisoner_validity/', params=filters,
+        ).json()
 
     def clean_prisoner_number(self):
         prisoner_number = self.cleaned_data.get('prisoner_number')
@@ -158,7 +189,7 @@ class PrisonerDetailsForm(SendMoneyForm):
             prison_set = self.get_prison_set()
             if prison_set:
                 filters['prisons'] = ','.join(sorted(prison_set))
-            prisoners = self.lookup_prisoner(**filters)
+            prisoners = mtp_api_circuit_breaker().call(self.lookup_prisoner, **filters)
             assert prisoners['count'] == len(prisoners['results']) == 1
             prisoner = prisoners['results'][0]
             return prisoner and prisoner['prisoner_number'] == prisoner_number \
@@ -246,7 +277,9 @@ class DebitCardAmountForm(SendMoneyForm):
         if not settings.PRISONER_CAPPING_ENABLED:
             return True
 
-        prisoner_account_balance_integer = self.lookup_prisoner_account_balance()['combined_account_balance']
+        prisoner_account_balance_integer = mtp_api_circuit_breaker().call(
+            self.lookup_prisoner_account_balance
+        )['combined_account_balance']
 
         assert isinstance(prisoner_account_balance_integer, int), \
             f'expected NOMIS balance to be int but is {type(prisoner_account_balance_integer)}'
@@ -258,11 +291,14 @@ class DebitCardAmountForm(SendMoneyForm):
     def lookup_prisoner_account_balance(self, tries=0):
         session = self.get_api_session(reconnect=(tries != 0))
         try:
-            return session.get(f'/prisoner_account_balances/{self.prisoner_number}').json()
+            return timed_call(
+                'mtp_api', settings.API_TIMEOUT,
+                session.get, f'/prisoner_account_balances/{self.prisoner_number}',
+            ).json()
         except TokenExpiredError:
             pass
         except RequestException as e:
-            if e.response.status_code != 401:
+            if e.response is None or e.response.status_code != 401:
                 raise
         if tries < self.max_lookup_tries:
             return self.lookup_prisoner_account_balance(tries=tries + 1)
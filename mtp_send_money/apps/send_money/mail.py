@@ -1,17 +1,16 @@
 from decimal import Decimal
 
 from django.conf import settings
-from django.urls import reverse
 from django.utils.translation import gettext
 from mtp_common.tasks import send_email
 
-from send_money.utils import site_url
+from send_money.utils import get_help_url
 
 
 def _send_notification_email(email, template_name, subject, tags, context):
     context.update({
         'site_url': settings.START_PAGE_URL,
-        'help_url': site_url(reverse('help_area:help')),
+        'help_url': get_help_url(),
     })
     send_email(
         email,
@@ -70,7 +69,7 @@ def send_email_for_card_payment_accepted(email, payment):
 
 def send_email_for_card_payment_rejected(email, payment):
     context = _get_email_context_for_payment(payment)
-    context['compliance_contact'] = settings.COMPLIANCE_CONTACT_EMAIL or site_url(reverse('help_area:help'))
+    context['compliance_contact'] = settings.COMPLIANCE_CONTACT_EMAIL or get_help_url()
 
     _send_notification_email(
         email,
@@ -0,0 +1,24 @@
+from django.core.management import BaseCommand, CommandError
+
+from send_money.benchmarks import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Runs micro-benchmarks of performance-sensitive code'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('names', nargs='*', help='Benchmarks to run; all are run if none are given')
+        parser.add_argument('--iterations', type=int, default=1000, help='Number of times to repeat timed code')
+
+    def handle(self, *args, **options):
+        names = options['names']
+        unknown_names = set(names) - set(benchmarks)
+        if unknown_names:
+            raise CommandError('Unknown benchmarks: %s' % ', '.join(sorted(unknown_names)))
+        for name in names or sorted(benchmarks):
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for description, value, unit in benchmarks[name](options['iterations']):
+                if isinstance(value, float):
+                    value = '%.2f' % value
+                self.stdout.write(f'  {description}: {value} {unit}')
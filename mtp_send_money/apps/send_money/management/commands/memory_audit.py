@@ -0,0 +1,72 @@
+import os
+import tempfile
+import tracemalloc
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from send_money.management.commands.profile_imports import run_python
+
+
+class Command(BaseCommand):
+    """
+    Loads the web application in a fresh python process with tracemalloc enabled and reports
+    memory allocated by the time a uwsgi worker would be forked
+    """
+    help = 'Reports memory allocated by the web application before serving requests'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--no-warm-up', action='store_false', dest='warm_up',
+                            help='Do not run warm-up stages that prepare static data before forking')
+        parser.add_argument('--group-by', choices=('filename', 'lineno', 'traceback'), default='filename',
+                            help='How to group allocations')
+        parser.add_argument('--frames', type=int, default=1, help='Number of stack frames to record per allocation')
+        parser.add_argument('--limit', type=int, default=20, help='Number of allocation groups to list')
+        parser.add_argument('--save', help='Path to save the tracemalloc snapshot to')
+        parser.add_argument('--compare-to', help='Path of a saved snapshot to report differences from')
+
+    def handle(self, **options):
+        snapshot = self.take_snapshot(options)
+        if options['save']:
+            snapshot.dump(options['save'])
+        limit = options['limit']
+
+        statistics = snapshot.statistics(options['group_by'])
+        self.stdout.write(f'{sum(stat.size for stat in statistics) / 1024:.0f} KiB allocated '
+                          f'in {sum(stat.count for stat in statistics)} blocks')
+
+        if options['compare_to']:
+            previous_snapshot = tracemalloc.Snapshot.load(options['compare_to'])
+            self.stdout.write(self.style.MIGRATE_HEADING(f'Largest differences from {options["compare_to"]}'))
+            for stat in snapshot.compare_to(previous_snapshot, options['group_by'])[:limit]:
+                self.stdout.write(f'  {stat}')
+        else:
+            self.stdout.write(self.style.MIGRATE_HEADING('Largest allocations'))
+            for stat in statistics[:limit]:
+                self.stdout.write(f'  {stat}')
+
+    def take_snapshot(self, options):
+        wsgi_module = settings.WSGI_APPLICATION.rsplit('.', 1)[0]
+        with tempfile.TemporaryDirectory() as path:
+            snapshot_path = os.path.join(path, 'snapshot')
+            code = (
+                'import tracemalloc\n'
+                f'tracemalloc.start({options["frames"]})\n'
+                f'import {wsgi_module}\n'
+            )
+            if options['warm_up']:
+                code += (
+                    'from send_money.warmup import warm_up\n'
+                    'warm_up()\n'
+                )
+            code += (
+                'snapshot = tracemalloc.take_snapshot()\n'
+                'snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])\n'
+                f'snapshot.dump({snapshot_path!r})\n'
+            )
+            # warm-up is run explicitly so that worker connections are not opened
+            process = run_python(code, env={'WARM_UP': 'False'})
+            if process.returncode:
+                raise CommandError(f'Loading application failed:\n{process.stderr[-2000:]}')
+            return tracemalloc.Snapshot.load(snapshot_path)
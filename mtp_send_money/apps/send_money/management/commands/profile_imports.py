@@ -0,0 +1,94 @@
+import collections
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError, get_commands
+
+ImportTime = collections.namedtuple('ImportTime', 'module self_time cumulative_time')
+
+
+def parse_import_times(output):
+    """
+    Parses the output of python's `-X importtime` option into a list of ImportTime with times in microseconds
+    """
+    import_times = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative_time, module = line[len('import time:'):].split('|')
+        if not self_time.strip().isdigit():
+            # column headings
+            continue
+        import_times.append(ImportTime(module.strip(), int(self_time), int(cumulative_time)))
+    return import_times
+
+
+def run_python(code, python_options=(), env=None):
+    """
+    Runs code in a fresh python interpreter that can import the application, returning the completed process
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, sys.path)), **(env or {}))
+    return subprocess.run(
+        [sys.executable, *python_options, '-c', code],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+
+
+class Command(BaseCommand):
+    """
+    Starts a fresh python process that loads the web application or a management command
+    and reports where the time spent importing modules goes
+    """
+    help = 'Reports time spent importing modules when a web worker or management command starts'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('target', nargs='?', default='wsgi',
+                            help='"wsgi" to load the web application with its urls or the name of a management command')
+        parser.add_argument('--limit', type=int, default=20, help='Number of packages and modules to list')
+
+    def handle(self, target, **options):
+        import_times = parse_import_times(self.run_target(target))
+        if not import_times:
+            raise CommandError('No import times were reported')
+        limit = options['limit']
+
+        total = sum(import_time.self_time for import_time in import_times)
+        self.stdout.write(f'{len(import_times)} modules imported in {total / 1000:.1f} ms')
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Packages by own import time'))
+        packages = collections.Counter()
+        for import_time in import_times:
+            packages[import_time.module.split('.', 1)[0]] += import_time.self_time
+        for package, self_time in packages.most_common(limit):
+            self.stdout.write(f'  {package}: {self_time / 1000:.1f} ms')
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Modules by cumulative import time'))
+        import_times.sort(key=lambda import_time: import_time.cumulative_time, reverse=True)
+        for import_time in import_times[:limit]:
+            self.stdout.write(f'  {import_time.module}: {import_time.cumulative_time / 1000:.1f} ms')
+
+    def run_target(self, target):
+        if target == 'wsgi':
+            wsgi_module = settings.WSGI_APPLICATION.rsplit('.', 1)[0]
+            code = (
+                f'import {wsgi_module}\n'
+                'from django.urls import get_resolver\n'
+                'get_resolver().url_patterns\n'
+            )
+        else:
+            commands = get_commands()
+            if target not in commands:
+                raise CommandError(f'Unknown command: {target}')
+            code = (
+                'import django\n'
+                'django.setup()\n'
+                'from django.core.management import load_command_class\n'
+                f'load_command_class({commands[target]!r}, {target!r})\n'
+            )
+        process = run_python(code, python_options=('-X', 'importtime'))
+        if process.returncode:
+            raise CommandError(f'Loading {target} failed:\n{process.stderr[-2000:]}')
+        return process.stderr
@@ -0,0 +1,69 @@
+import threading
+
+from django.core.management import BaseCommand, CommandError
+
+from send_money.stubs import GovUkPayStubHandler, MTPAPIStubHandler, StubBehaviour, StubDataset, start_stub_server
+
+
+class Command(BaseCommand):
+    """
+    Serves in-memory stand-ins for the MTP API and GOV.UK Pay so that load tests and benchmarks can run offline;
+    point API_URL and GOVUK_PAY_URL at the printed addresses
+    """
+    help = 'Runs stub MTP API and GOV.UK Pay servers for performance testing'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--host', default='localhost', help='Address to listen on')
+        parser.add_argument('--api-port', type=int, default=8000, help='Port for the MTP API stub')
+        parser.add_argument('--govuk-port', type=int, default=8001, help='Port for the GOV.UK Pay stub')
+        parser.add_argument('--latency', type=float, default=0, help='Milliseconds added to each response')
+        parser.add_argument('--jitter', type=float, default=0, help='Milliseconds by which latency randomly varies')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='Proportion of requests that fail with a server error, between 0 and 1')
+        parser.add_argument('--govuk-rate-limit', type=int, default=0,
+                            help='Requests per second the GOV.UK Pay stub allows before responding with 429')
+        parser.add_argument('--prisoners', type=int, default=1000, help='Number of prisoners that can be found')
+        parser.add_argument('--prisons', type=int, default=100, help='Number of prisons listed')
+        parser.add_argument('--payments', type=int, default=0,
+                            help='Number of completed card payments awaiting update in MTP')
+        parser.add_argument('--seed', type=int, help='Seed for generated data, latency and errors')
+
+    def handle(self, **options):
+        try:
+            dataset = StubDataset(
+                prisoners=options['prisoners'], prisons=options['prisons'], payments=options['payments'],
+                seed=options['seed'],
+            )
+            behaviour = StubBehaviour(
+                latency=options['latency'] / 1000, jitter=options['jitter'] / 1000,
+                error_rate=options['error_rate'], rate_limit=options['govuk_rate_limit'], seed=options['seed'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        servers = [
+            start_stub_server(handler_class, dataset, behaviour, host=options['host'], port=port)
+            for handler_class, port in (
+                (MTPAPIStubHandler, options['api_port']),
+                (GovUkPayStubHandler, options['govuk_port']),
+            )
+        ]
+        api_server, govuk_server = servers
+        self.stdout.write(f'API_URL={api_server.url}')
+        self.stdout.write(f'GOVUK_PAY_URL={govuk_server.url}')
+        prisoner = dataset.get_prisoner(0)
+        self.stdout.write(f'Prisoners are numbered from {prisoner["prisoner_number"]} '
+                          f'born on {prisoner["prisoner_dob"]}; quit with CONTROL-C')
+        try:
+            self.wait_for_interrupt()
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+    def wait_for_interrupt(self):
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -1,40 +1,124 @@
 from datetime import timedelta
 import logging
+import threading
+import time
 
+from django.conf import settings
 from django.core.management import BaseCommand
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
-from mtp_common.stack import StackException, is_first_instance
 from oauthlib.oauth2 import OAuth2Error
 from requests.exceptions import RequestException
 
-from send_money.exceptions import GovUkPaymentStatusException
-from send_money.payments import GovUkPaymentStatus, PaymentClient
+from send_money.circuit_breakers import CircuitOpenError
+from send_money.exceptions import GovUkPaymentNotSettledException, GovUkPaymentStatusException
+from send_money.payments import GovUkPaymentStatus, PaymentClient, PaymentUpdateBatch, PendingPaymentUpdate
+from send_money.reconciliation import (
+    ReconciliationReport,
+    defer_completion, get_priority, get_shard, is_completion_deferred, is_in_shard, lease,
+)
 from send_money.views import get_payment_delayed_capture_rollout_percentage
 
 logger = logging.getLogger('mtp')
 
 
+def is_first_instance():
+    # the kubernetes client is slow to import so is only loaded when the stack is queried
+    from mtp_common.stack import is_first_instance as stack_is_first_instance
+
+    return stack_is_first_instance()
+
+
 ALWAYS_CHECK_IF_OLDER_THAN = timedelta(days=3)
 
 
 class Command(BaseCommand):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stop_at = None
+        self.batch_size = 1
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--metrics-file', default=settings.RECONCILIATION_METRICS_FILE,
+                            help='Path to write run metrics to in prometheus text format')
+        parser.add_argument('--sharded', action='store_true', default=settings.RECONCILIATION_SHARDED,
+                            help='Process a slice of incomplete payments on every instance '
+                                 'instead of all of them on the first instance')
+        parser.add_argument('--shard-index', type=int, help='Slice to process when sharded; derived if not set')
+        parser.add_argument('--shard-count', type=int, help='Number of slices when sharded; derived if not set')
+        parser.add_argument('--time-limit', type=int, default=settings.RECONCILIATION_TIME_LIMIT,
+                            help='Seconds after which no more payments are checked in a run; 0 for no limit')
+        parser.add_argument('--batch-size', type=int, default=settings.RECONCILIATION_UPDATE_BATCH_SIZE,
+                            help='Number of completed payments to update in one request to the MTP API; '
+                                 '1 to update each immediately')
+
     def handle(self, **options):
+        self.update_incomplete_payments(options)
+
+    def update_incomplete_payments(self, options, **update_kwargs):
+        """
+        Updates incomplete payments if this instance should, returning the run report
+        """
         verbosity = options['verbosity']
-        if self.should_perform_update():
+        self.stop_at = time.monotonic() + options['time_limit'] if options['time_limit'] else None
+        self.batch_size = options['batch_size']
+        if options['sharded']:
+            shard_index, shard_count = self.get_shard(options)
+            # leased by index alone so that runs that disagree on the number of shards still exclude each other
+            with lease(f'update-incomplete-payments-{shard_index}') as acquired:
+                if not acquired:
+                    if verbosity:
+                        self.stdout.write(
+                            f'Not updating incomplete payments because shard {shard_index + 1} of {shard_count} '
+                            'is being processed elsewhere'
+                        )
+                    return
+                if verbosity:
+                    self.stdout.write(f'Updating incomplete payments in shard {shard_index + 1} of {shard_count}')
+                report = self.perform_update(shard=(shard_index, shard_count), **update_kwargs)
+        elif self.should_perform_update():
             if verbosity:
                 self.stdout.write('Updating incomplete payments')
-            self.perform_update()
-        elif verbosity:
-            self.stdout.write('Not updating incomplete payments because running on secondary instance')
+            report = self.perform_update(**update_kwargs)
+        else:
+            if verbosity:
+                self.stdout.write('Not updating incomplete payments because running on secondary instance')
+            return None
+
+        logger.info('Updated incomplete payments\n%s' % report.summary())
+        if verbosity > 1:
+            self.stdout.write(report.summary())
+        if options['metrics_file']:
+            report.write_textfile(options['metrics_file'])
+        return report
+
+    def get_shard(self, options):
+        if options['shard_index'] is not None and options['shard_count']:
+            return options['shard_index'], options['shard_count']
+        from mtp_common.stack import StackException
+
+        try:
+            return get_shard()
+        except StackException:
+            self.stderr.write('Not running on Cloud Platform')
+            return 0, 1
 
     def should_perform_update(self):
+        from mtp_common.stack import StackException
+
         try:
             return is_first_instance()
         except StackException:
             self.stderr.write('Not running on Cloud Platform')
             return True
 
+    def should_stop(self):
+        """
+        Returns True if the run should end before processing any more payments
+        """
+        return self.stop_at is not None and time.monotonic() >= self.stop_at
+
     def should_be_checked(self, payment):
         """
         Returns True if the GOV.UK Pay API should be used to check the status of the payment.
@@ -54,41 +138,153 @@ class Command(BaseCommand):
 
         return security_check.get('status') != 'pending'
 
-    def perform_update(self):
-        payment_client = PaymentClient()
-        payments = payment_client.get_incomplete_payments()
-        for payment in payments:
-            if not self.should_be_checked(payment):
-                continue
+    def perform_update(self, shard=None, payment_client=None, executor=None):
+        """
+        Checks and completes incomplete payments, only those in the given slice if shard is provided;
+        payments are processed most urgent first so that a run cut short still captures and cancels those it can
 
-            payment_ref = payment['uuid']
-            govuk_id = payment['processor_id']
+        :param shard: tuple of shard index and count
+        :param payment_client: PaymentClient to reuse, a new one is created if not provided
+        :param executor: concurrent.futures.Executor to process payments with, otherwise they're processed in turn
+        """
+        report = ReconciliationReport()
+        payment_client = payment_client or PaymentClient()
+        govuk_calls = payment_client.govuk_calls
+        with report.phase('fetch'):
+            payments = payment_client.get_incomplete_payments()
+        report.count('fetched', len(payments))
+        if shard:
+            shard_payments = [payment for payment in payments if is_in_shard(payment, *shard)]
+            report.count('other_shard', len(payments) - len(shard_payments))
+            payments = shard_payments
+        payments.sort(key=get_priority)
+
+        circuit_open = threading.Event()
+        batch = self.get_update_batch(payment_client, report)
 
+        def process(payment):
+            if circuit_open.is_set() or self.should_stop():
+                report.count('deferred')
+                return
+            if is_completion_deferred(payment):
+                report.count('settling')
+                return
+            if not self.should_be_checked(payment):
+                report.count('skipped')
+                return
             try:
+                self.process_payment(payment_client, payment, report, batch=batch)
+            except CircuitOpenError as error:
+                report.error(error)
+                logger.warning('Scheduled job: Stopping because %s' % error)
+                circuit_open.set()
+
+        if executor:
+            for _ in executor.map(process, payments):
+                pass
+        else:
+            for payment in payments:
+                process(payment)
+        if batch is not None:
+            self.flush_update_batch(payment_client, batch, report)
+
+        report.govuk_calls = payment_client.govuk_calls - govuk_calls
+        report.finish()
+        return report
+
+    def get_update_batch(self, payment_client, report):
+        """
+        Returns a PaymentUpdateBatch that counts completed payments and reports those that could not be updated
+        or None if payments should be updated immediately
+        """
+        if self.batch_size <= 1:
+            return None
+
+        def report_failure(payment_ref, error):
+            report.error(error)
+            logger.error('Scheduled job: Payment update failed for ref %s: %s' % (payment_ref, error))
+
+        return PaymentUpdateBatch(
+            payment_client, self.batch_size,
+            on_success=lambda _: report.count('completed'),
+            on_failure=report_failure,
+        )
+
+    def flush_update_batch(self, payment_client, batch, report):
+        # discarded updates are reported as failures by the batch
+        try:
+            with report.phase('update'):
+                batch.flush()
+        except OAuth2Error:
+            logger.exception('Scheduled job: Authentication error while updating payments')
+            payment_client.reset_api_session()
+        except CircuitOpenError as error:
+            logger.warning('Scheduled job: Could not update payments because %s' % error)
+
+    def process_payment(self, payment_client, payment, report, batch=None):
+        """
+        Checks the GOV.UK payment related to an incomplete payment and completes both if possible;
+        the completed payment's update is queued in batch if provided
+
+        :raise CircuitOpenError: if GOV.UK Pay or the MTP API are considered unavailable
+        """
+        payment_ref = payment['uuid']
+        govuk_id = payment['processor_id']
+        govuk_payment = None
+        # attribute changes are written together with the final status
+        pending_update = PendingPaymentUpdate(payment)
+
+        try:
+            with report.phase('govuk_lookup'):
                 govuk_payment = payment_client.get_govuk_payment(govuk_id)
-                previous_govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
-                govuk_status = payment_client.complete_payment_if_necessary(payment, govuk_payment)
+            previous_govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
+            with report.phase('completion'):
+                govuk_status = payment_client.complete_payment_if_necessary(
+                    payment, govuk_payment, pending_update=pending_update,
+                )
+            if previous_govuk_status == GovUkPaymentStatus.capturable:
+                if govuk_status == GovUkPaymentStatus.success:
+                    report.count('captured')
+                elif govuk_status == GovUkPaymentStatus.cancelled:
+                    report.count('cancelled')
 
-                # not yet finished and can't do anything so skip
-                if govuk_status and not govuk_status.finished():
-                    continue
+            # not yet finished and can't do anything so skip
+            if govuk_status and not govuk_status.finished():
+                return
 
-                if previous_govuk_status != govuk_status:
-                    # refresh govuk payment to get up-to-date fields (e.g. error codes)
+            if previous_govuk_status != govuk_status and govuk_status == GovUkPaymentStatus.success:
+                # refresh govuk payment after capture to get its settlement summary;
+                # a cancellation's resulting state is already known so it is not looked up again
+                with report.phase('govuk_lookup'):
                     govuk_payment = payment_client.get_govuk_payment(govuk_id)
 
-                # if here, status is either success, failed, cancelled, error
-                # or None (in case of govuk payment not found)
-                payment_client.update_completed_payment(payment, govuk_payment)
-            except OAuth2Error:
-                logger.exception(
-                    'Scheduled job: Authentication error while processing %s' % payment_ref
+            # if here, status is either success, failed, cancelled, error
+            # or None (in case of govuk payment not found)
+            with report.phase('update'):
+                payment_client.update_completed_payment(
+                    payment, govuk_payment, batch=batch, pending_update=pending_update,
                 )
-            except RequestException as error:
-                error_message = 'Scheduled job: Payment check failed for ref %s' % payment_ref
-                if hasattr(error, 'response') and hasattr(error.response, 'content'):
-                    error_message += '\nReceived: %s' % error.response.content
-                logger.exception(error_message)
-            except GovUkPaymentStatusException:
-                # expected much of the time
-                pass
+            if batch is None:
+                report.count('completed')
+        except OAuth2Error as error:
+            report.error(error)
+            logger.exception(
+                'Scheduled job: Authentication error while processing %s' % payment_ref
+            )
+            # authenticate again for the next payment
+            payment_client.reset_api_session()
+        except CircuitOpenError:
+            raise
+        except RequestException as error:
+            report.error(error)
+            error_message = 'Scheduled job: Payment check failed for ref %s' % payment_ref
+            if hasattr(error, 'response') and hasattr(error.response, 'content'):
+                error_message += '\nReceived: %s' % error.response.content
+            logger.exception(error_message)
+        except GovUkPaymentNotSettledException:
+            # captured but GOV.UK Pay does not yet know when so leave until it's likely to have settled
+            report.count('settling')
+            defer_completion(payment, govuk_payment)
+        except GovUkPaymentStatusException as error:
+            # expected much of the time
+            report.error(error)
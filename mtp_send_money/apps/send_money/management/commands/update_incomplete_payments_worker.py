@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import signal
+import threading
+import time
+
+from django.conf import settings
+from oauthlib.oauth2 import OAuth2Error
+from requests.exceptions import RequestException
+
+from send_money.management.commands.update_incomplete_payments import Command as UpdateIncompletePaymentsCommand
+from send_money.payments import PaymentClient
+
+logger = logging.getLogger('mtp')
+
+
+class Command(UpdateIncompletePaymentsCommand):
+    """
+    Updates incomplete payments repeatedly in one long-running process so that
+    authenticated API sessions and connection pools are reused between runs
+    """
+    help = 'Long-running worker that updates incomplete payments at a regular interval'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stop_event = threading.Event()
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--interval', type=int, default=settings.RECONCILIATION_WORKER_INTERVAL,
+                            help='Seconds between the start of consecutive runs')
+        parser.add_argument('--concurrency', type=int, default=settings.RECONCILIATION_WORKER_CONCURRENCY,
+                            help='Number of payments to check at once')
+        parser.add_argument('--runs', type=int, help='Stop after this many runs; runs until stopped if not set')
+
+    def handle(self, **options):
+        previous_handlers = {
+            signal_number: signal.signal(signal_number, self.handle_stop_signal)
+            for signal_number in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            self.run_worker(options)
+        finally:
+            for signal_number, handler in previous_handlers.items():
+                signal.signal(signal_number, handler)
+
+    def run_worker(self, options):
+        verbosity = options['verbosity']
+        payment_client = PaymentClient()
+        concurrency = max(options['concurrency'], 1)
+        runs = 0
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='reconciliation') as executor:
+            while not self.stop_event.is_set():
+                started_at = time.monotonic()
+                try:
+                    self.update_incomplete_payments(
+                        options,
+                        payment_client=payment_client,
+                        executor=executor if concurrency > 1 else None,
+                    )
+                except Exception as error:  # noqa: B902
+                    # the worker carries on with the next run whatever went wrong with this one
+                    logger.exception('Scheduled job: Updating incomplete payments failed')
+                    if isinstance(error, (OAuth2Error, RequestException)):
+                        payment_client.reset_api_session()
+                runs += 1
+                if options['runs'] and runs >= options['runs']:
+                    break
+                self.stop_event.wait(max(options['interval'] - (time.monotonic() - started_at), 0))
+        if verbosity:
+            self.stdout.write('Stopped updating incomplete payments')
+
+    def handle_stop_signal(self, signal_number, _frame):
+        # payments being checked are allowed to finish, but no more are started
+        logger.info('Scheduled job: Stopping incomplete payment worker after signal %d' % signal_number)
+        self.stop_event.set()
+
+    def should_stop(self):
+        return self.stop_event.is_set() or super().should_stop()
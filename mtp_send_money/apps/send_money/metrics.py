@@ -0,0 +1,80 @@
+from django.apps import apps
+from django.conf import settings
+from prometheus_client.metrics_core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.parser import text_string_to_metric_families
+
+from send_money.circuit_breakers import circuit_breakers, circuit_breakers_lock
+from send_money.rate_limits import rate_limiters, rate_limiters_lock
+
+
+class ReconciliationMetricCollector:
+    """
+    Exposes metrics written by the last incomplete payment reconciliation run
+    which happens in a separate process
+    """
+
+    def collect(self):
+        if not settings.RECONCILIATION_METRICS_FILE:
+            return []
+        try:
+            with open(settings.RECONCILIATION_METRICS_FILE) as f:
+                return list(text_string_to_metric_families(f.read()))
+        except (OSError, ValueError):
+            return []
+
+
+class CircuitBreakerMetricCollector:
+    """
+    Exposes the state of circuit breakers around upstream services in this process
+    """
+
+    def collect(self):
+        state = GaugeMetricFamily(
+            'mtp_circuit_breaker_state', 'Circuit breaker state: 0 closed, 1 open, 2 half-open',
+            labels=['name'],
+        )
+        calls = CounterMetricFamily(
+            'mtp_circuit_breaker_calls', 'Calls allowed through the circuit breaker', labels=['name'],
+        )
+        failures = CounterMetricFamily(
+            'mtp_circuit_breaker_failures', 'Calls that failed', labels=['name'],
+        )
+        rejections = CounterMetricFamily(
+            'mtp_circuit_breaker_rejections', 'Calls rejected without being attempted', labels=['name'],
+        )
+        with circuit_breakers_lock:
+            for name, circuit_breaker in circuit_breakers.items():
+                state.add_metric([name], circuit_breaker.state.value)
+                calls.add_metric([name], circuit_breaker.calls)
+                failures.add_metric([name], circuit_breaker.failures)
+                rejections.add_metric([name], circuit_breaker.rejections)
+        return [state, calls, failures, rejections]
+
+
+class RateLimiterMetricCollector:
+    """
+    Exposes how often rate limiters around upstream services in this process held back calls
+    """
+
+    def collect(self):
+        delays = CounterMetricFamily(
+            'mtp_rate_limiter_delays', 'Calls delayed to stay within the rate limit', labels=['name'],
+        )
+        rejections = CounterMetricFamily(
+            'mtp_rate_limiter_rejections', 'Calls rejected because the wait would have been too long',
+            labels=['name'],
+        )
+        with rate_limiters_lock:
+            for name, rate_limiter in rate_limiters.items():
+                delays.add_metric([name], rate_limiter.bucket.delays)
+                rejections.add_metric([name], rate_limiter.bucket.rejections)
+        return [delays, rejections]
+
+
+try:
+    app = apps.get_app_config('metrics')
+    app.register_collector(ReconciliationMetricCollector())
+    app.register_collector(CircuitBreakerMetricCollector())
+    app.register_collector(RateLimiterMetricCollector())
+except LookupError:
+    pass
@@ -1,5 +1,6 @@
 import logging
 
+from django.conf import settings
 from django.http import Http404
 from django.utils.cache import add_never_cache_headers
 from django.utils.translation import gettext as _
@@ -7,6 +8,8 @@ from django.utils.translation import gettext as _
 from mtp_common.auth.exceptions import Unauthorized
 from mtp_common.auth.models import MojAnonymousUser
 
+from send_money.deadlines import deadline
+
 logger = logging.getLogger('mtp')
 
 
@@ -16,7 +19,9 @@ class SendMoneyMiddleware:
 
     def __call__(self, request):
         request.user = MojAnonymousUser()
-        response = self.get_response(request)
+        # outbound calls made while handling the request share a time budget
+        with deadline(settings.REQUEST_DEADLINE):
+            response = self.get_response(request)
         if not response.has_header('Cache-Control'):
             add_never_cache_headers(response)
         return response
@@ -1,6 +1,8 @@
 import enum
 from datetime import datetime, time, timedelta
+import functools
 import logging
+import threading
 from urllib.parse import quote_plus as url_quote
 
 from django.conf import settings
@@ -10,11 +12,15 @@ from django.utils import timezone
 from django.utils.dateparse import parse_datetime, parse_date
 from django.utils.functional import cached_property
 from mtp_common.api import retrieve_all_pages_for_path
-from mtp_common.auth.exceptions import HttpNotFoundError
+from mtp_common.auth.exceptions import HttpClientError, HttpNotFoundError
 import requests
 from requests.exceptions import RequestException
 
-from send_money.exceptions import GovUkPaymentStatusException
+from send_money.circuit_breakers import CircuitOpenError, govuk_pay_circuit_breaker, mtp_api_circuit_breaker
+from send_money.deadlines import get_remaining_time, timed_call
+from send_money.exceptions import (
+    GovUkPaymentNotSettledException, GovUkPaymentStatusException, PaymentUpdateError,
+)
 from send_money.mail import (
     send_email_for_card_payment_accepted,
     send_email_for_card_payment_confirmation,
@@ -22,6 +28,7 @@ from send_money.mail import (
     send_email_for_card_payment_rejected,
     send_email_for_card_payment_timed_out,
 )
+from send_money.rate_limits import govuk_pay_rate_limiter, parse_retry_after
 from send_money.utils import (
     get_api_session,
     govuk_headers,
@@ -67,11 +74,13 @@ class GovUkPaymentStatus(enum.Enum):
             )
 
     @classmethod
-    def payment_timed_out_after_capturable(cls, govuk_payment):
+    def payment_timed_out_after_capturable(cls, govuk_payment, payment_client=None):
         """
         :return: True if failed because of a timeout and the payment was in a capturable
             status at some point in the past.
 
+        :param payment_client: PaymentClient to use for looking up events, a new one is created if not provided
+
         :raise GovUkPaymentStatusException: if the input value is not in the expected format.
         """
         status = cls.get_from_govuk_payment(govuk_payment)
@@ -85,7 +94,7 @@ class GovUkPaymentStatus(enum.Enum):
 
         # check if there's a capturable event in the event log
         govuk_id = govuk_payment['payment_id']
-        payment_client = PaymentClient()
+        payment_client = payment_client or PaymentClient()
         events = payment_client.get_govuk_payment_events(govuk_id)
 
         return any(
@@ -118,36 +127,221 @@ def is_active_payment(payment):
         return False
 
 
+# (
+#   payment attribute name,
+#   path to the value in a govuk payment
+# )
+completion_payment_attr_paths = (
+    ('email', ('email',)),
+    ('worldpay_id', ('provider_id',)),
+    ('cardholder_name', ('card_details', 'cardholder_name')),
+    ('card_number_first_digits', ('card_details', 'first_digits_card_number')),
+    ('card_number_last_digits', ('card_details', 'last_digits_card_number')),
+    ('card_expiry_date', ('card_details', 'expiry_date')),
+    ('card_brand', ('card_details', 'card_brand')),
+    ('billing_address', ('card_details', 'billing_address')),
+)
+
+
+def compile_attr_plan(attr_paths):
+    """
+    Groups attribute paths by the object holding their values so that each is looked up once;
+    returns a tuple of (path to object, ((attribute name, key in object), ...))
+    """
+    plan = {}
+    for attr_name, path in attr_paths:
+        plan.setdefault(path[:-1], []).append((attr_name, path[-1]))
+    return tuple(
+        (object_path, tuple(attr_names))
+        for object_path, attr_names in plan.items()
+    )
+
+
+completion_payment_attr_plan = compile_attr_plan(completion_payment_attr_paths)
+
+
+class PendingPaymentUpdate:
+    """
+    Collects changes to one MTP payment so that attribute and status changes are written together;
+    the payment dict reflects them straight away
+    """
+
+    def __init__(self, payment):
+        self.payment = payment
+        self.changes = {}
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    def add(self, changes):
+        self.changes.update(changes)
+        self.payment.update(changes)
+
+    def take(self):
+        """
+        Returns collected changes, which are then no longer pending
+        """
+        changes, self.changes = self.changes, {}
+        return changes
+
+
 class PaymentClient:
     CHECK_INCOMPLETE_PAYMENT_DELAY = timedelta(minutes=settings.CHECK_INCOMPLETE_PAYMENT_DELAY)
 
-    @cached_property
+    def __init__(self):
+        self.govuk_calls = 0
+        self.govuk_calls_lock = threading.Lock()
+        self.bulk_payment_updates_supported = True
+        self._api_session = None
+        self.api_session_lock = threading.Lock()
+
+    @property
     def api_session(self):
-        return get_api_session()
+        # a client can be shared by threads so the session is created and reset under a lock
+        with self.api_session_lock:
+            if self._api_session is None:
+                self._api_session = get_api_session()
+            return self._api_session
+
+    def reset_api_session(self):
+        with self.api_session_lock:
+            self._api_session = None
+
+    @cached_property
+    def govuk_session(self):
+        """
+        Session reused for GOV.UK Pay calls so that connections are pooled
+        """
+        session = requests.Session()
+        session.headers.update(govuk_headers())
+        return session
+
+    def govuk_request(self, method, path, within_deadline=True, **kwargs):
+        """
+        Makes a request to the GOV.UK Pay API keeping count of calls made by this client.
+        Calls are throttled by a shared rate limiter; if GOV.UK Pay still responds with 429 Too Many Requests,
+        calls are paused as the Retry-After header asks and the request is retried a limited number of times
+        after which the 429 response is returned.
+        Requests that change state should pass within_deadline=False to be given the full GOVUK_PAY_TIMEOUT
+
+        :raise CircuitOpenError: if GOV.UK Pay is considered unavailable
+        :raise DeadlineExceeded: if the current request has no time left
+        :raise RateLimitExceeded: if waiting for the rate limit would take too long
+        """
+        rate_limiter = govuk_pay_rate_limiter()
+        retries = settings.GOVUK_PAY_RATE_LIMIT_RETRIES
+        while True:
+            rate_limiter.acquire(max_wait=self.get_max_rate_limit_wait(within_deadline))
+            with self.govuk_calls_lock:
+                self.govuk_calls += 1
+            response = govuk_pay_circuit_breaker().call(
+                timed_call, 'govuk_pay', settings.GOVUK_PAY_TIMEOUT,
+                self.govuk_session.request,
+                method,
+                govuk_url(path),
+                within_deadline=within_deadline,
+                **kwargs
+            )
+            if response.status_code != 429:
+                return response
+            rate_limiter.pause(parse_retry_after(response, maximum=settings.GOVUK_PAY_RATE_LIMIT_MAX_PAUSE))
+            if retries <= 0:
+                return response
+            retries -= 1
+
+    @classmethod
+    def get_max_rate_limit_wait(cls, within_deadline=True):
+        remaining_time = get_remaining_time() if within_deadline else None
+        if remaining_time is None:
+            return settings.GOVUK_PAY_RATE_LIMIT_MAX_WAIT
+        return max(min(remaining_time, settings.GOVUK_PAY_RATE_LIMIT_MAX_WAIT), 0)
+
+    def api_request(self, method, path, **kwargs):
+        """
+        Makes a request to the MTP API
+
+        :raise CircuitOpenError: if the MTP API is considered unavailable
+        :raise DeadlineExceeded: if the current request has no time left
+        """
+        return mtp_api_circuit_breaker().call(
+            timed_call, 'mtp_api', settings.API_TIMEOUT,
+            getattr(self.api_session, method),
+            path,
+            **kwargs
+        )
 
     def create_payment(self, new_payment):
-        api_response = self.api_session.post('/payments/', json=new_payment).json()
+        api_response = self.api_request('post', '/payments/', json=new_payment).json()
         return api_response['uuid']
 
     def get_incomplete_payments(self):
         older_than = timezone.now() - self.CHECK_INCOMPLETE_PAYMENT_DELAY
-        return retrieve_all_pages_for_path(
+        return mtp_api_circuit_breaker().call(
+            retrieve_all_pages_for_path,
             self.api_session, '/payments/', modified__lt=older_than.isoformat()
         )
 
     def get_payment(self, payment_ref):
         try:
             if payment_ref:
-                return self.api_session.get('/payments/%s/' % url_quote(payment_ref)).json()
+                return self.api_request('get', '/payments/%s/' % url_quote(payment_ref)).json()
         except HttpNotFoundError:
             pass
 
     def update_payment(self, payment_ref, payment_update):
         if not payment_ref:
             raise ValueError('payment_ref must be provided')
-        response = self.api_session.patch('/payments/%s/' % url_quote(payment_ref), json=payment_update)
+        response = self.api_request('patch', '/payments/%s/' % url_quote(payment_ref), json=payment_update)
         return response.json()
 
+    def update_payments(self, payment_updates):
+        """
+        Updates several payments using one request to the MTP API's bulk update endpoint
+        falling back to one request per payment if it is not available
+
+        :param payment_updates: dict of payment reference to changes
+        :return: dict of payment reference to the updated payment or the exception that prevented its update
+        :raise CircuitOpenError: if the MTP API is considered unavailable
+        :raise RequestException: if the bulk update request fails
+        """
+        if self.bulk_payment_updates_supported:
+            try:
+                response = self.api_request('patch', '/payments/', json=[
+                    dict(payment_update, uuid=payment_ref)
+                    for payment_ref, payment_update in payment_updates.items()
+                ])
+            except HttpClientError as e:
+                if e.response is None or e.response.status_code not in (404, 405):
+                    raise
+                logger.warning('MTP API does not support bulk payment updates')
+                self.bulk_payment_updates_supported = False
+            else:
+                return self.parse_bulk_payment_update_response(payment_updates, response)
+
+        results = {}
+        for payment_ref, payment_update in payment_updates.items():
+            try:
+                results[payment_ref] = self.update_payment(payment_ref, payment_update)
+            except CircuitOpenError:
+                raise
+            except RequestException as e:
+                results[payment_ref] = e
+        return results
+
+    def parse_bulk_payment_update_response(self, payment_updates, response):
+        try:
+            response_results = {result['uuid']: result for result in response.json()['results']}
+        except (ValueError, KeyError, TypeError):
+            raise RequestException('Cannot parse response', response=response)
+        results = {}
+        for payment_ref in payment_updates:
+            result = response_results.get(payment_ref) or {'errors': 'No result returned'}
+            if 'payment' in result:
+                results[payment_ref] = result['payment']
+            else:
+                results[payment_ref] = PaymentUpdateError(payment_ref, result.get('errors'))
+        return results
+
     def get_security_check_result(self, payment):
         """
         Checks the security check for 'payment' and returns a CheckResult indicating the next
@@ -169,7 +363,7 @@ class PaymentClient:
         logging.warning(f'Unrecognised check status {check_status} for payment {payment["uuid"]}')
         return CheckResult.capture
 
-    def complete_payment_if_necessary(self, payment, govuk_payment):
+    def complete_payment_if_necessary(self, payment, govuk_payment, pending_update=None):
         """
         Completes a payment if necessary and returns the resulting GovUkPaymentStatus.
 
@@ -185,6 +379,8 @@ class PaymentClient:
         :return: GovUkPaymentStatus for the GOV.UK payment govuk_payment
         :param payment: dict with MTP payment details as returned by the MTP API
         :param govuk_payment: dict with GOV.UK payment details as returned by the GOV.UK Pay API
+        :param pending_update: PendingPaymentUpdate to collect attribute changes in if they are not needed
+            straight away, i.e. unless the payment is capturable; they are then written by update_completed_payment
         """
         govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
         if not govuk_status:
@@ -212,7 +408,10 @@ class PaymentClient:
 
         # update payment so that we can work out if it has to be delayed
         payment_attr_updates = self.get_completion_payment_attr_updates(payment, govuk_payment)
-        if payment_attr_updates:
+        if payment_attr_updates and pending_update is not None and govuk_status != GovUkPaymentStatus.capturable:
+            # security checks only matter for capturable payments so the update can wait for the final status
+            pending_update.add(payment_attr_updates)
+        elif payment_attr_updates:
             # update instead of replace payment because we want to keep the same reference
             payment.update(
                 **self.update_payment(payment['uuid'], payment_attr_updates),
@@ -243,46 +442,18 @@ class PaymentClient:
         payment = payment or {}
         govuk_payment = govuk_payment or {}
 
-        def get_attr(attr_name):
-            def wrapper(govuk_payment):
-                return govuk_payment.get(attr_name)
-            return wrapper
-
-        def get_card_details_attr_value(govuk_card_details_attr_name):
-            def wrapper(govuk_payment):
-                card_details = govuk_payment.get('card_details', {})
-                return card_details.get(govuk_card_details_attr_name)
-            return wrapper
-
-        # (
-        #   payment attribute name,
-        #   callable to get the value from a govuk payment
-        # )
-        attrs_mapping = [
-            ('email', get_attr('email')),
-            ('worldpay_id', get_attr('provider_id')),
-            ('cardholder_name', get_card_details_attr_value('cardholder_name')),
-            ('card_number_first_digits', get_card_details_attr_value('first_digits_card_number')),
-            ('card_number_last_digits', get_card_details_attr_value('last_digits_card_number')),
-            ('card_expiry_date', get_card_details_attr_value('expiry_date')),
-            ('card_brand', get_card_details_attr_value('card_brand')),
-            ('billing_address', get_card_details_attr_value('billing_address')),
-        ]
-
         attr_updates = {}
-        for payment_attr_name, govuk_payment_attr_func in attrs_mapping:
-            payment_attr_value = payment.get(payment_attr_name)
-            if payment_attr_value:  # don't override existing values
-                continue
-
-            govuk_payment_attr_value = govuk_payment_attr_func(govuk_payment)
-
-            # no value or hasn't changed
-            if not govuk_payment_attr_value or govuk_payment_attr_value == payment_attr_value:
-                continue
-
-            attr_updates[payment_attr_name] = govuk_payment_attr_value
-
+        for govuk_payment_path, attr_names in completion_payment_attr_plan:
+            source = govuk_payment
+            for key in govuk_payment_path:
+                source = source.get(key) or {}
+            for payment_attr_name, govuk_payment_attr_name in attr_names:
+                # don't override existing values
+                if payment.get(payment_attr_name):
+                    continue
+                govuk_payment_attr_value = source.get(govuk_payment_attr_name)
+                if govuk_payment_attr_value:
+                    attr_updates[payment_attr_name] = govuk_payment_attr_value
         return attr_updates
 
     def capture_govuk_payment(self, govuk_payment):
@@ -296,16 +467,14 @@ class PaymentClient:
             return govuk_status
 
         govuk_id = govuk_payment['payment_id']
-        response = requests.post(
-            govuk_url(f'/payments/{govuk_id}/capture'),
-            headers=govuk_headers(),
-            timeout=15,
-        )
+        response = self.govuk_request('POST', f'/payments/{govuk_id}/capture', within_deadline=False)
 
         response.raise_for_status()
 
+        # GOV.UK Pay responds with no content so the known resulting state is merged in;
+        # callers that need settlement details must look the payment up again
         govuk_status = GovUkPaymentStatus.success
-        govuk_payment['state']['status'] = govuk_status.name
+        govuk_payment['state'] = {**govuk_payment['state'], 'status': govuk_status.name, 'finished': True}
         return govuk_status
 
     def cancel_govuk_payment(self, govuk_payment):
@@ -319,27 +488,45 @@ class PaymentClient:
             return govuk_status
 
         govuk_id = govuk_payment['payment_id']
-        response = requests.post(
-            govuk_url(f'/payments/{govuk_id}/cancel'),
-            headers=govuk_headers(),
-            timeout=15,
-        )
+        response = self.govuk_request('POST', f'/payments/{govuk_id}/cancel', within_deadline=False)
 
         response.raise_for_status()
 
+        # GOV.UK Pay responds with no content so the known resulting state is merged in
         govuk_status = GovUkPaymentStatus.cancelled
-        govuk_payment['state']['status'] = govuk_status.name
+        govuk_payment['state'] = {
+            **govuk_payment['state'],
+            'status': govuk_status.name,
+            'finished': True,
+            'code': 'P0040',
+            'message': 'Payment was cancelled by the service',
+        }
         return govuk_status
 
-    def update_completed_payment(self, payment, govuk_payment):
+    def update_completed_payment(self, payment, govuk_payment, batch=None, pending_update=None):
+        """
+        Updates the MTP payment once its GOV.UK payment has finished and notifies the sender
+
+        :param batch: PaymentUpdateBatch to queue the update in, otherwise it is written immediately;
+            notification emails are only sent once the update has been written
+        :param pending_update: PendingPaymentUpdate with changes collected earlier that are written together
+            with the final status; they are written on their own if the payment has not yet settled
+        """
         govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
-        timed_out_after_capturable = GovUkPaymentStatus.payment_timed_out_after_capturable(govuk_payment)
+        timed_out_after_capturable = GovUkPaymentStatus.payment_timed_out_after_capturable(govuk_payment, self)
 
         # update mtp payment
         payment_attr_updates = self.get_completion_payment_attr_updates(payment, govuk_payment)
+        if pending_update:
+            payment_attr_updates = {**pending_update.changes, **payment_attr_updates}
 
         if govuk_status == GovUkPaymentStatus.success:
-            received_at = self.get_govuk_capture_time(govuk_payment)
+            try:
+                received_at = self.get_govuk_capture_time(govuk_payment)
+            except GovUkPaymentNotSettledException:
+                if pending_update:
+                    self.update_payment(payment['uuid'], pending_update.take())
+                raise
             payment_attr_updates['received_at'] = received_at.isoformat()
             payment_attr_updates['status'] = 'taken'
         elif govuk_status == GovUkPaymentStatus.cancelled:
@@ -349,9 +536,19 @@ class PaymentClient:
         else:
             payment_attr_updates['status'] = 'failed'
 
-        self.update_payment(payment['uuid'], payment_attr_updates)
+        notify = functools.partial(
+            self.send_completed_payment_email,
+            payment, govuk_payment, govuk_status, timed_out_after_capturable,
+        )
+        if pending_update:
+            pending_update.take()
+        if batch is None:
+            self.update_payment(payment['uuid'], payment_attr_updates)
+            notify()
+        else:
+            batch.update(payment['uuid'], payment_attr_updates, on_success=notify)
 
-        # send notification email
+    def send_completed_payment_email(self, payment, govuk_payment, govuk_status, timed_out_after_capturable):
         email = (govuk_payment or {}).get('email')
         if not email:
             return
@@ -380,11 +577,7 @@ class PaymentClient:
                     logger.warning(f'Payment {payment["uuid"]} timed out before being actioned by FIU')
 
     def get_govuk_payment(self, govuk_id):
-        response = requests.get(
-            govuk_url('/payments/%s' % govuk_id),
-            headers=govuk_headers(),
-            timeout=15
-        )
+        response = self.govuk_request('GET', '/payments/%s' % govuk_id)
 
         if response.status_code != 200:
             if response.status_code == 404:
@@ -411,11 +604,7 @@ class PaymentClient:
         :raise HTTPError: if GOV.UK Pay returns a 4xx or 5xx response
         :raise RequestException: if the response body cannot be parsed
         """
-        response = requests.get(
-            govuk_url(f'/payments/{govuk_id}/events'),
-            headers=govuk_headers(),
-            timeout=15,
-        )
+        response = self.govuk_request('GET', f'/payments/{govuk_id}/events')
 
         response.raise_for_status()
 
@@ -449,15 +638,12 @@ class PaymentClient:
                     return capture_submit_time
         except (KeyError, TypeError):
             pass
-        raise GovUkPaymentStatusException(
+        raise GovUkPaymentNotSettledException(
             'Capture date not yet available for payment %s' % govuk_payment.get('reference')
         )
 
     def create_govuk_payment(self, payment_ref, new_govuk_payment):
-        govuk_response = requests.post(
-            govuk_url('/payments'), headers=govuk_headers(),
-            json=new_govuk_payment, timeout=15
-        )
+        govuk_response = self.govuk_request('POST', '/payments', within_deadline=False, json=new_govuk_payment)
 
         try:
             if govuk_response.status_code != 201:
@@ -473,3 +659,95 @@ class PaymentClient:
                 'Failed to create new GOV.UK payment for MTP payment %s. Received: %s'
                 % (payment_ref, govuk_response.content)
             )
+
+
+class PaymentUpdateBatch:
+    """
+    Queues updates to MTP payments so that they are written in groups using the MTP API's bulk update endpoint;
+    changes to the same payment are merged and callbacks run once its update has been written.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, payment_client, size, on_success=None, on_failure=None):
+        """
+        :param payment_client: PaymentClient used to write updates
+        :param size: number of payments to update in each request; queued updates are written when it is reached
+        :param on_success: called with the payment reference after each payment is updated
+        :param on_failure: called with the payment reference and exception when a payment could not be updated
+        """
+        self.payment_client = payment_client
+        self.size = max(size, 1)
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def update(self, payment_ref, payment_update, on_success=None):
+        """
+        Queues changes to a payment writing all queued changes if the batch is full
+
+        :param on_success: called with no arguments once the payment has been updated
+        """
+        with self.lock:
+            changes, callbacks = self.pending.setdefault(payment_ref, ({}, []))
+            changes.update(payment_update)
+            if on_success:
+                callbacks.append(on_success)
+            full = len(self.pending) >= self.size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all queued changes
+
+        :return: dict of payment reference to the exception that prevented its update
+        :raise CircuitOpenError: if the MTP API is considered unavailable; unwritten changes are discarded
+            and reported as failures, as they are if any other unexpected error occurs
+        """
+        with self.lock:
+            pending, self.pending = list(self.pending.items()), {}
+        failures = {}
+        for start in range(0, len(pending), self.size):
+            group = dict(pending[start:start + self.size])
+            try:
+                results = self.payment_client.update_payments({
+                    payment_ref: changes
+                    for payment_ref, (changes, _) in group.items()
+                })
+            except RequestException as e:
+                if isinstance(e, CircuitOpenError):
+                    self.discard(pending[start:], e)
+                    raise
+                results = {payment_ref: e for payment_ref in group}
+            except Exception as e:  # noqa: B902
+                self.discard(pending[start:], e)
+                raise
+            for payment_ref, result in results.items():
+                if isinstance(result, Exception):
+                    failures[payment_ref] = result
+                    if self.on_failure:
+                        self.on_failure(payment_ref, result)
+                    continue
+                for callback in group[payment_ref][1]:
+                    self.run_callback(payment_ref, callback)
+                if self.on_success:
+                    self.run_callback(payment_ref, self.on_success, payment_ref)
+        return failures
+
+    def discard(self, pending, error):
+        if self.on_failure:
+            for payment_ref, _ in pending:
+                self.on_failure(payment_ref, error)
+
+    @classmethod
+    def run_callback(cls, payment_ref, callback, *args):
+        # the payment is already updated so a failing callback must not stop others from running
+        try:
+            callback(*args)
+        except Exception:  # noqa: B902
+            logger.exception('Callback after updating payment %s failed' % payment_ref)
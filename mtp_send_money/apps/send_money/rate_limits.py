@@ -0,0 +1,251 @@
+import email.utils
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from requests.exceptions import RequestException
+
+logger = logging.getLogger('mtp')
+
+
+class RateLimitExceeded(RequestException):
+    """
+    Raised instead of making a request when waiting for the rate limit would take too long;
+    it's a RequestException so existing error handling treats it like a failed request
+    """
+
+
+class TokenBucket:
+    """
+    Spaces out calls made by this process so that no more than `rate` per second are made on average,
+    allowing bursts of up to `burst` calls. Callers reserve a token and then sleep until it is due
+    so that waiting callers are released in order rather than all retrying at once.
+    A pause (e.g. from a Retry-After header) stops tokens being issued until it ends.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.updated = None
+        self.paused_until = 0
+        self.delays = 0
+        self.rejections = 0
+
+    def __repr__(self):
+        return f'<TokenBucket {self.name}>'
+
+    def reserve(self, rate, burst, max_wait=None):
+        """
+        Takes a token returning how long the caller must wait before using it
+
+        :raise RateLimitExceeded: if the wait would be longer than max_wait
+        """
+        burst = max(burst, 1)
+        with self.lock:
+            now = time.monotonic()
+            if self.tokens is None:
+                self.tokens = burst
+            elif rate:
+                # tokens are not issued while paused
+                refill_from = max(self.updated, self.paused_until)
+                if now > refill_from:
+                    self.tokens = min(burst, self.tokens + (now - refill_from) * rate)
+            self.updated = now
+            wait = max(self.paused_until - now, 0)
+            if rate and self.tokens < 1:
+                wait += (1 - self.tokens) / rate
+            if max_wait is not None and wait > max_wait:
+                self.rejections += 1
+                raise RateLimitExceeded(f'{self.name} rate limit would delay call by {wait:.1f}s')
+            if rate:
+                self.tokens -= 1
+            if wait > 0:
+                self.delays += 1
+            return wait
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            if self.tokens is not None:
+                self.tokens = min(self.tokens, 0)
+            else:
+                self.tokens = 0
+                self.updated = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.tokens = None
+            self.updated = None
+            self.paused_until = 0
+
+
+class SharedRateLimit:
+    """
+    Limits calls made by all processes sharing a cache to `rate` per one-second window.
+    Django's cache has no atomic refill so this is a fixed-window approximation of a token bucket;
+    it relies on `add` and `incr` being atomic which is true of memcached and redis but not file-based caches.
+    """
+
+    def __init__(self, name, cache_name):
+        self.name = name
+        self.cache = caches[cache_name]
+        self.key_prefix = f'rate-limit-{name}'
+
+    def __repr__(self):
+        return f'<SharedRateLimit {self.name}>'
+
+    def acquire(self, rate, max_wait=None):
+        """
+        Waits until a call is allowed returning the time spent waiting
+
+        :raise RateLimitExceeded: if the wait would be longer than max_wait
+        """
+        waited = 0
+        while True:
+            now = time.time()
+            paused_until = self.cache.get(f'{self.key_prefix}-paused-until') or 0
+            if paused_until > now:
+                wait = paused_until - now
+            elif rate:
+                window = int(now)
+                key = f'{self.key_prefix}-{window}'
+                self.cache.add(key, 0, timeout=2)
+                try:
+                    count = self.cache.incr(key)
+                except ValueError:
+                    # the window expired between being added and incremented
+                    continue
+                if count <= rate:
+                    return waited
+                wait = window + 1 - now
+            else:
+                return waited
+            if max_wait is not None and waited + wait > max_wait:
+                raise RateLimitExceeded(f'{self.name} shared rate limit would delay call by {waited + wait:.1f}s')
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        self.cache.set(f'{self.key_prefix}-paused-until', time.time() + seconds, timeout=math.ceil(seconds) + 1)
+
+
+class RateLimiter:
+    """
+    Throttles calls to a dependency using a token bucket per process and, if a cache is configured,
+    a limit shared between processes. Settings are read using a prefix, e.g. for GOVUK_PAY_RATE_LIMIT:
+    `{prefix}` is the rate per second (0 disables throttling though pauses still apply),
+    `{prefix}_BURST` is the number of calls allowed at once and `{prefix}_CACHE` names the shared cache
+    """
+
+    def __init__(self, name, settings_prefix):
+        self.name = name
+        self.settings_prefix = settings_prefix
+        self.bucket = TokenBucket(name)
+        self.shared_limits = {}
+
+    def __repr__(self):
+        return f'<RateLimiter {self.name}>'
+
+    @property
+    def rate(self):
+        return getattr(settings, self.settings_prefix)
+
+    @property
+    def burst(self):
+        return getattr(settings, f'{self.settings_prefix}_BURST')
+
+    @property
+    def shared_limit(self):
+        cache_name = getattr(settings, f'{self.settings_prefix}_CACHE')
+        if not cache_name:
+            return None
+        if cache_name not in self.shared_limits:
+            self.shared_limits[cache_name] = SharedRateLimit(self.name, cache_name)
+        return self.shared_limits[cache_name]
+
+    def acquire(self, max_wait=None):
+        """
+        Waits until a call is allowed returning the time spent waiting
+
+        :raise RateLimitExceeded: if the wait would be longer than max_wait
+        """
+        waited = self.bucket.reserve(self.rate, self.burst, max_wait=max_wait)
+        if waited > 0:
+            time.sleep(waited)
+        shared_limit = self.shared_limit
+        if shared_limit:
+            try:
+                shared_wait = shared_limit.acquire(
+                    self.rate, max_wait=None if max_wait is None else max(max_wait - waited, 0)
+                )
+            except RateLimitExceeded:
+                self.bucket.rejections += 1
+                raise
+            if shared_wait > 0 and waited <= 0:
+                self.bucket.delays += 1
+            waited += shared_wait
+        return waited
+
+    def pause(self, seconds):
+        """
+        Stops calls for some seconds, e.g. because the dependency responded with Retry-After
+        """
+        logger.warning(f'{self.name} rate limited, pausing calls for {seconds:.1f}s')
+        self.bucket.pause(seconds)
+        shared_limit = self.shared_limit
+        if shared_limit:
+            shared_limit.pause(seconds)
+
+    def reset(self):
+        self.bucket.reset()
+
+
+def parse_retry_after(response, default=1, maximum=None):
+    """
+    Returns the number of seconds a response's Retry-After header asks clients to wait;
+    the header can be a number of seconds or an HTTP date.
+    Missing or unusable values (including infinity) give the default and waits are limited to the maximum
+    """
+    seconds = None
+    value = response.headers.get('Retry-After')
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                retry_at = None
+            if retry_at is not None:
+                seconds = retry_at.timestamp() - time.time()
+    if seconds is None or not math.isfinite(seconds):
+        seconds = default
+    seconds = max(seconds, 0)
+    if maximum is not None:
+        seconds = min(seconds, maximum)
+    return seconds
+
+
+rate_limiters_lock = threading.Lock()
+rate_limiters = {}
+
+
+def get_rate_limiter(name, settings_prefix):
+    with rate_limiters_lock:
+        if name not in rate_limiters:
+            rate_limiters[name] = RateLimiter(name, settings_prefix)
+        return rate_limiters[name]
+
+
+def reset_rate_limiters():
+    with rate_limiters_lock:
+        for rate_limiter in rate_limiters.values():
+            rate_limiter.reset()
+
+
+def govuk_pay_rate_limiter():
+    return get_rate_limiter('govuk_pay', 'GOVUK_PAY_RATE_LIMIT')
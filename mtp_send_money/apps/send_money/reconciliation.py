@@ -0,0 +1,293 @@
+import collections
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
+
+
+class ReconciliationReport:
+    """
+    Collects counts and timings for one run of the incomplete payment reconciliation
+    so that they can be logged and exported in prometheus text format; safe to update from several threads
+    """
+    outcomes = ('fetched', 'other_shard', 'skipped', 'settling', 'deferred', 'captured', 'cancelled', 'completed')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter({outcome: 0 for outcome in self.outcomes})
+        self.errors = collections.Counter()
+        self.phase_durations = collections.defaultdict(float)
+        self.govuk_calls = 0
+        self.started_at = time.time()
+        self.duration = None
+        self._start = time.monotonic()
+
+    def count(self, outcome, increment=1):
+        with self.lock:
+            self.counts[outcome] += increment
+
+    def error(self, exception):
+        with self.lock:
+            self.errors[type(exception).__name__] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                self.phase_durations[name] += duration
+
+    def finish(self):
+        self.duration = time.monotonic() - self._start
+
+    def summary(self):
+        lines = [
+            '%s: %d' % (outcome, count)
+            for outcome, count in self.counts.items()
+        ]
+        lines.extend(
+            'errors (%s): %d' % (error_type, count)
+            for error_type, count in sorted(self.errors.items())
+        )
+        lines.append('GOV.UK Pay calls: %d' % self.govuk_calls)
+        lines.extend(
+            'phase %s: %.3fs' % (phase, duration)
+            for phase, duration in self.phase_durations.items()
+        )
+        if self.duration is not None:
+            lines.append('duration: %.3fs' % self.duration)
+        return '\n'.join(lines)
+
+    def get_registry(self):
+        registry = CollectorRegistry()
+        payments = Gauge(
+            'mtp_reconciliation_payments', 'Payments processed by outcome in the last reconciliation run',
+            ['outcome'], registry=registry,
+        )
+        for outcome, count in self.counts.items():
+            payments.labels(outcome=outcome).set(count)
+        errors = Gauge(
+            'mtp_reconciliation_errors', 'Errors by exception type in the last reconciliation run',
+            ['type'], registry=registry,
+        )
+        for error_type, count in self.errors.items():
+            errors.labels(type=error_type).set(count)
+        Gauge(
+            'mtp_reconciliation_govuk_calls', 'GOV.UK Pay API calls made in the last reconciliation run',
+            registry=registry,
+        ).set(self.govuk_calls)
+        phase_durations = Gauge(
+            'mtp_reconciliation_phase_duration_seconds', 'Time spent in each phase of the last reconciliation run',
+            ['phase'], registry=registry,
+        )
+        for phase, duration in self.phase_durations.items():
+            phase_durations.labels(phase=phase).set(duration)
+        if self.duration is not None:
+            Gauge(
+                'mtp_reconciliation_duration_seconds', 'Duration of the last reconciliation run',
+                registry=registry,
+            ).set(self.duration)
+        Gauge(
+            'mtp_reconciliation_last_run_timestamp_seconds', 'When the last reconciliation run started',
+            registry=registry,
+        ).set(self.started_at)
+        return registry
+
+    def write_textfile(self, path):
+        """
+        Writes metrics in a format that the prometheus pushgateway or node exporter textfile collector accept
+        """
+        write_to_textfile(path, self.get_registry())
+
+
+def get_shard():
+    """
+    Returns the index of the current pod amongst running pods of this app and the number of running pods
+
+    :raise StackInterrogationException: if not running in Cloud Platform
+    """
+    # the kubernetes client is slow to import so is only loaded when the stack is queried
+    from mtp_common.stack import StackInterrogationException, get_pod_list
+
+    current_pod_name = os.environ.get('POD_NAME')
+    if not current_pod_name:
+        raise StackInterrogationException('Pod name not known')
+    pod_list = get_pod_list(app=settings.APP)
+    pod_names = sorted(
+        pod.metadata.name
+        for pod in filter(lambda pod: pod.status.phase == 'Running', pod_list.items)
+    )
+    if current_pod_name not in pod_names:
+        raise StackInterrogationException('Pod is not running')
+    return pod_names.index(current_pod_name), len(pod_names)
+
+
+def is_in_shard(payment, shard_index, shard_count):
+    """
+    Deterministically assigns a payment to one of shard_count slices using its uuid
+    """
+    digest = hashlib.sha1(payment['uuid'].encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count == shard_index
+
+
+latest_datetime = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+
+
+def get_priority(payment):
+    """
+    Returns a sort key that puts payments which can be captured or cancelled now first,
+    because GOV.UK Pay expires capturable payments, then those without a security check
+    and lastly those still awaiting a security check decision; oldest first within each group
+    """
+    security_check = payment.get('security_check') or {}
+    security_check_status = security_check.get('status')
+    if security_check_status in ('accepted', 'rejected'):
+        urgency = 0
+    elif not security_check_status:
+        urgency = 1
+    else:
+        urgency = 2
+    try:
+        created = parse_datetime(payment.get('created') or '')
+    except ValueError:
+        created = None
+    # payments with unknown creation dates go last within their group
+    return urgency, created or latest_datetime
+
+
+def defer_completion(payment, govuk_payment):
+    """
+    Records that a captured payment cannot be completed until GOV.UK Pay provides its capture date
+    so that it is not checked again before it is expected to settle;
+    returns the time before which it will not be checked or None if the capture time is not known
+    so the payment is checked again in the next run.
+    NB: the cache is local to each pod so this is only a hint to save GOV.UK Pay lookups;
+    a pod without it (or after it was culled) simply checks the payment
+    """
+    now = timezone.now()
+    settlement_delay = datetime.timedelta(seconds=settings.RECONCILIATION_SETTLEMENT_DELAY)
+    settlement_summary = (govuk_payment or {}).get('settlement_summary') or {}
+    capture_submit_time = parse_datetime(settlement_summary.get('capture_submit_time') or '')
+    if not capture_submit_time:
+        return None
+    check_after = capture_submit_time + settlement_delay
+    if check_after <= now:
+        # overdue so check again after another full delay
+        check_after = now + settlement_delay
+    caches[settings.RECONCILIATION_CACHE].set(
+        f'settling-{payment["uuid"]}', check_after.isoformat(),
+        timeout=(check_after - now).total_seconds(),
+    )
+    return check_after
+
+
+def is_completion_deferred(payment):
+    """
+    Returns True if the payment was captured but is not expected to have settled yet
+    """
+    return caches[settings.RECONCILIATION_CACHE].get(f'settling-{payment["uuid"]}') is not None
+
+
+class CacheLease:
+    """
+    Lease held in a cache shared by all instances (e.g. memcached or redis) which expires by itself
+    if the holder dies; relies on the cache's `add` being atomic.
+    Django's cache has no compare-and-delete so a lease is only released early while it certainly
+    has not expired and been taken by another instance, otherwise it is left to expire
+    """
+    local_cache_backends = (DummyCache, FileBasedCache, LocMemCache)
+    release_margin = 60  # seconds
+
+    def __init__(self, name, timeout):
+        cache_name = settings.RECONCILIATION_LEASE_CACHE
+        if not cache_name:
+            raise ImproperlyConfigured('RECONCILIATION_LEASE_CACHE must name a cache shared by all instances')
+        self.cache = caches[cache_name]
+        if isinstance(self.cache, self.local_cache_backends):
+            raise ImproperlyConfigured(
+                f'RECONCILIATION_LEASE_CACHE "{cache_name}" is not shared between instances; '
+                'use memcached or redis'
+            )
+        self.key = f'lease-{name}'
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        self.acquired_at = None
+
+    def acquire(self):
+        acquired = self.cache.add(self.key, self.token, self.timeout)
+        if acquired:
+            self.acquired_at = time.monotonic()
+        return acquired
+
+    def release(self):
+        if self.acquired_at is None:
+            return
+        held_for = time.monotonic() - self.acquired_at
+        self.acquired_at = None
+        if held_for < self.timeout - self.release_margin and self.cache.get(self.key) == self.token:
+            self.cache.delete(self.key)
+
+
+class FileLease:
+    """
+    Stand-in for a shared lease using a lock file so that processes on one host exclude each other;
+    the operating system releases it if the holder dies.
+    NB: it does not exclude instances in other pods or hosts
+    """
+
+    def __init__(self, name, timeout):
+        self.path = os.path.join(settings.RECONCILIATION_LEASE_PATH, f'mtp-lease-{name}.lock')
+        self.file = None
+
+    def acquire(self):
+        self.file = open(self.path, 'w')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+lease_backends = {
+    'cache': CacheLease,
+    'file': FileLease,
+}
+
+
+@contextlib.contextmanager
+def lease(name):
+    """
+    Tries to take the named lease for the duration of the block yielding whether it was acquired
+    """
+    held_lease = lease_backends[settings.RECONCILIATION_LEASE_BACKEND](name, settings.RECONCILIATION_LEASE_TIMEOUT)
+    acquired = held_lease.acquire()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            held_lease.release()
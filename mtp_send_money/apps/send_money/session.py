@@ -0,0 +1,123 @@
+import datetime
+import json
+import re
+import struct
+
+from django.core.signing import JSONSerializer
+
+VERSION = 1
+JSON_REMAINDER = 0
+
+length_struct = struct.Struct('>H')
+uint_struct = struct.Struct('>I')
+amount_re = re.compile(r'^(0|[1-9]\d{0,6})\.\d\d$')
+date_re = re.compile(r'^\d{4}-\d\d-\d\d$')
+
+
+def pack_text(value):
+    if not isinstance(value, str):
+        return None
+    encoded = value.encode()
+    if len(encoded) > 0xffff:
+        return None
+    return length_struct.pack(len(encoded)) + encoded
+
+
+def unpack_text(data, offset):
+    length, = length_struct.unpack_from(data, offset)
+    offset += length_struct.size
+    return data[offset:offset + length].decode(), offset + length
+
+
+def pack_date(value):
+    # dates are saved in the session as yyyy-mm-dd text
+    if not isinstance(value, str) or not date_re.match(value):
+        return None
+    try:
+        date = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+    if date.isoformat() != value:
+        return None
+    return uint_struct.pack(date.toordinal())
+
+
+def unpack_date(data, offset):
+    ordinal, = uint_struct.unpack_from(data, offset)
+    return datetime.date.fromordinal(ordinal).isoformat(), offset + uint_struct.size
+
+
+def pack_amount(value):
+    # amounts are saved in the session as text with 2 decimal places
+    if not isinstance(value, str) or not amount_re.match(value):
+        return None
+    pounds, pence = value.split('.')
+    return uint_struct.pack(int(pounds) * 100 + int(pence))
+
+
+def unpack_amount(data, offset):
+    amount, = uint_struct.unpack_from(data, offset)
+    return '%d.%02d' % divmod(amount, 100), offset + uint_struct.size
+
+
+text = (pack_text, unpack_text)
+date = (pack_date, unpack_date)
+amount = (pack_amount, unpack_amount)
+
+# (session key, code, packer) for values saved by the payment journey forms; codes must never be reused
+packed_fields = (
+    ('prisoner_name', 1, text),
+    ('prisoner_number', 2, text),
+    ('prisoner_dob', 3, date),
+    ('amount', 4, amount),
+    ('payment_method', 5, text),
+    ('processor_id', 6, text),
+)
+packed_fields_by_code = {
+    code: (key, unpack)
+    for key, code, (_, unpack) in packed_fields
+}
+
+
+class CompactSessionSerializer:
+    """
+    Serializer for the signed-cookie session backend that packs the values saved by the payment journey forms
+    into a short binary form with a leading version byte; any other values are appended as JSON.
+    Cookies written in the JSON format used previously can still be read.
+    """
+
+    def dumps(self, obj):
+        chunks = [bytes([VERSION])]
+        remainder = dict(obj)
+        for key, code, (pack, _) in packed_fields:
+            if key not in remainder:
+                continue
+            packed_value = pack(remainder[key])
+            if packed_value is None:
+                # cannot be packed so is kept as JSON
+                continue
+            del remainder[key]
+            chunks.append(bytes([code]))
+            chunks.append(packed_value)
+        if remainder:
+            chunks.append(bytes([JSON_REMAINDER]))
+            chunks.append(json.dumps(remainder, separators=(',', ':')).encode('latin-1'))
+        return b''.join(chunks)
+
+    def loads(self, data):
+        if data[:1] == b'{':
+            return JSONSerializer().loads(data)
+        if data[:1] != bytes([VERSION]):
+            raise ValueError('Unknown session format')
+
+        obj = {}
+        offset = 1
+        while offset < len(data):
+            code = data[offset]
+            offset += 1
+            if code == JSON_REMAINDER:
+                obj.update(json.loads(data[offset:].decode('latin-1')))
+                break
+            key, unpack = packed_fields_by_code[code]
+            obj[key], offset = unpack(data, offset)
+        return obj
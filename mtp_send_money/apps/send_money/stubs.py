@@ -0,0 +1,478 @@
+"""
+In-memory stand-ins for the MTP API and GOV.UK Pay used to run load tests and benchmarks offline
+"""
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+from django.utils.crypto import get_random_string
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger('mtp')
+
+
+class StubBehaviour:
+    """
+    How stub servers degrade responses: latency in seconds with random jitter,
+    the proportion of requests that fail with a server error
+    and the number of requests per second allowed by rate-limited servers
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, rate_limit=0, seed=None):
+        if not 0 <= error_rate <= 1:
+            raise ValueError('Error rate must be between 0 and 1')
+        if rate_limit < 0:
+            raise ValueError('Rate limit cannot be negative')
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = None
+        self.rate_limit_count = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def get_delay(self):
+        with self.lock:
+            return max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def get_retry_after(self):
+        """
+        Returns the seconds until the next request is allowed if the rate limit has been reached
+        """
+        if not self.rate_limit:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            window = int(now)
+            if window != self.rate_limit_window:
+                self.rate_limit_window = window
+                self.rate_limit_count = 0
+            self.rate_limit_count += 1
+            if self.rate_limit_count <= self.rate_limit:
+                return None
+            return window + 1 - now
+
+
+class StubDataset:
+    """
+    Prisons, prisoners and payments shared by the stub servers
+    """
+
+    def __init__(self, prisoners=1000, prisons=100, payments=0, seed=None):
+        if prisoners < 1 or prisons < 1:
+            raise ValueError('At least one prison and prisoner are needed')
+        generator = random.Random(seed)
+        self.lock = threading.Lock()
+        self.prisons = [
+            {
+                'nomis_id': f'S{index:02d}',
+                'short_name': f'Stub {index + 1}',
+                'name': f'HMP Stub {index + 1}',
+            }
+            for index in range(prisons)
+        ]
+        self.prisoners = {}
+        for index in range(prisoners):
+            prisoner = self.get_prisoner(index)
+            self.prisoners[prisoner['prisoner_number']] = dict(
+                prisoner,
+                prison=self.prisons[index % prisons]['nomis_id'],
+                combined_account_balance=generator.randrange(0, 100000),
+            )
+        self.payments = {}
+        self.govuk_payments = {}
+        for index in range(payments):
+            self.add_completed_payment(self.get_prisoner(index % prisoners), generator.randrange(100, 20000))
+
+    @classmethod
+    def get_prisoner(cls, index):
+        """
+        Returns the number and date of birth of a generated prisoner to use in load tests
+        """
+        letters = chr(65 + index // 10000 % 26) + chr(65 + index // 260000 % 26)
+        return {
+            'prisoner_number': f'A{index % 10000:04d}{letters}',
+            'prisoner_dob': (datetime.date(1970, 1, 1) + datetime.timedelta(days=index % 15000)).isoformat(),
+        }
+
+    def add_completed_payment(self, prisoner, amount):
+        """
+        Adds a payment that was taken by GOV.UK Pay but not yet updated in MTP
+        """
+        payment = self.create_payment({
+            'amount': amount,
+            'service_charge': 0,
+            'recipient_name': 'Stub Prisoner',
+            'prisoner_number': prisoner['prisoner_number'],
+            'prisoner_dob': prisoner['prisoner_dob'],
+        })
+        govuk_payment = self.create_govuk_payment({
+            'amount': amount,
+            'reference': payment['uuid'],
+            'delayed_capture': False,
+            'return_url': '',
+        }, '')
+        self.complete_govuk_payment(govuk_payment['payment_id'])
+        self.update_payment(payment['uuid'], {'processor_id': govuk_payment['payment_id']})
+        # old enough to be picked up by update_incomplete_payments
+        an_hour_ago = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)).isoformat()
+        with self.lock:
+            payment.update(created=an_hour_ago, modified=an_hour_ago)
+
+    def create_payment(self, data):
+        now = now_isoformat()
+        payment = dict(
+            data,
+            uuid=str(uuid.uuid4()),
+            status='pending',
+            processor_id=None,
+            created=now,
+            modified=now,
+            security_check={'status': 'accepted', 'user_actioned': False},
+        )
+        with self.lock:
+            self.payments[payment['uuid']] = payment
+        return payment
+
+    def update_payment(self, payment_ref, data):
+        with self.lock:
+            payment = self.payments.get(payment_ref)
+            if payment is not None:
+                payment.update(data, modified=now_isoformat())
+            return payment
+
+    def create_govuk_payment(self, data, base_url):
+        payment_id = get_random_string(length=26).lower()
+        govuk_payment = dict(
+            data,
+            payment_id=payment_id,
+            state={'status': 'created', 'finished': False},
+            created_date=now_isoformat(),
+            _links={'next_url': {'method': 'GET', 'href': f'{base_url}/pay/{payment_id}'}},
+            events=[],
+        )
+        with self.lock:
+            self.govuk_payments[payment_id] = govuk_payment
+            self.change_govuk_payment_state(govuk_payment, govuk_payment['state'])
+        return govuk_payment
+
+    def change_govuk_payment_state(self, govuk_payment, state):
+        govuk_payment['state'] = state
+        govuk_payment['events'].append({'state': state, 'updated': now_isoformat()})
+
+    def complete_govuk_payment(self, payment_id):
+        """
+        Acts as the user entering card details on GOV.UK Pay
+        """
+        with self.lock:
+            govuk_payment = self.govuk_payments.get(payment_id)
+            if govuk_payment is None or govuk_payment['state']['status'] != 'created':
+                return govuk_payment
+            govuk_payment.update(
+                email='sender@outside.local',
+                provider_id=str(uuid.uuid4()),
+                card_details={
+                    'cardholder_name': 'Stub Sender',
+                    'first_digits_card_number': '424242',
+                    'last_digits_card_number': '4242',
+                    'expiry_date': '10/30',
+                    'card_brand': 'Visa',
+                    'billing_address': {
+                        'line1': '1 Stub Street', 'city': 'London', 'postcode': 'SW1A 1AA', 'country': 'GB',
+                    },
+                },
+            )
+            if govuk_payment['delayed_capture']:
+                self.change_govuk_payment_state(govuk_payment, {'status': 'capturable', 'finished': False})
+            else:
+                self.capture_govuk_payment(govuk_payment)
+            return govuk_payment
+
+    def capture_govuk_payment(self, govuk_payment):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        govuk_payment['settlement_summary'] = {
+            'capture_submit_time': now.isoformat(),
+            'captured_date': now.date().isoformat(),
+        }
+        self.change_govuk_payment_state(govuk_payment, {'status': 'success', 'finished': True})
+
+    def finish_govuk_payment(self, payment_id, action):
+        """
+        Captures or cancels a capturable payment returning False if it cannot be
+        """
+        with self.lock:
+            govuk_payment = self.govuk_payments.get(payment_id)
+            if govuk_payment is None or govuk_payment['state']['status'] != 'capturable':
+                return False
+            if action == 'capture':
+                self.capture_govuk_payment(govuk_payment)
+            else:
+                self.change_govuk_payment_state(govuk_payment, {
+                    'status': 'cancelled', 'finished': True,
+                    'code': 'P0040', 'message': 'Payment was cancelled by the service',
+                })
+            return True
+
+
+def now_isoformat():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, dataset, behaviour):
+        super().__init__(server_address, handler_class)
+        self.dataset = dataset
+        self.behaviour = behaviour
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}{self.RequestHandlerClass.url_prefix}'
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """
+    Dispatches requests to methods by http method and path pattern; methods return a status and response data
+    """
+    url_prefix = ''
+    routes = ()
+    rate_limited = False
+
+    def do_GET(self):  # noqa: N802
+        self.dispatch()
+
+    def do_POST(self):  # noqa: N802
+        self.dispatch()
+
+    def do_PATCH(self):  # noqa: N802
+        self.dispatch()
+
+    def log_message(self, format, *args):
+        logger.debug('Stub %s: %s' % (self.__class__.__name__, format % args))
+
+    @property
+    def dataset(self):
+        return self.server.dataset
+
+    @property
+    def base_url(self):
+        return f'http://{self.headers["Host"]}{self.url_prefix}'
+
+    def dispatch(self):
+        behaviour = self.server.behaviour
+        time.sleep(behaviour.get_delay())
+        retry_after = behaviour.get_retry_after() if self.rate_limited else None
+        if retry_after is not None:
+            return self.send_json(429, {'code': 'P0900', 'description': 'Too many requests'}, {
+                'Retry-After': str(math.ceil(retry_after)),
+            })
+        if behaviour.should_fail():
+            return self.send_json(503, {'detail': 'Stubbed failure'})
+
+        url = urlsplit(self.path)
+        for method, path_re, handler_name in self.routes:
+            match = re.match(self.url_prefix + path_re, url.path)
+            if match and method == self.command:
+                self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                self.data = self.read_json()
+                return self.send_json(*getattr(self, handler_name)(**match.groupdict()))
+        self.send_json(404, {'detail': 'Not found.'})
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def send_json(self, status, data=None, headers=None):
+        body = b'' if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        for header in (headers or {}).items():
+            self.send_header(*header)
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def paginate(self, results):
+        offset = int(self.query.get('offset', 0))
+        limit = int(self.query.get('limit', 20))
+        return 200, {'count': len(results), 'results': results[offset:offset + limit]}
+
+
+class MTPAPIStubHandler(StubRequestHandler):
+    payment_statuses = ('pending', 'failed', 'taken', 'rejected', 'expired')
+
+    routes = (
+        ('POST', r'/oauth2/token/$', 'get_token'),
+        ('GET', r'/service-availability/$', 'get_service_availability'),
+        ('GET', r'/prisons/$', 'list_prisons'),
+        ('GET', r'/prisoner_validity/$', 'check_prisoner_validity'),
+        ('GET', r'/prisoner_account_balances/(?P<prisoner_number>[^/]+)/?$', 'get_prisoner_account_balance'),
+        ('GET', r'/payments/$', 'list_payments'),
+        ('POST', r'/payments/$', 'create_payment'),
+        ('PATCH', r'/payments/$', 'update_payments'),
+        ('GET', r'/payments/(?P<payment_ref>[^/]+)/$', 'get_payment'),
+        ('PATCH', r'/payments/(?P<payment_ref>[^/]+)/$', 'update_payment'),
+    )
+
+    def get_token(self):
+        return 200, {
+            'access_token': get_random_string(length=30),
+            'refresh_token': get_random_string(length=30),
+            'token_type': 'Bearer',
+            'expires_in': 36000,
+            'scope': 'read write',
+        }
+
+    def get_service_availability(self):
+        return 200, {'gov_uk_pay': {'status': True}}
+
+    def list_prisons(self):
+        return self.paginate(self.dataset.prisons)
+
+    def check_prisoner_validity(self):
+        prisoner = self.dataset.prisoners.get(self.query.get('prisoner_number'))
+        prisons = self.query.get('prisons')
+        if not prisoner or prisoner['prisoner_dob'] != self.query.get('prisoner_dob') or \
+                prisons and prisoner['prison'] not in prisons.split(','):
+            return 200, {'count': 0, 'results': []}
+        return 200, {'count': 1, 'results': [{
+            'prisoner_number': prisoner['prisoner_number'],
+            'prisoner_dob': prisoner['prisoner_dob'],
+        }]}
+
+    def get_prisoner_account_balance(self, prisoner_number):
+        prisoner = self.dataset.prisoners.get(prisoner_number)
+        if not prisoner:
+            return 404, {'detail': 'Not found.'}
+        return 200, {'combined_account_balance': prisoner['combined_account_balance']}
+
+    def list_payments(self):
+        modified_before = parse_datetime(self.query.get('modified__lt') or '')
+        with self.dataset.lock:
+            payments = [
+                dict(payment)
+                for payment in self.dataset.payments.values()
+                if payment['status'] == 'pending' and (
+                    not modified_before or parse_datetime(payment['modified']) < modified_before
+                )
+            ]
+        return self.paginate(payments)
+
+    def create_payment(self):
+        return 201, self.dataset.create_payment(self.data)
+
+    def get_payment(self, payment_ref):
+        with self.dataset.lock:
+            payment = self.dataset.payments.get(payment_ref)
+            if payment is None:
+                return 404, {'detail': 'Not found.'}
+            return 200, dict(payment)
+
+    def update_payment(self, payment_ref):
+        if self.data.get('status', 'pending') not in self.payment_statuses:
+            return 400, {'status': [f'"{self.data["status"]}" is not a valid choice.']}
+        if self.dataset.update_payment(payment_ref, self.data) is None:
+            return 404, {'detail': 'Not found.'}
+        return self.get_payment(payment_ref)
+
+    def update_payments(self):
+        """
+        Bulk update with a result for each payment holding either the updated payment or errors
+        """
+        if not isinstance(self.data, list):
+            return 400, {'non_field_errors': ['Expected a list of payment updates.']}
+        results = []
+        for payment_update in self.data:
+            payment_update = dict(payment_update)
+            payment_ref = payment_update.pop('uuid', None)
+            if payment_update.get('status', 'pending') not in self.payment_statuses:
+                results.append({'uuid': payment_ref, 'errors': {
+                    'status': [f'"{payment_update["status"]}" is not a valid choice.'],
+                }})
+                continue
+            payment = self.dataset.update_payment(payment_ref, payment_update)
+            if payment is None:
+                results.append({'uuid': payment_ref, 'errors': {'uuid': ['Not found.']}})
+                continue
+            with self.dataset.lock:
+                results.append({'uuid': payment_ref, 'payment': dict(payment)})
+        return 200, {'results': results}
+
+
+class GovUkPayStubHandler(StubRequestHandler):
+    url_prefix = '/v1'
+    rate_limited = True
+    routes = (
+        ('POST', r'/payments/?$', 'create_payment'),
+        ('GET', r'/payments/(?P<payment_id>[^/]+)/?$', 'get_payment'),
+        ('GET', r'/payments/(?P<payment_id>[^/]+)/events/?$', 'get_payment_events'),
+        ('POST', r'/payments/(?P<payment_id>[^/]+)/(?P<action>capture|cancel)/?$', 'finish_payment'),
+        ('GET', r'/pay/(?P<payment_id>[^/]+)$', 'pay'),
+    )
+
+    def get_govuk_payment(self, payment_id):
+        with self.dataset.lock:
+            govuk_payment = self.dataset.govuk_payments.get(payment_id)
+            if govuk_payment is None:
+                return None
+            return {key: value for key, value in govuk_payment.items() if key != 'events'}
+
+    def create_payment(self):
+        govuk_payment = self.dataset.create_govuk_payment(self.data, self.base_url)
+        return 201, self.get_govuk_payment(govuk_payment['payment_id'])
+
+    def get_payment(self, payment_id):
+        govuk_payment = self.get_govuk_payment(payment_id)
+        if govuk_payment is None:
+            return 404, {'code': 'P0200', 'description': 'Not found'}
+        return 200, govuk_payment
+
+    def get_payment_events(self, payment_id):
+        with self.dataset.lock:
+            govuk_payment = self.dataset.govuk_payments.get(payment_id)
+            if govuk_payment is None:
+                return 404, {'code': 'P0300', 'description': 'Not found'}
+            return 200, {'payment_id': payment_id, 'events': list(govuk_payment['events'])}
+
+    def finish_payment(self, payment_id, action):
+        if payment_id not in self.dataset.govuk_payments:
+            return 404, {'code': 'P1000', 'description': 'Not found'}
+        if not self.dataset.finish_govuk_payment(payment_id, action):
+            return 400, {'code': 'P1003', 'description': 'Payment is not capturable'}
+        return 204, None
+
+    def pay(self, payment_id):
+        govuk_payment = self.dataset.complete_govuk_payment(payment_id)
+        if govuk_payment is None:
+            return 404, {'code': 'P0200', 'description': 'Not found'}
+        return 303, None, {'Location': govuk_payment['return_url']}
+
+
+def start_stub_server(handler_class, dataset, behaviour, host='localhost', port=0):
+    """
+    Serves requests on a background thread returning the server which should be shut down after use
+    """
+    server = StubServer((host, port), handler_class, dataset, behaviour)
+    threading.Thread(target=server.serve_forever, name=f'stub-{handler_class.__name__}', daemon=True).start()
+    return server
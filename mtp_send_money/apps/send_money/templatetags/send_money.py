@@ -1,6 +1,10 @@
 import datetime
+import functools
 
 from django import template
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 
 from send_money.utils import (
     format_percentage, currency_format, currency_format_pence, get_total_charge
@@ -46,10 +50,21 @@ def prisoner_details_not_found(error_list):
     return any(error.code == 'not_found' for error in error_list.as_data())
 
 
-@register.inclusion_tag('send_money/includes/card-acceptance-signage.html')
-def card_acceptance_signage(width):
+@functools.lru_cache(maxsize=None)
+def render_card_acceptance_signage(width, static_url):
     height = int(round(146 * width / 160))
-    return {
+    return mark_safe(render_to_string('send_money/includes/card-acceptance-signage.html', {
         'width': width,
         'height': height,
-    }
+    }))
+
+
+@register.simple_tag
+def card_acceptance_signage(width):
+    """
+    Renders card logos; the output only depends on width and static file urls so it's rendered once per process
+    unless templates are being edited
+    """
+    if settings.DEBUG:
+        return render_card_acceptance_signage.__wrapped__(width, settings.STATIC_URL)
+    return render_card_acceptance_signage(width, settings.STATIC_URL)
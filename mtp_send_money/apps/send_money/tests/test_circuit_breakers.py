@@ -0,0 +1,165 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from mtp_common.test_utils import silence_logger
+import requests
+from requests.exceptions import ConnectionError, HTTPError
+import responses
+
+from send_money.circuit_breakers import (
+    CircuitBreaker, CircuitOpenError, CircuitState,
+    govuk_pay_circuit_breaker, reset_circuit_breakers,
+)
+from send_money.deadlines import DeadlineExceeded
+from send_money.payments import PaymentClient
+from send_money.utils import govuk_url
+
+
+def failing_call():
+    raise ConnectionError('Connection refused')
+
+
+def successful_call():
+    return 'ok'
+
+
+@override_settings(
+    CIRCUIT_BREAKER_FAILURE_RATE=0.5,
+    CIRCUIT_BREAKER_MINIMUM_CALLS=4,
+    CIRCUIT_BREAKER_WINDOW=60,
+    CIRCUIT_BREAKER_RESET_TIMEOUT=30,
+)
+class CircuitBreakerTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000
+        patched_time = mock.patch('send_money.circuit_breakers.time.monotonic', side_effect=lambda: self.now)
+        patched_time.start()
+        self.addCleanup(patched_time.stop)
+
+    def make_calls(self, circuit_breaker, func, count):
+        for _ in range(count):
+            try:
+                circuit_breaker.call(func)
+            except ConnectionError:
+                pass
+
+    def test_stays_closed_below_minimum_calls(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, failing_call, 3)
+        self.assertEqual(circuit_breaker.state, CircuitState.closed)
+        self.assertEqual(circuit_breaker.call(successful_call), 'ok')
+
+    def test_stays_closed_below_failure_rate(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, successful_call, 3)
+            self.make_calls(circuit_breaker, failing_call, 2)
+        self.assertEqual(circuit_breaker.state, CircuitState.closed)
+
+    def test_opens_and_fails_fast(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, failing_call, 4)
+        self.assertEqual(circuit_breaker.state, CircuitState.open)
+
+        func = mock.Mock()
+        with self.assertRaises(CircuitOpenError):
+            circuit_breaker.call(func)
+        func.assert_not_called()
+        self.assertEqual(circuit_breaker.rejections, 1)
+
+    def test_old_failures_leave_window(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, failing_call, 3)
+            self.now += 61
+            self.make_calls(circuit_breaker, failing_call, 1)
+        self.assertEqual(circuit_breaker.state, CircuitState.closed)
+
+    def test_half_open_probe_closes_circuit(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, failing_call, 4)
+            self.now += 30
+            self.assertEqual(circuit_breaker.call(successful_call), 'ok')
+        self.assertEqual(circuit_breaker.state, CircuitState.closed)
+
+    def test_half_open_allows_one_probe(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, failing_call, 4)
+        self.now += 30
+
+        def probe():
+            with self.assertRaises(CircuitOpenError):
+                circuit_breaker.call(successful_call)
+            return 'ok'
+
+        with silence_logger():
+            self.assertEqual(circuit_breaker.call(probe), 'ok')
+        self.assertEqual(circuit_breaker.state, CircuitState.closed)
+
+    def test_failed_probe_reopens_circuit(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, failing_call, 4)
+            self.now += 30
+            self.make_calls(circuit_breaker, failing_call, 1)
+        self.assertEqual(circuit_breaker.state, CircuitState.open)
+        with self.assertRaises(CircuitOpenError):
+            circuit_breaker.call(successful_call)
+
+    def test_interrupted_probe_leaves_circuit_half_open(self):
+        circuit_breaker = CircuitBreaker('test')
+        with silence_logger():
+            self.make_calls(circuit_breaker, failing_call, 4)
+        self.now += 30
+
+        for exception in (KeyboardInterrupt, DeadlineExceeded):
+            with self.assertRaises(exception):
+                circuit_breaker.call(mock.Mock(side_effect=exception))
+            self.assertEqual(circuit_breaker.state, CircuitState.half_open)
+
+        with silence_logger():
+            self.assertEqual(circuit_breaker.call(successful_call), 'ok')
+        self.assertEqual(circuit_breaker.state, CircuitState.closed)
+
+    def test_failures(self):
+        response_404 = requests.Response()
+        response_404.status_code = 404
+        response_503 = requests.Response()
+        response_503.status_code = 503
+        self.assertTrue(CircuitBreaker.is_failure(ConnectionError()))
+        self.assertTrue(CircuitBreaker.is_failure(HTTPError(response=response_503)))
+        self.assertFalse(CircuitBreaker.is_failure(HTTPError(response=response_404)))
+        self.assertFalse(CircuitBreaker.is_failure(ValueError()))
+        self.assertTrue(CircuitBreaker.is_failed_response(response_503))
+        self.assertFalse(CircuitBreaker.is_failed_response(response_404))
+
+
+@override_settings(
+    GOVUK_PAY_URL='https://pay.gov.local/v1',
+    CIRCUIT_BREAKER_FAILURE_RATE=0.5,
+    CIRCUIT_BREAKER_MINIMUM_CALLS=2,
+)
+class PaymentClientCircuitBreakerTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        reset_circuit_breakers()
+        self.addCleanup(reset_circuit_breakers)
+
+    def test_govuk_pay_calls_fail_fast_when_unavailable(self):
+        client = PaymentClient()
+        with responses.RequestsMock() as rsps, silence_logger():
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), status=500)
+            rsps.add(rsps.GET, govuk_url('/payments/2/'), status=502)
+            for govuk_id in (1, 2):
+                with self.assertRaises(requests.RequestException):
+                    client.get_govuk_payment(govuk_id)
+            self.assertEqual(govuk_pay_circuit_breaker().state, CircuitState.open)
+
+            with self.assertRaises(CircuitOpenError):
+                client.get_govuk_payment(3)
+            self.assertEqual(len(rsps.calls), 2)
@@ -1,17 +1,38 @@
 from datetime import datetime, timedelta
+import ast
+import io
 import json
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import tracemalloc
 from unittest import mock
 
+from django.conf import settings
 from django.core import mail
-from django.core.management import call_command
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
 from django.test import override_settings
 from django.test.testcases import SimpleTestCase
 from django.utils.timezone import utc
+from mtp_common.test_utils import silence_logger
 import responses
 
+from send_money.reconciliation import (
+    CacheLease, FileLease,
+    defer_completion, get_priority, is_completion_deferred, is_in_shard,
+)
 from send_money.tests import mock_auth
 from send_money.utils import api_url, govuk_url
-from send_money.management.commands.update_incomplete_payments import ALWAYS_CHECK_IF_OLDER_THAN
+from send_money.management.commands.profile_imports import ImportTime, parse_import_times
+from send_money.management.commands.update_incomplete_payments import (
+    ALWAYS_CHECK_IF_OLDER_THAN,
+    Command as UpdateIncompletePaymentsCommand,
+)
 
 
 PAYMENT_DATA = {
@@ -32,8 +53,16 @@ PAYMENT_DATA = {
 }
 
 
-@override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1')
-class UpdateIncompletePaymentsTestCase(SimpleTestCase):
+@override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1', RECONCILIATION_CACHE='default')
+class BaseUpdateIncompletePaymentsTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        cache = caches[settings.RECONCILIATION_CACHE]
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+
+class UpdateIncompletePaymentsTestCase(BaseUpdateIncompletePaymentsTestCase):
     def setUp(self):
         super().setUp()
         self.mocked_is_first_instance = mock.patch(
@@ -204,16 +233,6 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
                 },
                 status=200,
             )
-            # save email
-            rsps.add(
-                rsps.PATCH,
-                api_url('/payments/%s/' % 'wargle-1111'),
-                json={
-                    **payments[0],
-                    'email': 'success_sender@outside.local',
-                },
-                status=200,
-            )
             # update status
             rsps.add(
                 rsps.PATCH,
@@ -344,16 +363,6 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
                 },
                 status=200,
             )
-            # save email
-            rsps.add(
-                rsps.PATCH,
-                api_url('/payments/%s/' % 'wargle-6666'),
-                json={
-                    **payments[5],
-                    'email': 'success_after_delay@outside.local',
-                },
-                status=200,
-            )
             # update status
             rsps.add(
                 rsps.PATCH,
@@ -411,13 +420,10 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
             call_command('update_incomplete_payments', verbosity=0)
 
             # check wargle-1111
-            self.assertEqual(
-                json.loads(rsps.calls[3].request.body.decode()),
-                {'email': 'success_sender@outside.local'},
-            )
             self.assertDictEqual(
-                json.loads(rsps.calls[4].request.body.decode()),
+                json.loads(rsps.calls[3].request.body.decode()),
                 {
+                    'email': 'success_sender@outside.local',
                     'status': 'taken',
                     'received_at': '2016-10-27T15:11:05+00:00',
                 },
@@ -431,7 +437,7 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
 
             # check wargle-3333
             self.assertEqual(
-                json.loads(rsps.calls[7].request.body.decode()),
+                json.loads(rsps.calls[6].request.body.decode()),
                 {
                     'email': 'failed_sender@outside.local',
                     'status': 'failed',
@@ -440,7 +446,7 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
 
             # check wargle-4444
             self.assertEqual(
-                json.loads(rsps.calls[9].request.body.decode()),
+                json.loads(rsps.calls[8].request.body.decode()),
                 {
                     'email': 'cancelled_sender@outside.local',
                     'status': 'rejected',
@@ -455,7 +461,7 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
 
             # check wargle-5555
             self.assertEqual(
-                json.loads(rsps.calls[12].request.body.decode()),
+                json.loads(rsps.calls[11].request.body.decode()),
                 {
                     'email': 'timedout_sender@outside.local',
                     'status': 'expired',
@@ -469,13 +475,10 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
             self.assertTrue('£7' in mail.outbox[2].body)
 
             # check wargle-6666
-            self.assertEqual(
-                json.loads(rsps.calls[14].request.body.decode()),
-                {'email': 'success_after_delay_sender@outside.local'},
-            )
             self.assertDictEqual(
-                json.loads(rsps.calls[15].request.body.decode()),
+                json.loads(rsps.calls[13].request.body.decode()),
                 {
+                    'email': 'success_after_delay_sender@outside.local',
                     'status': 'taken',
                     'received_at': '2016-10-27T15:11:05+00:00',
                 },
@@ -489,7 +492,7 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
 
             # check wargle-7777
             self.assertEqual(
-                json.loads(rsps.calls[18].request.body.decode()),
+                json.loads(rsps.calls[16].request.body.decode()),
                 {
                     'email': 'timedout_sender@outside.local',
                     'status': 'expired',
@@ -647,16 +650,6 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
                 },
                 status=200,
             )
-            # save email
-            rsps.add(
-                rsps.PATCH,
-                api_url('/payments/%s/' % 'wargle-dddd'),
-                json={
-                    **payments[3],
-                    'email': 'success_sender@outside.local',
-                },
-                status=200,
-            )
             # update status
             rsps.add(
                 rsps.PATCH,
@@ -694,14 +687,12 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
 
             # wargle-aaaa, wargle-bbbb and wargle-cccc already checked implicitly by RequestsMock
 
+            # payments with a decided security check are processed first
             # check wargle-dddd
-            self.assertEqual(
-                json.loads(rsps.calls[5].request.body.decode()),
-                {'email': 'success_sender@outside.local'},
-            )
             self.assertDictEqual(
-                json.loads(rsps.calls[6].request.body.decode()),
+                json.loads(rsps.calls[3].request.body.decode()),
                 {
+                    'email': 'success_sender@outside.local',
                     'status': 'taken',
                     'received_at': '2016-10-27T15:11:05+00:00',
                 },
@@ -715,7 +706,7 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
 
             # check wargle-eeee
             self.assertEqual(
-                json.loads(rsps.calls[8].request.body.decode()),
+                json.loads(rsps.calls[5].request.body.decode()),
                 {
                     'email': 'cancelled_sender@outside.local',
                     'status': 'rejected',
@@ -800,25 +791,14 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
                 },
                 status=200,
             )
-            rsps.add(
-                rsps.PATCH,
-                api_url(f'/payments/{PAYMENT_DATA["uuid"]}/'),
-                json={
-                    **PAYMENT_DATA,
-                    **payment_extra_details,
-                },
-                status=200,
-            )
 
             call_command('update_incomplete_payments', verbosity=0)
 
-            self.assertDictEqual(
-                json.loads(rsps.calls[-2].request.body.decode()),
-                payment_extra_details,
-            )
+            # card details are saved together with the final status
             self.assertDictEqual(
                 json.loads(rsps.calls[-1].request.body.decode()),
                 {
+                    **payment_extra_details,
                     'received_at': '2016-10-27T15:11:05+00:00',
                     'status': 'taken',
                 },
@@ -898,6 +878,48 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
 
             self.assertEqual(len(mail.outbox), 0)
 
+    def test_update_incomplete_payments_saves_details_if_no_captured_date(self):
+        """
+        Test that if the GOV.UK payment is in 'success' but no captured_date is found,
+        details like the email address are still saved on the MTP payment on their own.
+        """
+        payment = {**PAYMENT_DATA, 'email': None}
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 1,
+                    'results': [payment],
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
+                json={
+                    'reference': PAYMENT_DATA['uuid'],
+                    'state': {'status': 'success'},
+                    'email': 'success_sender@outside.local',
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url(f'/payments/{PAYMENT_DATA["uuid"]}/'),
+                json=PAYMENT_DATA,
+                status=200,
+            )
+
+            call_command('update_incomplete_payments', verbosity=0)
+
+            self.assertDictEqual(
+                json.loads(rsps.calls[-1].request.body.decode()),
+                {'email': 'success_sender@outside.local'},
+            )
+        self.assertEqual(len(mail.outbox), 0)
+
     @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
     def _test_update_incomplete_payments_doesnt_update_before_capture(self, settlement_summary):
         with responses.RequestsMock() as rsps:
@@ -950,6 +972,41 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
             'captured_date': '2015'
         })
 
+    def add_capture_run(self, rsps, govuk_payment_data):
+        """
+        Adds mocked responses for a run that captures an accepted payment
+        """
+        rsps.add(
+            rsps.GET,
+            api_url('/payments/'),
+            json={
+                'count': 1,
+                'results': [
+                    {
+                        **PAYMENT_DATA,
+                        'security_check': {
+                            'status': 'accepted',
+                            'user_actioned': True,
+                        },
+                    },
+                ],
+            },
+            status=200,
+        )
+        # get govuk payment
+        rsps.add(
+            rsps.GET,
+            govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
+            json=govuk_payment_data,
+            status=200,
+        )
+        # capture payment
+        rsps.add(
+            rsps.POST,
+            govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/capture/'),
+            status=204,
+        )
+
     @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
     def test_captured_payment_with_captured_date_gets_updated(self):
         """
@@ -965,35 +1022,106 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
         }
         with responses.RequestsMock() as rsps:
             mock_auth(rsps)
+            self.add_capture_run(rsps, govuk_payment_data)
+            # get govuk payment to see if we have the captured date
             rsps.add(
                 rsps.GET,
-                api_url('/payments/'),
+                govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
                 json={
-                    'count': 1,
-                    'results': [
-                        {
-                            **PAYMENT_DATA,
-                            'security_check': {
-                                'status': 'accepted',
-                                'user_actioned': True,
-                            },
-                        },
-                    ],
+                    **govuk_payment_data,
+                    'state': {'status': 'success'},
+                    'settlement_summary': {
+                        'capture_submit_time': '2016-10-27T15:11:05Z',
+                        'captured_date': '2016-10-27',
+                    },
                 },
                 status=200,
             )
-            # get govuk payment
+            # update status
+            rsps.add(
+                rsps.PATCH,
+                api_url(f'/payments/{PAYMENT_DATA["uuid"]}/'),
+                json={
+                    **PAYMENT_DATA,
+                    'status': 'taken',
+                    'email': 'success_sender@outside.local',
+                },
+                status=200,
+            )
+
+            call_command('update_incomplete_payments', verbosity=0)
+
+            self.assertEqual(len(mail.outbox), 1)
+
+            self.assertEqual(
+                json.loads(rsps.calls[-1].request.body.decode()),
+                {
+                    'status': 'taken',
+                    'received_at': '2016-10-27T15:11:05+00:00',
+                },
+            )
+
+    @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
+    def test_captured_payment_gets_updated_after_settlement_delay(self):
+        """
+        Test that when a MTP pending payment is captured but the captured date is not yet available,
+        the GOV.UK payment is not looked up again until it's expected to have settled; then the captured date
+        is found so the payment is marked as 'taken' and a confirmation email is sent.
+        """
+        govuk_payment_data = {
+            'payment_id': PAYMENT_DATA['processor_id'],
+            'reference': PAYMENT_DATA['uuid'],
+            'state': {'status': 'capturable'},
+            'email': 'success_sender@outside.local',
+        }
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            self.add_capture_run(rsps, govuk_payment_data)
             rsps.add(
                 rsps.GET,
                 govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
-                json=govuk_payment_data,
+                json={
+                    **govuk_payment_data,
+                    'state': {'status': 'success'},
+                    'settlement_summary': {'capture_submit_time': '2016-10-27T15:11:05Z'},
+                },
+                status=200,
+            )
+
+            call_command('update_incomplete_payments', verbosity=0)
+        self.assertEqual(len(mail.outbox), 0)
+
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 1,
+                    'results': [PAYMENT_DATA],
+                },
                 status=200,
             )
-            # capture payment
+            stdout = io.StringIO()
+            call_command('update_incomplete_payments', verbosity=2, stdout=stdout)
+
+            # GOV.UK Pay not called
+            self.assertEqual(len(rsps.calls), 2)
+        self.assertIn('settling: 1', stdout.getvalue())
+
+        # settlement delay passes
+        caches[settings.RECONCILIATION_CACHE].clear()
+
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
             rsps.add(
-                rsps.POST,
-                govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/capture/'),
-                status=204,
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 1,
+                    'results': [PAYMENT_DATA],
+                },
+                status=200,
             )
             # get govuk payment to see if we have the captured date
             rsps.add(
@@ -1033,14 +1161,35 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
                 },
             )
 
+    @override_settings(RECONCILIATION_SETTLEMENT_DELAY=60 * 60)
+    def test_completion_deferred_until_expected_settlement(self):
+        now = datetime(2016, 10, 27, 15, tzinfo=utc)
+        with mock.patch('send_money.reconciliation.timezone.now', return_value=now):
+            check_after = defer_completion(PAYMENT_DATA, {
+                'settlement_summary': {'capture_submit_time': '2016-10-27T14:50:00Z'},
+            })
+            self.assertEqual(check_after, datetime(2016, 10, 27, 15, 50, tzinfo=utc))
+
+            # overdue payments are left for another full delay
+            check_after = defer_completion(PAYMENT_DATA, {
+                'settlement_summary': {'capture_submit_time': '2016-10-27T12:00:00Z'},
+            })
+            self.assertEqual(check_after, datetime(2016, 10, 27, 16, tzinfo=utc))
+
+        self.assertTrue(is_completion_deferred(PAYMENT_DATA))
+        self.assertFalse(is_completion_deferred({**PAYMENT_DATA, 'uuid': 'wargle-2222'}))
+
+    def test_completion_not_deferred_without_capture_time(self):
+        payment = {**PAYMENT_DATA, 'uuid': 'wargle-3333'}
+        self.assertIsNone(defer_completion(payment, {'settlement_summary': {}}))
+        self.assertIsNone(defer_completion(payment, {}))
+        self.assertFalse(is_completion_deferred(payment))
+
     @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
-    def _test_captured_payment_doesnt_get_updated_before_capture(self, settlement_summary):
-        govuk_payment_data = {
-            'payment_id': PAYMENT_DATA['processor_id'],
-            'reference': PAYMENT_DATA['uuid'],
-            'state': {'status': 'capturable'},
-            'email': 'success_sender@outside.local',
-        }
+    def test_cancelled_payment_gets_updated_without_looking_up_again(self):
+        """
+        Test that cancelling a payment and completing it only makes two calls to GOV.UK Pay.
+        """
         with responses.RequestsMock() as rsps:
             mock_auth(rsps)
             rsps.add(
@@ -1052,7 +1201,7 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
                         {
                             **PAYMENT_DATA,
                             'security_check': {
-                                'status': 'accepted',
+                                'status': 'rejected',
                                 'user_actioned': True,
                             },
                         },
@@ -1063,14 +1212,52 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
             rsps.add(
                 rsps.GET,
                 govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
-                json=govuk_payment_data,
+                json={
+                    'payment_id': PAYMENT_DATA['processor_id'],
+                    'reference': PAYMENT_DATA['uuid'],
+                    'state': {'status': 'capturable'},
+                    'email': 'success_sender@outside.local',
+                },
                 status=200,
             )
             rsps.add(
                 rsps.POST,
-                govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/capture/'),
+                govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/cancel/'),
                 status=204,
             )
+            rsps.add(
+                rsps.PATCH,
+                api_url(f'/payments/{PAYMENT_DATA["uuid"]}/'),
+                json={
+                    **PAYMENT_DATA,
+                    'status': 'rejected',
+                },
+                status=200,
+            )
+
+            stdout = io.StringIO()
+            call_command('update_incomplete_payments', verbosity=2, stdout=stdout)
+
+            self.assertEqual(
+                json.loads(rsps.calls[-1].request.body.decode()),
+                {'status': 'rejected'},
+            )
+        self.assertIn('cancelled: 1', stdout.getvalue())
+        self.assertIn('completed: 1', stdout.getvalue())
+        self.assertIn('GOV.UK Pay calls: 2', stdout.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
+    def _test_captured_payment_doesnt_get_updated_before_capture(self, settlement_summary):
+        govuk_payment_data = {
+            'payment_id': PAYMENT_DATA['processor_id'],
+            'reference': PAYMENT_DATA['uuid'],
+            'state': {'status': 'capturable'},
+            'email': 'success_sender@outside.local',
+        }
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            self.add_capture_run(rsps, govuk_payment_data)
             rsps.add(
                 rsps.GET,
                 govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
@@ -1193,3 +1380,535 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
             '2016-10-28',
             '2016-10-28T23:59:59.999999+00:00'
         )
+
+    @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
+    def test_run_metrics_written_to_file(self):
+        """
+        Test that the outcome of a run is written out in prometheus text format.
+        """
+        payments = [
+            {
+                **PAYMENT_DATA,
+                'uuid': 'wargle-aaaa',
+                'processor_id': 1,
+            },
+            {
+                **PAYMENT_DATA,
+                'uuid': 'wargle-bbbb',
+                'processor_id': 2,
+            },
+        ]
+        with responses.RequestsMock() as rsps, tempfile.TemporaryDirectory() as metrics_path:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/%s/' % 1),
+                json={
+                    'reference': 'wargle-aaaa',
+                    'state': {'status': 'cancelled'},
+                    'email': PAYMENT_DATA['email'],
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/%s/' % 'wargle-aaaa'),
+                json={
+                    **payments[0],
+                    'status': 'rejected',
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/%s/' % 2),
+                status=500,
+            )
+
+            metrics_file = os.path.join(metrics_path, 'reconciliation.prom')
+            with silence_logger():
+                call_command('update_incomplete_payments', verbosity=0, metrics_file=metrics_file)
+
+            with open(metrics_file) as f:
+                metrics = f.read()
+
+        self.assertIn('mtp_reconciliation_payments{outcome="fetched"} 2.0', metrics)
+        self.assertIn('mtp_reconciliation_payments{outcome="skipped"} 0.0', metrics)
+        self.assertIn('mtp_reconciliation_payments{outcome="completed"} 1.0', metrics)
+        self.assertIn('mtp_reconciliation_errors{type="RequestException"} 1.0', metrics)
+        self.assertIn('mtp_reconciliation_govuk_calls 2.0', metrics)
+        self.assertIn('mtp_reconciliation_phase_duration_seconds{phase="govuk_lookup"}', metrics)
+        self.assertIn('mtp_reconciliation_duration_seconds', metrics)
+
+    @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
+    def test_completed_payments_updated_in_batches(self):
+        """
+        Test that completed payments are updated in groups with one request each,
+        emails are only sent for payments that were updated and failed updates are reported.
+        """
+        payments = [
+            {
+                **PAYMENT_DATA,
+                'uuid': f'wargle-{index}',
+                'processor_id': index,
+            }
+            for index in range(3)
+        ]
+        with responses.RequestsMock() as rsps, tempfile.TemporaryDirectory() as metrics_path:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            for payment in payments:
+                rsps.add(
+                    rsps.GET,
+                    govuk_url('/payments/%s/' % payment['processor_id']),
+                    json={
+                        'reference': payment['uuid'],
+                        'state': {'status': 'cancelled'},
+                        'email': PAYMENT_DATA['email'],
+                    },
+                    status=200,
+                )
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/'),
+                json={'results': [
+                    {'uuid': 'wargle-0', 'payment': {**payments[0], 'status': 'rejected'}},
+                    {'uuid': 'wargle-1', 'errors': {'status': ['Cannot change status.']}},
+                ]},
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/'),
+                json={'results': [
+                    {'uuid': 'wargle-2', 'payment': {**payments[2], 'status': 'rejected'}},
+                ]},
+                status=200,
+            )
+
+            metrics_file = os.path.join(metrics_path, 'reconciliation.prom')
+            with silence_logger():
+                call_command('update_incomplete_payments', verbosity=0, batch_size=2, metrics_file=metrics_file)
+
+            with open(metrics_file) as f:
+                metrics = f.read()
+            update_requests = [
+                json.loads(call.request.body)
+                for call in rsps.calls
+                if call.request.method == 'PATCH'
+            ]
+
+        self.assertEqual(update_requests, [
+            [{'status': 'rejected', 'uuid': 'wargle-0'}, {'status': 'rejected', 'uuid': 'wargle-1'}],
+            [{'status': 'rejected', 'uuid': 'wargle-2'}],
+        ])
+        self.assertIn('mtp_reconciliation_payments{outcome="completed"} 2.0', metrics)
+        self.assertIn('mtp_reconciliation_errors{type="PaymentUpdateError"} 1.0', metrics)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_urgent_payments_checked_first_when_run_cut_short(self):
+        """
+        Test that payments with a decided security check are checked first, oldest first,
+        so that they are the ones checked if a run cannot check all payments.
+        """
+        now = datetime.now()
+        payments = [
+            {
+                **PAYMENT_DATA,
+                'uuid': 'wargle-aaaa',
+                'processor_id': 1,
+                'created': (now - timedelta(days=4)).isoformat() + 'Z',
+                'security_check': None,
+            },
+            {
+                **PAYMENT_DATA,
+                'uuid': 'wargle-bbbb',
+                'processor_id': 2,
+                'created': (now - timedelta(hours=1)).isoformat() + 'Z',
+                'security_check': {'status': 'accepted', 'user_actioned': True},
+            },
+            {
+                **PAYMENT_DATA,
+                'uuid': 'wargle-cccc',
+                'processor_id': 3,
+                'created': (now - timedelta(hours=2)).isoformat() + 'Z',
+                'security_check': {'status': 'rejected', 'user_actioned': True},
+            },
+        ]
+        self.assertEqual(
+            [payment['uuid'] for payment in sorted(payments, key=get_priority)],
+            ['wargle-cccc', 'wargle-bbbb', 'wargle-aaaa'],
+        )
+
+        with responses.RequestsMock() as rsps, \
+                mock.patch.object(UpdateIncompletePaymentsCommand, 'should_stop', side_effect=[False, True, True]):
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/%s/' % 3),
+                json={
+                    'reference': 'wargle-cccc',
+                    'state': {'status': 'submitted'},
+                },
+                status=200,
+            )
+            stdout = io.StringIO()
+            call_command('update_incomplete_payments', verbosity=2, stdout=stdout)
+
+        self.assertIn('deferred: 2', stdout.getvalue())
+
+    def test_payments_with_unknown_creation_date_sorted_last(self):
+        payments = [
+            {'uuid': 'wargle-aaaa', 'created': 'unknown', 'security_check': None},
+            {'uuid': 'wargle-bbbb', 'created': '2016-13-40T10:00:00Z', 'security_check': None},
+            {'uuid': 'wargle-cccc', 'created': None, 'security_check': None},
+            {'uuid': 'wargle-dddd', 'created': '2016-10-27T10:00:00Z', 'security_check': None},
+        ]
+        self.assertEqual(
+            [payment['uuid'] for payment in sorted(payments, key=get_priority)][0],
+            'wargle-dddd',
+        )
+
+    def test_time_limit_stops_run(self):
+        command = UpdateIncompletePaymentsCommand()
+        self.assertFalse(command.should_stop())
+        with mock.patch('send_money.management.commands.update_incomplete_payments.time.monotonic', return_value=100):
+            command.stop_at = 160
+            self.assertFalse(command.should_stop())
+            command.stop_at = 100
+            self.assertTrue(command.should_stop())
+
+
+class ShardedUpdateIncompletePaymentsTestCase(BaseUpdateIncompletePaymentsTestCase):
+    def setUp(self):
+        super().setUp()
+        lease_path = tempfile.TemporaryDirectory()
+        self.addCleanup(lease_path.cleanup)
+        patched_settings = override_settings(
+            RECONCILIATION_LEASE_BACKEND='file',
+            RECONCILIATION_LEASE_PATH=lease_path.name,
+        )
+        patched_settings.enable()
+        self.addCleanup(patched_settings.disable)
+
+    def test_payments_assigned_to_exactly_one_shard(self):
+        for index in range(100):
+            payment = {'uuid': f'wargle-{index}'}
+            shards = [shard_index for shard_index in range(3) if is_in_shard(payment, shard_index, 3)]
+            self.assertEqual(len(shards), 1)
+
+    def test_only_payments_in_shard_checked(self):
+        payments = [
+            {
+                **PAYMENT_DATA,
+                'uuid': f'wargle-{index}',
+                'processor_id': index,
+            }
+            for index in range(10)
+        ]
+        payments_in_shard = [payment for payment in payments if is_in_shard(payment, 1, 2)]
+        self.assertTrue(0 < len(payments_in_shard) < len(payments))
+
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            for payment in payments_in_shard:
+                rsps.add(
+                    rsps.GET,
+                    govuk_url('/payments/%s/' % payment['processor_id']),
+                    json={
+                        'reference': payment['uuid'],
+                        'state': {'status': 'submitted'},
+                    },
+                    status=200,
+                )
+
+            call_command('update_incomplete_payments', verbosity=0, sharded=True, shard_index=1, shard_count=2)
+
+            self.assertEqual(len(rsps.calls), 2 + len(payments_in_shard))
+
+    def test_shard_skipped_if_leased_elsewhere(self):
+        held_lease = FileLease('update-incomplete-payments-0', 60)
+        self.assertTrue(held_lease.acquire())
+        self.addCleanup(held_lease.release)
+
+        with responses.RequestsMock() as rsps:
+            call_command('update_incomplete_payments', verbosity=0, sharded=True, shard_index=0, shard_count=2)
+            self.assertEqual(len(rsps.calls), 0)
+
+    def test_lease_released_after_run(self):
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 0,
+                    'results': [],
+                },
+                status=200,
+            )
+            call_command('update_incomplete_payments', verbosity=0, sharded=True, shard_index=0, shard_count=2)
+
+        held_lease = FileLease('update-incomplete-payments-0', 60)
+        self.assertTrue(held_lease.acquire())
+        held_lease.release()
+
+
+class CacheLeaseTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        # a local memory cache stands in for a shared one
+        patched_backends = mock.patch.object(CacheLease, 'local_cache_backends', ())
+        patched_backends.start()
+        self.addCleanup(patched_backends.stop)
+        patched_settings = override_settings(RECONCILIATION_LEASE_CACHE='default')
+        patched_settings.enable()
+        self.addCleanup(patched_settings.disable)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_lease_excludes_others_until_released(self):
+        held_lease = CacheLease('test', 60 * 60)
+        self.assertTrue(held_lease.acquire())
+        self.assertFalse(CacheLease('test', 60 * 60).acquire())
+        held_lease.release()
+        self.assertTrue(CacheLease('test', 60 * 60).acquire())
+
+    def test_lease_near_expiry_left_to_expire(self):
+        held_lease = CacheLease('test', 60 * 60)
+        self.assertTrue(held_lease.acquire())
+        with mock.patch('send_money.reconciliation.time.monotonic', return_value=held_lease.acquired_at + 60 * 60):
+            held_lease.release()
+        self.assertEqual(cache.get('lease-test'), held_lease.token)
+
+    def test_local_cache_rejected(self):
+        with mock.patch.object(CacheLease, 'local_cache_backends', (LocMemCache,)), \
+                self.assertRaises(ImproperlyConfigured):
+            CacheLease('test', 60)
+        with override_settings(RECONCILIATION_LEASE_CACHE=''), self.assertRaises(ImproperlyConfigured):
+            CacheLease('test', 60)
+
+
+@override_settings(RECONCILIATION_SHARDED=False)
+class UpdateIncompletePaymentsWorkerTestCase(BaseUpdateIncompletePaymentsTestCase):
+    def setUp(self):
+        super().setUp()
+        mocked_is_first_instance = mock.patch(
+            'send_money.management.commands.update_incomplete_payments.is_first_instance',
+            return_value=True
+        )
+        mocked_is_first_instance.start()
+        self.addCleanup(mocked_is_first_instance.stop)
+
+    def add_payments(self, rsps, payments):
+        rsps.add(
+            rsps.GET,
+            api_url('/payments/'),
+            json={
+                'count': len(payments),
+                'results': payments,
+            },
+            status=200,
+        )
+
+    def test_api_session_reused_between_runs(self):
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            self.add_payments(rsps, [])
+            self.add_payments(rsps, [])
+            self.add_payments(rsps, [])
+            call_command('update_incomplete_payments_worker', verbosity=0, interval=0, runs=3)
+
+            self.assertEqual(len(rsps.calls), 4)
+
+    def test_unexpected_errors_do_not_stop_worker(self):
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            # payment missing expected fields
+            self.add_payments(rsps, [{'uuid': 'wargle-1111'}])
+            self.add_payments(rsps, [])
+            with silence_logger():
+                call_command('update_incomplete_payments_worker', verbosity=0, interval=0, runs=2)
+
+            self.assertEqual(len(rsps.calls), 3)
+
+    def test_payments_checked_concurrently(self):
+        payments = [
+            {
+                **PAYMENT_DATA,
+                'uuid': f'wargle-{index}',
+                'processor_id': index,
+            }
+            for index in range(6)
+        ]
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            self.add_payments(rsps, payments)
+            for payment in payments:
+                rsps.add(
+                    rsps.GET,
+                    govuk_url('/payments/%s/' % payment['processor_id']),
+                    json={
+                        'reference': payment['uuid'],
+                        'state': {'status': 'submitted'},
+                    },
+                    status=200,
+                )
+            call_command('update_incomplete_payments_worker', verbosity=0, interval=0, runs=1, concurrency=3)
+
+            self.assertEqual(len(rsps.calls), 2 + len(payments))
+
+    def test_stops_gracefully_on_sigterm(self):
+        payments = [
+            {
+                **PAYMENT_DATA,
+                'uuid': f'wargle-{index}',
+                'processor_id': index,
+            }
+            for index in range(3)
+        ]
+
+        def terminate(_request):
+            os.kill(os.getpid(), signal.SIGTERM)
+            return 200, {}, json.dumps({
+                'reference': payments[0]['uuid'],
+                'state': {'status': 'submitted'},
+            })
+
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            mock_auth(rsps)
+            self.add_payments(rsps, payments)
+            rsps.add_callback(rsps.GET, govuk_url('/payments/0/'), callback=terminate)
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), status=500)
+            with silence_logger():
+                call_command('update_incomplete_payments_worker', verbosity=0, interval=3600)
+
+            # the payment being checked completes, but no more are started and no further run is waited for
+            self.assertEqual(len(rsps.calls), 3)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous_handler)
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    def test_benchmarks_run(self):
+        stdout = io.StringIO()
+        call_command('benchmark', 'session', 'completion_attrs', iterations=1, stdout=stdout)
+        self.assertIn('CompactSessionSerializer cookie size', stdout.getvalue())
+        self.assertIn('plan for new payment', stdout.getvalue())
+
+    def test_unknown_benchmark(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'unknown')
+
+
+class ProfileImportsTestCase(SimpleTestCase):
+    def test_import_times_parsed(self):
+        output = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       100 |        100 |   django.utils\n'
+            'import time:       200 |        300 | django\n'
+        )
+        self.assertListEqual(parse_import_times(output), [
+            ImportTime('django.utils', 100, 100),
+            ImportTime('django', 200, 300),
+        ])
+
+    def test_command_does_not_load_stack_client(self):
+        stdout = io.StringIO()
+        call_command('profile_imports', 'update_incomplete_payments', limit=10000, stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn('send_money.payments', output)
+        self.assertNotIn('kubernetes', output)
+
+    def test_unknown_command(self):
+        with self.assertRaises(CommandError):
+            call_command('profile_imports', 'unknown')
+
+
+class MemoryAuditTestCase(SimpleTestCase):
+    def run_python(self, code, env):
+        # takes a snapshot in this process instead of loading the application in a new one
+        self.assertEqual(env, {'WARM_UP': 'False'})
+        self.code = code
+        snapshot_path = re.search(r'snapshot\.dump\((.*)\)', code).group(1)
+        tracemalloc.start()
+        try:
+            self.allocated = [str(number) for number in range(1000)]
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        snapshot.dump(ast.literal_eval(snapshot_path))
+        return subprocess.CompletedProcess([], 0, '', '')
+
+    def call_command(self, *args, **kwargs):
+        stdout = io.StringIO()
+        with mock.patch('send_money.management.commands.memory_audit.run_python', self.run_python):
+            call_command('memory_audit', *args, stdout=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_allocations_reported(self):
+        output = self.call_command(group_by='lineno', limit=5)
+        self.assertIn('warm_up()', self.code)
+        self.assertIn('KiB allocated', output)
+        self.assertIn('test_commands.py', output)
+
+    def test_snapshots_compared(self):
+        with tempfile.TemporaryDirectory() as path:
+            snapshot_path = os.path.join(path, 'snapshot')
+            self.call_command('--no-warm-up', save=snapshot_path)
+            self.assertNotIn('warm_up()', self.code)
+            output = self.call_command(compare_to=snapshot_path)
+        self.assertIn(f'Largest differences from {snapshot_path}', output)
+
+
+class RunStubsTestCase(SimpleTestCase):
+    @mock.patch('send_money.management.commands.run_stubs.Command.wait_for_interrupt')
+    def test_servers_started_until_interrupted(self, mocked_wait_for_interrupt):
+        stdout = io.StringIO()
+        call_command('run_stubs', host='127.0.0.1', api_port=0, govuk_port=0, prisoners=5, stdout=stdout)
+        output = stdout.getvalue()
+        self.assertRegex(output, r'API_URL=http://127\.0\.0\.1:\d+\n')
+        self.assertRegex(output, r'GOVUK_PAY_URL=http://127\.0\.0\.1:\d+/v1\n')
+        self.assertIn('A0000AA', output)
+        mocked_wait_for_interrupt.assert_called_once_with()
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            call_command('run_stubs', error_rate=1.5)
+        with self.assertRaises(CommandError):
+            call_command('run_stubs', govuk_rate_limit=-1)
@@ -0,0 +1,153 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from requests.exceptions import Timeout
+import responses
+
+from send_money.deadlines import (
+    DeadlineExceeded, LatencyTracker,
+    bind_deadline, deadline, get_latency_tracker, get_remaining_time, get_timeout, timed_call,
+)
+from send_money.payments import PaymentClient
+
+
+class DeadlineTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000
+        patched_time = mock.patch('send_money.deadlines.time.monotonic', side_effect=lambda: self.now)
+        patched_time.start()
+        self.addCleanup(patched_time.stop)
+
+    def test_no_deadline(self):
+        self.assertIsNone(get_remaining_time())
+        self.assertEqual(get_timeout('test-no-deadline', 15), 15)
+
+    def test_remaining_time(self):
+        with deadline(10):
+            self.now += 4
+            self.assertEqual(get_remaining_time(), 6)
+            self.assertEqual(get_timeout('test-remaining-time', 15), 6)
+            self.assertEqual(get_timeout('test-remaining-time', 5), 5)
+        self.assertIsNone(get_remaining_time())
+
+    def test_nested_deadline_cannot_extend_outer(self):
+        with deadline(10):
+            with deadline(20):
+                self.assertEqual(get_remaining_time(), 10)
+            with deadline(5):
+                self.assertEqual(get_remaining_time(), 5)
+            self.assertEqual(get_remaining_time(), 10)
+
+    def test_deadline_bound_to_other_thread(self):
+        with ThreadPoolExecutor(max_workers=1) as executor, deadline(10):
+            self.now += 4
+            self.assertIsNone(executor.submit(get_remaining_time).result())
+            self.assertEqual(executor.submit(bind_deadline(get_remaining_time)).result(), 6)
+            self.assertIsNone(executor.submit(get_remaining_time).result())
+
+    def test_exhausted_deadline(self):
+        func = mock.Mock()
+        with deadline(10):
+            self.now += 10
+            with self.assertRaises(DeadlineExceeded):
+                timed_call('test-exhausted', 15, func)
+        func.assert_not_called()
+
+    def test_timeout_passed_to_call(self):
+        func = mock.Mock(return_value='ok')
+        with deadline(10):
+            self.now += 3
+            self.assertEqual(timed_call('test-passed', 15, func, 'a', b=1), 'ok')
+        func.assert_called_once_with('a', b=1, timeout=7)
+
+    def test_call_outside_deadline_given_maximum_timeout(self):
+        func = mock.Mock(return_value='ok')
+        with deadline(10):
+            self.now += 11
+            self.assertEqual(timed_call('test-outside-deadline', 15, func, within_deadline=False), 'ok')
+        func.assert_called_once_with(timeout=15)
+
+    def test_elapsed_time_recorded(self):
+        def call(timeout):
+            self.now += 1
+
+        def slow_call(timeout):
+            self.now += 2
+            raise Timeout
+
+        timed_call('test-elapsed', 15, call)
+        with self.assertRaises(Timeout):
+            timed_call('test-elapsed', 15, slow_call)
+        self.assertEqual(list(get_latency_tracker('test-elapsed').latencies), [1, 2])
+
+    def test_timeout_cut_short_by_deadline_not_recorded(self):
+        def slow_call(timeout):
+            self.now += timeout
+            raise Timeout
+
+        with deadline(10):
+            self.now += 9
+            with self.assertRaises(Timeout):
+                timed_call('test-cut-short', 15, slow_call)
+        self.assertEqual(len(get_latency_tracker('test-cut-short').latencies), 0)
+
+    @override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1')
+    def test_payment_client_fails_fast_without_time_left(self):
+        with responses.RequestsMock(), deadline(10):
+            self.now += 11
+            with self.assertRaises(DeadlineExceeded):
+                PaymentClient().get_govuk_payment('12345')
+
+    @override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1', GOVUK_PAY_TIMEOUT=15)
+    def test_payment_client_gives_state_changes_full_timeout(self):
+        client = PaymentClient()
+        client.govuk_session = mock.Mock()
+        client.govuk_session.request.return_value = mock.Mock(status_code=201, **{
+            'json.return_value': {'payment_id': 'wargle-1111'},
+        })
+        with mock.patch.object(client, 'update_payment'), deadline(10):
+            self.now += 9.5
+            client.create_govuk_payment('wargle-aaaa', {'amount': 1000})
+            client.capture_govuk_payment({'payment_id': 'wargle-1111', 'state': {'status': 'capturable'}})
+            client.cancel_govuk_payment({'payment_id': 'wargle-1111', 'state': {'status': 'capturable'}})
+        timeouts = [call_kwargs['timeout'] for _, call_kwargs in client.govuk_session.request.call_args_list]
+        self.assertEqual(timeouts, [15, 15, 15])
+
+
+@override_settings(
+    ADAPTIVE_TIMEOUT_PERCENTILE=90,
+    ADAPTIVE_TIMEOUT_MULTIPLIER=3,
+    ADAPTIVE_TIMEOUT_MINIMUM=2,
+    ADAPTIVE_TIMEOUT_MINIMUM_SAMPLES=10,
+)
+class LatencyTrackerTestCase(SimpleTestCase):
+    def test_maximum_used_without_enough_samples(self):
+        tracker = LatencyTracker('test')
+        for _ in range(9):
+            tracker.record(0.1)
+        self.assertIsNone(tracker.get_percentile(90))
+        self.assertEqual(tracker.get_timeout(15), 15)
+
+    def test_timeout_follows_latency(self):
+        tracker = LatencyTracker('test')
+        for latency in range(1, 11):
+            tracker.record(latency / 2)
+        self.assertEqual(tracker.get_percentile(90), 4.5)
+        self.assertEqual(tracker.get_timeout(15), 13.5)
+        self.assertEqual(tracker.get_timeout(10), 10)
+
+    def test_timeout_has_minimum(self):
+        tracker = LatencyTracker('test')
+        for _ in range(10):
+            tracker.record(0.05)
+        self.assertEqual(tracker.get_timeout(15), 2)
+
+    def test_only_recent_latencies_kept(self):
+        tracker = LatencyTracker('test', size=10)
+        for _ in range(10):
+            tracker.record(5)
+        for _ in range(10):
+            tracker.record(1)
+        self.assertEqual(tracker.get_timeout(15), 3)
@@ -2,7 +2,7 @@ import logging
 from unittest import mock
 
 from django.test.testcases import SimpleTestCase
-from django.test import override_settings
+from django.test import RequestFactory, override_settings
 from django.utils.crypto import get_random_string
 import responses
 
@@ -157,6 +157,50 @@ class DebitCardPrisonerDetailsFormTestCase(PrisonerDetailsFormTestCase):
     form_class = DebitCardPrisonerDetailsForm
 
 
+class SessionFormTestCase(SimpleTestCase):
+    def make_request(self):
+        request = RequestFactory().get('/')
+        request.session = {
+            'prisoner_name': 'John Smith',
+            'prisoner_number': 'A1234AB',
+            'prisoner_dob': '1980-10-05',
+        }
+        return request
+
+    @mock.patch('send_money.forms.DebitCardPrisonerDetailsForm.is_prisoner_known', return_value=True)
+    def test_form_built_and_cleaned_once_per_request(self, mocked_is_prisoner_known):
+        request = self.make_request()
+        form = DebitCardPrisonerDetailsForm.unserialise_from_session(request)
+        self.assertTrue(form.is_valid())
+        same_form = DebitCardPrisonerDetailsForm.unserialise_from_session(request)
+        self.assertIs(same_form, form)
+        self.assertTrue(same_form.is_valid())
+        self.assertEqual(mocked_is_prisoner_known.call_count, 1)
+
+        # another request builds the form again
+        self.assertIsNot(DebitCardPrisonerDetailsForm.unserialise_from_session(self.make_request()), form)
+
+    @mock.patch('send_money.forms.DebitCardPrisonerDetailsForm.is_prisoner_known', return_value=True)
+    def test_saving_to_session_replaces_shared_form(self, _):
+        request = self.make_request()
+        form = DebitCardPrisonerDetailsForm.unserialise_from_session(request)
+        self.assertTrue(form.is_valid())
+
+        new_form = DebitCardPrisonerDetailsForm(request=request, data={
+            'prisoner_name': 'Jane Smith',
+            'prisoner_number': 'A1234AB',
+            'prisoner_dob_0': '5',
+            'prisoner_dob_1': '10',
+            'prisoner_dob_2': '1980',
+        })
+        self.assertTrue(new_form.is_valid())
+        new_form.serialise_to_session()
+
+        form = DebitCardPrisonerDetailsForm.unserialise_from_session(request)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['prisoner_name'], 'Jane Smith')
+
+
 DebitCardPrisonerDetailsFormTestCase.make_valid_tests([
     {
         'name': 'normal',
@@ -1,4 +1,5 @@
 import json
+from unittest import mock
 
 from django.core import mail
 from django.test import override_settings
@@ -7,8 +8,9 @@ from mtp_common.test_utils import silence_logger
 from requests.exceptions import HTTPError, RequestException
 import responses
 
-from send_money.exceptions import GovUkPaymentStatusException
-from send_money.payments import GovUkPaymentStatus, PaymentClient
+from send_money.circuit_breakers import CircuitOpenError
+from send_money.exceptions import GovUkPaymentStatusException, PaymentUpdateError
+from send_money.payments import GovUkPaymentStatus, PaymentClient, PaymentUpdateBatch, PendingPaymentUpdate
 from send_money.tests import mock_auth
 from send_money.utils import api_url, govuk_url
 
@@ -669,6 +671,32 @@ class CompletePaymentIfNecessaryTestCase(SimpleTestCase):
         self.assertEqual(status, GovUkPaymentStatus.success)
         self.assertEqual(len(mail.outbox), 0)
 
+    def test_success_status_with_pending_update(self):
+        """
+        Test that if the govuk payment is in 'success' state and changes are collected in a pending update,
+        the MTP payment record is not patched yet but the changes are collected
+        """
+        client = PaymentClient()
+        payment = {
+            'uuid': 'some-id',
+        }
+        govuk_payment = {
+            'payment_id': 'payment-id',
+            'state': {
+                'status': GovUkPaymentStatus.success.name,
+            },
+            'email': 'sender@example.com',
+            'provider_id': '123456789',
+        }
+        pending_update = PendingPaymentUpdate(payment)
+        with responses.RequestsMock():
+            status = client.complete_payment_if_necessary(payment, govuk_payment, pending_update=pending_update)
+
+        self.assertEqual(status, GovUkPaymentStatus.success)
+        expected_changes = {'email': 'sender@example.com', 'worldpay_id': '123456789'}
+        self.assertDictEqual(pending_update.changes, expected_changes)
+        self.assertDictEqual(payment, {'uuid': 'some-id', **expected_changes})
+
     def test_capturable_payment_that_shouldnt_be_captured_yet(self):
         """
         Test that if the govuk payment is in 'capturable' state, the MTP payment record
@@ -1152,3 +1180,144 @@ class GetCompletionPaymentAttrUpdatesTestCase(SimpleTestCase):
                 },
             }
         )
+
+    def test_missing_card_details(self):
+        """
+        Test that attributes are still found if the GOV.UK payment has no card details
+        """
+        client = PaymentClient()
+        for card_details in (None, {}):
+            govuk_payment = {
+                'email': 'some@email.com',
+                'card_details': card_details,
+            }
+            attr_updates = client.get_completion_payment_attr_updates({}, govuk_payment)
+            self.assertDictEqual(attr_updates, {'email': 'some@email.com'})
+
+
+class UpdatePaymentsTestCase(SimpleTestCase):
+    def test_bulk_update_reports_errors_per_payment(self):
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/'),
+                json={'results': [
+                    {'uuid': 'wargle-1111', 'payment': {'uuid': 'wargle-1111', 'status': 'taken'}},
+                    {'uuid': 'wargle-2222', 'errors': {'status': ['Cannot change status.']}},
+                ]},
+                status=200,
+            )
+            results = PaymentClient().update_payments({
+                'wargle-1111': {'status': 'taken'},
+                'wargle-2222': {'status': 'taken'},
+                'wargle-3333': {'status': 'failed'},
+            })
+            self.assertEqual(json.loads(rsps.calls[-1].request.body), [
+                {'status': 'taken', 'uuid': 'wargle-1111'},
+                {'status': 'taken', 'uuid': 'wargle-2222'},
+                {'status': 'failed', 'uuid': 'wargle-3333'},
+            ])
+
+        self.assertEqual(results['wargle-1111'], {'uuid': 'wargle-1111', 'status': 'taken'})
+        self.assertIsInstance(results['wargle-2222'], PaymentUpdateError)
+        self.assertEqual(results['wargle-2222'].errors, {'status': ['Cannot change status.']})
+        self.assertIsInstance(results['wargle-3333'], PaymentUpdateError)
+
+    def test_falls_back_to_individual_updates(self):
+        payment_client = PaymentClient()
+        with responses.RequestsMock() as rsps, silence_logger():
+            mock_auth(rsps)
+            rsps.add(rsps.PATCH, api_url('/payments/'), status=405)
+            for payment_ref in ('wargle-1111', 'wargle-2222', 'wargle-1111'):
+                rsps.add(
+                    rsps.PATCH,
+                    api_url(f'/payments/{payment_ref}/'),
+                    json={'uuid': payment_ref, 'status': 'taken'},
+                    status=200,
+                )
+            results = payment_client.update_payments({
+                'wargle-1111': {'status': 'taken'},
+                'wargle-2222': {'status': 'taken'},
+            })
+            # bulk updates are not tried again
+            payment_client.update_payments({'wargle-1111': {'status': 'taken'}})
+            self.assertEqual(len(rsps.calls), 5)
+
+        self.assertEqual(results, {
+            'wargle-1111': {'uuid': 'wargle-1111', 'status': 'taken'},
+            'wargle-2222': {'uuid': 'wargle-2222', 'status': 'taken'},
+        })
+
+
+class PaymentUpdateBatchTestCase(SimpleTestCase):
+    def test_changes_merged_and_written_when_full(self):
+        on_success = mock.Mock()
+        payment_client = mock.Mock(spec=PaymentClient)
+        payment_client.update_payments.side_effect = lambda payment_updates: {
+            payment_ref: {'uuid': payment_ref}
+            for payment_ref in payment_updates
+        }
+        batch = PaymentUpdateBatch(payment_client, 2, on_success=on_success)
+        notify = mock.Mock()
+
+        batch.update('wargle-1111', {'email': 'sender@outside.local'})
+        batch.update('wargle-1111', {'status': 'taken'}, on_success=notify)
+        payment_client.update_payments.assert_not_called()
+        self.assertEqual(len(batch), 1)
+
+        batch.update('wargle-2222', {'status': 'failed'})
+        payment_client.update_payments.assert_called_once_with({
+            'wargle-1111': {'email': 'sender@outside.local', 'status': 'taken'},
+            'wargle-2222': {'status': 'failed'},
+        })
+        notify.assert_called_once_with()
+        self.assertEqual(on_success.call_count, 2)
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch.flush(), {})
+        self.assertEqual(payment_client.update_payments.call_count, 1)
+
+    def test_failed_request_reported_for_each_payment(self):
+        on_failure = mock.Mock()
+        batch = PaymentUpdateBatch(PaymentClient(), 10, on_failure=on_failure)
+        notify = mock.Mock()
+        batch.update('wargle-1111', {'status': 'taken'}, on_success=notify)
+        batch.update('wargle-2222', {'status': 'taken'}, on_success=notify)
+        with responses.RequestsMock() as rsps, silence_logger():
+            mock_auth(rsps)
+            rsps.add(rsps.PATCH, api_url('/payments/'), status=500)
+            failures = batch.flush()
+
+        self.assertEqual(set(failures), {'wargle-1111', 'wargle-2222'})
+        self.assertEqual(on_failure.call_count, 2)
+        notify.assert_not_called()
+
+    def test_discarded_updates_reported_as_failures(self):
+        on_failure = mock.Mock()
+        payment_client = mock.Mock(spec=PaymentClient)
+        payment_client.update_payments.side_effect = CircuitOpenError('mtp_api circuit is open')
+        batch = PaymentUpdateBatch(payment_client, 10, on_failure=on_failure)
+        batch.update('wargle-1111', {'status': 'taken'})
+        batch.update('wargle-2222', {'status': 'taken'})
+        with self.assertRaises(CircuitOpenError):
+            batch.flush()
+
+        self.assertEqual({call[0][0] for call in on_failure.call_args_list}, {'wargle-1111', 'wargle-2222'})
+        self.assertEqual(len(batch), 0)
+
+    def test_failing_callback_does_not_stop_others(self):
+        payment_client = mock.Mock(spec=PaymentClient)
+        payment_client.update_payments.side_effect = lambda payment_updates: {
+            payment_ref: {'uuid': payment_ref}
+            for payment_ref in payment_updates
+        }
+        on_success = mock.Mock()
+        batch = PaymentUpdateBatch(payment_client, 10, on_success=on_success)
+        notify = mock.Mock()
+        batch.update('wargle-1111', {'status': 'taken'}, on_success=mock.Mock(side_effect=ValueError))
+        batch.update('wargle-2222', {'status': 'taken'}, on_success=notify)
+        with silence_logger():
+            self.assertEqual(batch.flush(), {})
+
+        notify.assert_called_once_with()
+        self.assertEqual(on_success.call_count, 2)
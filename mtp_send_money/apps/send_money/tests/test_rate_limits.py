@@ -0,0 +1,214 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from mtp_common.test_utils import silence_logger
+import requests
+import responses
+
+from send_money.deadlines import deadline
+from send_money.payments import PaymentClient
+from send_money.rate_limits import (
+    RateLimiter, RateLimitExceeded, TokenBucket,
+    govuk_pay_rate_limiter, parse_retry_after, reset_rate_limiters,
+)
+from send_money.stubs import GovUkPayStubHandler, StubBehaviour, StubDataset, start_stub_server
+from send_money.utils import govuk_url
+
+
+class PatchedTimeTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000
+        self.sleeps = []
+        for name, side_effect in (
+            ('monotonic', lambda: self.now),
+            ('time', lambda: self.now),
+            ('sleep', self.sleep),
+        ):
+            patched_time = mock.patch(f'send_money.rate_limits.time.{name}', side_effect=side_effect)
+            patched_time.start()
+            self.addCleanup(patched_time.stop)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTestCase(PatchedTimeTestCase):
+    def test_burst_allowed_then_calls_spaced_out(self):
+        bucket = TokenBucket('test')
+        waits = [bucket.reserve(rate=2, burst=3) for _ in range(5)]
+        self.assertEqual(waits, [0, 0, 0, 0.5, 1])
+        self.assertEqual(bucket.delays, 2)
+
+    def test_tokens_refill_up_to_burst(self):
+        bucket = TokenBucket('test')
+        for _ in range(3):
+            bucket.reserve(rate=2, burst=3)
+        self.now += 10
+        waits = [bucket.reserve(rate=2, burst=3) for _ in range(4)]
+        self.assertEqual(waits, [0, 0, 0, 0.5])
+
+    def test_long_waits_rejected(self):
+        bucket = TokenBucket('test')
+        bucket.reserve(rate=1, burst=1)
+        bucket.reserve(rate=1, burst=1)
+        with self.assertRaises(RateLimitExceeded):
+            bucket.reserve(rate=1, burst=1, max_wait=1.5)
+        self.assertEqual(bucket.rejections, 1)
+        # a rejected call does not take a token
+        self.assertEqual(bucket.reserve(rate=1, burst=1, max_wait=2), 2)
+
+    def test_pause_stops_calls(self):
+        bucket = TokenBucket('test')
+        bucket.pause(5)
+        self.assertEqual(bucket.reserve(rate=2, burst=3), 5.5)
+        self.now += 5
+        self.assertEqual(bucket.reserve(rate=2, burst=3), 1)
+
+    def test_pause_applies_without_rate(self):
+        bucket = TokenBucket('test')
+        self.assertEqual(bucket.reserve(rate=0, burst=1), 0)
+        bucket.pause(3)
+        self.assertEqual(bucket.reserve(rate=0, burst=1), 3)
+        self.now += 4
+        self.assertEqual(bucket.reserve(rate=0, burst=1), 0)
+
+
+@override_settings(TEST_RATE_LIMIT=2, TEST_RATE_LIMIT_BURST=5, TEST_RATE_LIMIT_CACHE='default')
+class SharedRateLimitTestCase(PatchedTimeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.25
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_calls_limited_across_processes(self):
+        rate_limiters = [RateLimiter('test', 'TEST_RATE_LIMIT') for _ in range(2)]
+        for rate_limiter in rate_limiters:
+            self.assertEqual(rate_limiter.acquire(), 0)
+        # both "processes" still have tokens but the shared window is full
+        self.assertEqual(rate_limiters[0].acquire(), 0.75)
+        self.assertEqual(self.now, 1001)
+        self.assertEqual(rate_limiters[1].acquire(), 0)
+        with self.assertRaises(RateLimitExceeded):
+            rate_limiters[1].acquire(max_wait=0.5)
+        self.assertEqual(rate_limiters[1].bucket.rejections, 1)
+
+    def test_pause_shared(self):
+        rate_limiters = [RateLimiter('test', 'TEST_RATE_LIMIT') for _ in range(2)]
+        with silence_logger():
+            rate_limiters[0].pause(3)
+        self.assertEqual(rate_limiters[1].acquire(), 3)
+        self.assertEqual(self.sleeps, [3])
+
+
+class ParseRetryAfterTestCase(SimpleTestCase):
+    def make_response(self, retry_after=None):
+        response = requests.Response()
+        if retry_after is not None:
+            response.headers['Retry-After'] = retry_after
+        return response
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after(self.make_response('2')), 2)
+        self.assertEqual(parse_retry_after(self.make_response('-1')), 0)
+
+    def test_http_date(self):
+        with mock.patch('send_money.rate_limits.time.time', return_value=1445412480):
+            self.assertEqual(parse_retry_after(self.make_response('Wed, 21 Oct 2015 07:28:30 GMT')), 30)
+
+    def test_default(self):
+        self.assertEqual(parse_retry_after(self.make_response()), 1)
+        self.assertEqual(parse_retry_after(self.make_response('soon')), 1)
+
+    def test_non_finite_values_ignored(self):
+        for value in ('inf', '-inf', 'nan', '1e400'):
+            self.assertEqual(parse_retry_after(self.make_response(value)), 1, msg=f'{value} should be ignored')
+
+    def test_maximum(self):
+        self.assertEqual(parse_retry_after(self.make_response('1e12'), maximum=60), 60)
+        self.assertEqual(parse_retry_after(self.make_response('2'), maximum=60), 2)
+        with mock.patch('send_money.rate_limits.time.time', return_value=1445412480):
+            self.assertEqual(parse_retry_after(self.make_response('Fri, 01 Jan 9999 00:00:00 GMT'), maximum=60), 60)
+
+
+@override_settings(
+    GOVUK_PAY_URL='https://pay.gov.local/v1',
+    GOVUK_PAY_RATE_LIMIT=0,
+    GOVUK_PAY_RATE_LIMIT_RETRIES=2,
+    GOVUK_PAY_RATE_LIMIT_MAX_WAIT=5,
+)
+class PaymentClientRateLimitTestCase(PatchedTimeTestCase):
+    def setUp(self):
+        super().setUp()
+        reset_rate_limiters()
+        self.addCleanup(reset_rate_limiters)
+
+    def test_retries_after_too_many_requests(self):
+        client = PaymentClient()
+        delays = govuk_pay_rate_limiter().bucket.delays
+        with responses.RequestsMock() as rsps, silence_logger():
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), status=429, headers={'Retry-After': '2'})
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), json={'payment_id': '1'})
+            self.assertEqual(client.get_govuk_payment('1')['payment_id'], '1')
+        self.assertEqual(self.sleeps, [2])
+        self.assertEqual(client.govuk_calls, 2)
+        self.assertEqual(govuk_pay_rate_limiter().bucket.delays, delays + 1)
+
+    @override_settings(GOVUK_PAY_RATE_LIMIT_CACHE='default')
+    def test_unusable_retry_after_does_not_stop_calls(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        client = PaymentClient()
+        with responses.RequestsMock() as rsps, silence_logger():
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), status=429, headers={'Retry-After': 'inf'})
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), json={'payment_id': '1'})
+            rsps.add(rsps.GET, govuk_url('/payments/2/'), json={'payment_id': '2'})
+            self.assertEqual(client.get_govuk_payment('1')['payment_id'], '1')
+            self.assertEqual(client.get_govuk_payment('2')['payment_id'], '2')
+        self.assertEqual(self.sleeps, [1])
+
+    @override_settings(GOVUK_PAY_RATE_LIMIT_CACHE='default', GOVUK_PAY_RATE_LIMIT_MAX_PAUSE=3)
+    def test_long_retry_after_limited(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        client = PaymentClient()
+        with responses.RequestsMock() as rsps, silence_logger():
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), status=429, headers={'Retry-After': '1e12'})
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), json={'payment_id': '1'})
+            self.assertEqual(client.get_govuk_payment('1')['payment_id'], '1')
+        self.assertEqual(self.sleeps, [3])
+
+    def test_gives_up_after_retries(self):
+        client = PaymentClient()
+        with responses.RequestsMock() as rsps, silence_logger():
+            for _ in range(3):
+                rsps.add(rsps.GET, govuk_url('/payments/1/events/'), status=429, headers={'Retry-After': '1'})
+            with self.assertRaises(requests.HTTPError):
+                client.get_govuk_payment_events('1')
+        self.assertEqual(client.govuk_calls, 3)
+
+    def test_does_not_wait_beyond_deadline(self):
+        client = PaymentClient()
+        with responses.RequestsMock() as rsps, silence_logger():
+            rsps.add(rsps.GET, govuk_url('/payments/1/'), status=429, headers={'Retry-After': '4'})
+            with deadline(10), mock.patch('send_money.payments.get_remaining_time', return_value=3), \
+                    self.assertRaises(RateLimitExceeded):
+                client.get_govuk_payment('1')
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(client.govuk_calls, 1)
+
+
+class StubRateLimitTestCase(SimpleTestCase):
+    def test_stub_responds_with_retry_after(self):
+        server = start_stub_server(
+            GovUkPayStubHandler, StubDataset(prisoners=1, prisons=1), StubBehaviour(rate_limit=1), host='127.0.0.1',
+        )
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with mock.patch('send_money.stubs.time.monotonic', return_value=1000.5):
+            responses_ = [requests.get(f'{server.url}/payments/1') for _ in range(2)]
+        self.assertEqual([response.status_code for response in responses_], [404, 429])
+        self.assertEqual(responses_[1].headers['Retry-After'], '1')
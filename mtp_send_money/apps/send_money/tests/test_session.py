@@ -0,0 +1,56 @@
+import unittest
+
+from django.core import signing
+
+from send_money.session import CompactSessionSerializer
+
+SALT = 'django.contrib.sessions.backends.signed_cookies'
+
+
+class CompactSessionSerializerTestCase(unittest.TestCase):
+    session_data = {
+        'payment_method': 'debit_card',
+        'prisoner_name': 'Jâmes Hälls',
+        'prisoner_dob': '1992-12-05',
+        'prisoner_number': 'A1409AE',
+        'amount': '17.50',
+        'processor_id': 'r3tocm6tp6q1g8ns1e0jhgpmis',
+    }
+
+    def test_round_trip(self):
+        serializer = CompactSessionSerializer()
+        cases = [
+            {},
+            self.session_data,
+            {**self.session_data, 'amount': '0.01', '_messages': '[["__json_message",0,20,"Saved"]]'},
+            {'prisoner_dob': '0999-01-01', 'amount': '200.00'},
+        ]
+        for case in cases:
+            self.assertEqual(serializer.loads(serializer.dumps(case)), case)
+
+    def test_values_that_cannot_be_packed_are_kept(self):
+        serializer = CompactSessionSerializer()
+        cases = [
+            {'prisoner_dob': '1992-02-30'},
+            {'prisoner_dob': '5/12/1992'},
+            {'prisoner_dob': None},
+            {'amount': '017.50'},
+            {'amount': '17.5'},
+            {'amount': 17.5},
+            {'prisoner_name': ['James', 'Halls']},
+        ]
+        for case in cases:
+            self.assertEqual(serializer.loads(serializer.dumps(case)), case)
+
+    def test_json_sessions_can_be_read(self):
+        cookie = signing.dumps(self.session_data, salt=SALT, serializer=signing.JSONSerializer, compress=True)
+        self.assertEqual(signing.loads(cookie, salt=SALT, serializer=CompactSessionSerializer), self.session_data)
+
+    def test_unknown_version_rejected(self):
+        with self.assertRaises(ValueError):
+            CompactSessionSerializer().loads(b'\x7f\x01')
+
+    def test_cookie_is_smaller(self):
+        json_cookie = signing.dumps(self.session_data, salt=SALT, serializer=signing.JSONSerializer, compress=True)
+        compact_cookie = signing.dumps(self.session_data, salt=SALT, serializer=CompactSessionSerializer, compress=True)
+        self.assertLess(len(compact_cookie), len(json_cookie) * 0.6)
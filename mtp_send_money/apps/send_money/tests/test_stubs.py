@@ -0,0 +1,116 @@
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from mtp_common.api import retrieve_all_pages_for_path
+import requests
+
+from send_money.payments import GovUkPaymentStatus, PaymentClient
+from send_money.stubs import GovUkPayStubHandler, MTPAPIStubHandler, StubBehaviour, StubDataset, start_stub_server
+from send_money.utils import get_api_session
+
+
+class StubServersTestCase(SimpleTestCase):
+    def start_servers(self, dataset=None, behaviour=None):
+        dataset = dataset or StubDataset(prisoners=30, prisons=25, seed=1)
+        behaviour = behaviour or StubBehaviour()
+        servers = []
+        for handler_class in (MTPAPIStubHandler, GovUkPayStubHandler):
+            server = start_stub_server(handler_class, dataset, behaviour, host='127.0.0.1')
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            servers.append(server)
+        settings_override = override_settings(API_URL=servers[0].url, GOVUK_PAY_URL=servers[1].url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return dataset
+
+    def test_card_payment_flow(self):
+        self.start_servers()
+        payment_client = PaymentClient()
+        payment_ref = payment_client.create_payment({
+            'amount': 1700,
+            'service_charge': 0,
+            'recipient_name': 'John',
+            'prisoner_number': 'A0001AA',
+            'prisoner_dob': '1970-01-02',
+        })
+        govuk_payment = payment_client.create_govuk_payment(payment_ref, {
+            'delayed_capture': True,
+            'amount': 1700,
+            'reference': payment_ref,
+            'description': 'To this prisoner: A0001AA',
+            'return_url': f'http://localhost/confirmation/?payment_ref={payment_ref}',
+        })
+        govuk_id = govuk_payment['payment_id']
+        self.assertEqual(payment_client.get_payment(payment_ref)['processor_id'], govuk_id)
+
+        response = requests.get(govuk_payment['_links']['next_url']['href'], allow_redirects=False)
+        self.assertEqual(response.headers['Location'], f'http://localhost/confirmation/?payment_ref={payment_ref}')
+
+        payment = payment_client.get_payment(payment_ref)
+        govuk_payment = payment_client.get_govuk_payment(govuk_id)
+        self.assertEqual(govuk_payment['state']['status'], 'capturable')
+        self.assertEqual(
+            payment_client.complete_payment_if_necessary(payment, govuk_payment),
+            GovUkPaymentStatus.success,
+        )
+        self.assertEqual(payment_client.get_payment(payment_ref)['email'], 'sender@outside.local')
+        self.assertEqual(payment_client.get_govuk_payment(govuk_id)['state']['status'], 'success')
+        self.assertEqual(
+            [event['state']['status'] for event in payment_client.get_govuk_payment_events(govuk_id)],
+            ['created', 'capturable', 'success'],
+        )
+
+    def test_bulk_payment_updates(self):
+        dataset = self.start_servers()
+        payment_client = PaymentClient()
+        payment_refs = [
+            payment_client.create_payment({'amount': 100 * index, 'prisoner_number': 'A0001AA'})
+            for index in range(1, 3)
+        ]
+        results = payment_client.update_payments({
+            payment_refs[0]: {'status': 'taken'},
+            payment_refs[1]: {'status': 'unknown'},
+            'missing': {'status': 'taken'},
+        })
+        self.assertEqual(results[payment_refs[0]]['status'], 'taken')
+        self.assertEqual(results[payment_refs[1]].errors, {'status': ['"unknown" is not a valid choice.']})
+        self.assertEqual(results['missing'].errors, {'uuid': ['Not found.']})
+        self.assertEqual(dataset.payments[payment_refs[1]]['status'], 'pending')
+
+    def test_prisoner_lookups(self):
+        dataset = self.start_servers()
+        session = get_api_session()
+        prisoner = dataset.get_prisoner(3)
+        self.assertEqual(session.get('/prisoner_validity/', params=prisoner).json()['count'], 1)
+        self.assertEqual(session.get('/prisoner_validity/', params={
+            'prisoner_number': prisoner['prisoner_number'], 'prisoner_dob': '1970-01-01',
+        }).json()['count'], 0)
+        response = session.get('/prisoner_validity/', params=dict(prisoner, prisons='S00,S01'))
+        self.assertEqual(response.json()['count'], 0)
+        balance = session.get(f'/prisoner_account_balances/{prisoner["prisoner_number"]}').json()
+        self.assertIsInstance(balance['combined_account_balance'], int)
+        self.assertEqual(len(retrieve_all_pages_for_path(session, '/prisons/')), 25)
+
+    def test_incomplete_payments(self):
+        self.start_servers(dataset=StubDataset(prisoners=5, prisons=1, payments=7))
+        payments = PaymentClient().get_incomplete_payments()
+        self.assertEqual(len(payments), 7)
+        govuk_payment = PaymentClient().get_govuk_payment(payments[0]['processor_id'])
+        self.assertEqual(govuk_payment['state']['status'], 'success')
+        self.assertIn('captured_date', govuk_payment['settlement_summary'])
+
+    def test_latency_and_errors(self):
+        self.start_servers(behaviour=StubBehaviour(latency=0.2, jitter=0.1, error_rate=1))
+        with mock.patch('send_money.stubs.time.sleep') as mocked_sleep:
+            response = requests.get(f'{settings.GOVUK_PAY_URL}/payments/1')
+        self.assertEqual(response.status_code, 503)
+        delay = mocked_sleep.call_args[0][0]
+        self.assertTrue(0.1 <= delay <= 0.3)
+
+    def test_behaviour_validated(self):
+        with self.assertRaises(ValueError):
+            StubBehaviour(error_rate=2)
+        with self.assertRaises(ValueError):
+            StubDataset(prisoners=0)
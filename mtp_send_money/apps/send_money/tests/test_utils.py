@@ -1,20 +1,30 @@
 import datetime
 from decimal import Decimal
 from functools import partial
+import itertools
+import json
+import math
 import unittest
+from unittest import mock
 
 from django.core.exceptions import ValidationError
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase
 from django.test.utils import override_settings
+from django.utils import translation
 from requests.exceptions import Timeout
 import responses
 
+from send_money.templatetags.send_money import render_card_acceptance_signage
 from send_money.utils import (
     serialise_amount, unserialise_amount,
     serialise_date, unserialise_date, lenient_unserialise_date,
     format_percentage, currency_format, currency_format_pence,
-    clamp_amount, get_service_charge, get_total_charge,
+    clamp_amount, get_service_charge, get_total_charge, get_service_charge_spec,
     RejectCardNumberValidator, validate_prisoner_number,
     api_url, check_payment_service_available,
+    get_help_url, get_support_links,
 )
 
 
@@ -289,6 +299,38 @@ class ServiceChargeTestCase(BaseEqualityTestCase):
                                 ' with both service charges')
 
 
+class ServiceChargeSpecTestCase(unittest.TestCase):
+    def calculate_like_browser(self, spec, pence):
+        numerator = pence * spec['percentageFactor'] + spec['fixedTerm']
+        tenths_of_pennies = (numerator - numerator % spec['denominator']) / spec['denominator']
+        return math.ceil(tenths_of_pennies / 10)
+
+    def test_spec_matches_server_calculation(self):
+        for percentage, fixed in [('0', '0'), ('2.4', '0'), ('0', '0.20'), ('2.4', '0.20'), ('1.375', '0.125')]:
+            with override_settings(SERVICE_CHARGE_PERCENTAGE=Decimal(percentage),
+                                   SERVICE_CHARGE_FIXED=Decimal(fixed)):
+                spec = json.loads(get_service_charge_spec())
+                self.assertEqual(spec['version'], 1)
+                self.assertGreaterEqual(spec['maxPence'], 20000)
+                for pence in itertools.chain(range(1, 20001), [spec['maxPence']]):
+                    self.assertEqual(
+                        self.calculate_like_browser(spec, pence),
+                        int(get_service_charge(Decimal(pence) / 100) * 100),
+                        msg=f'Charge on {pence}p with {percentage}% + £{fixed} differs',
+                    )
+
+    @override_settings(SERVICE_CHARGE_PERCENTAGE=Decimal('-1'),
+                       SERVICE_CHARGE_FIXED=Decimal('0'))
+    def test_spec_without_calculation_if_not_supported(self):
+        self.assertDictEqual(json.loads(get_service_charge_spec()), {'version': 1})
+
+    def test_spec_changes_with_settings(self):
+        with override_settings(SERVICE_CHARGE_PERCENTAGE=Decimal('2.4'), SERVICE_CHARGE_FIXED=Decimal('0')):
+            spec = get_service_charge_spec()
+        with override_settings(SERVICE_CHARGE_PERCENTAGE=Decimal('2.5'), SERVICE_CHARGE_FIXED=Decimal('0')):
+            self.assertNotEqual(get_service_charge_spec(), spec)
+
+
 class ValidationTestCase(unittest.TestCase):
     def test_valid_prisoner_number_validation(self):
         validate_prisoner_number('A1234AB')
@@ -367,3 +409,36 @@ class PaymentServiceAvailabilityTestCase(unittest.TestCase):
             available, message_to_users = check_payment_service_available()
         self.assertFalse(available)
         self.assertEqual(message_to_users, 'Scheduled downtime')
+
+
+class CachedLinksTestCase(unittest.TestCase):
+    def test_support_links_follow_language(self):
+        with translation.override('en-gb'):
+            english_links = get_support_links()
+            self.assertEqual(english_links[0]['url'], '/en-gb/terms/')
+            self.assertEqual(english_links[0]['title'], 'Terms and conditions')
+            self.assertIs(get_support_links(), english_links)
+        with translation.override('cy'):
+            welsh_links = get_support_links()
+            self.assertEqual(welsh_links[0]['url'], '/cy/terms/')
+        self.assertIsNot(welsh_links, english_links)
+
+    def test_help_url_follows_site_url(self):
+        with translation.override('en-gb'):
+            with override_settings(SITE_URL='http://localhost:8004/'):
+                self.assertEqual(get_help_url(), 'http://localhost:8004/en-gb/help/')
+            with override_settings(SITE_URL='https://send-money.service.gov.uk/'):
+                self.assertEqual(get_help_url(), 'https://send-money.service.gov.uk/en-gb/help/')
+
+
+class CardAcceptanceSignageTestCase(SimpleTestCase):
+    def test_signage_rendered_once_per_width(self):
+        render_card_acceptance_signage.cache_clear()
+        self.addCleanup(render_card_acceptance_signage.cache_clear)
+        template = Template('{% load send_money %}{% card_acceptance_signage width=160 %}')
+        with mock.patch('send_money.templatetags.send_money.render_to_string', wraps=render_to_string) as render:
+            first_render = template.render(Context())
+            second_render = template.render(Context())
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first_render, second_render)
+        self.assertIn('width="160" height="146"', first_render)
@@ -1,23 +1,32 @@
+from concurrent.futures import Future
 import datetime
 from decimal import Decimal
 import json
 import logging
+import threading
 from unittest import mock
 
+from django.conf import settings
 from django.core import mail
 from django.test import override_settings
 from django.test.testcases import SimpleTestCase
 from django.urls import reverse, reverse_lazy
+from django.utils import translation
 from mtp_common.test_utils import silence_logger
 from requests import ConnectionError
 import responses
 
+from send_money.deadlines import DeadlineExceeded
 from send_money.models import PaymentMethodBankTransferEnabled as PaymentMethod
 from send_money.tests import (
     BaseTestCase, mock_auth,
     patch_notifications, patch_gov_uk_pay_availability_check,
 )
-from send_money.views import should_be_capture_delayed
+from send_money.views import (
+    UserAgreementView, PaymentMethodChoiceView, DebitCardPrisonerDetailsView,
+    DebitCardAmountView, DebitCardCheckView, DebitCardPaymentView, DebitCardConfirmationView,
+    build_view_url, should_be_capture_delayed,
+)
 from send_money.utils import api_url, govuk_url, get_api_session
 
 
@@ -315,6 +324,8 @@ class DebitCardAmountTestCase(DebitCardFlowTestCase):
 
         self.assertContains(response, '2.5%')
         self.assertContains(response, '21p')
+        # the specification is included in the page so charges can be shown without further requests
+        self.assertContains(response, 'data-charge-spec="{&quot;denominator&quot;:')
 
     @override_settings(SERVICE_CHARGE_PERCENTAGE=Decimal('0'),
                        SERVICE_CHARGE_FIXED=Decimal('0'))
@@ -471,6 +482,24 @@ class DebitCardAmountTestCase(DebitCardFlowTestCase):
             self.assertEqual(self.client.session.get('amount'), '55.50')
 
 
+class JourneyTestCase(SimpleTestCase):
+    def test_previous_views(self):
+        self.assertEqual(UserAgreementView.previous_views, ())
+        self.assertEqual(DebitCardPaymentView.previous_views, (
+            UserAgreementView, PaymentMethodChoiceView, DebitCardPrisonerDetailsView,
+            DebitCardAmountView, DebitCardCheckView,
+        ))
+
+    def test_view_urls_reversed_per_language(self):
+        request = mock.Mock(resolver_match=mock.Mock(namespace='send_money'))
+        with translation.override('en-gb'):
+            self.assertEqual(build_view_url(request, 'check_details'), '/en-gb/debit-card/check/')
+        with translation.override('cy'):
+            self.assertEqual(build_view_url(request, 'check_details'), '/cy/debit-card/check/')
+        with translation.override('en-gb'):
+            self.assertEqual(build_view_url(request, 'check_details'), '/en-gb/debit-card/check/')
+
+
 @patch_notifications()
 @patch_gov_uk_pay_availability_check()
 class DebitCardCheckTestCase(DebitCardFlowTestCase):
@@ -566,6 +595,7 @@ class DebitCardPaymentTestCase(DebitCardFlowTestCase):
                 response, govuk_url(self.payment_process_path),
                 fetch_redirect_response=False
             )
+        self.assertEqual(self.client.session['processor_id'], processor_id)
 
     @mock.patch('send_money.views.should_be_capture_delayed', mock.Mock(return_value=True))
     def test_debit_card_payment_with_delayed_capture(self):
@@ -708,7 +738,7 @@ class DebitCardConfirmationTestCase(DebitCardFlowTestCase):
 
         with self.patch_prisoner_details_check(), self.patch_prisoner_balance_check():
             self.client.get(self.url, data={'payment_ref': '../service-availability/'})
-        mocked_api_session.get.assert_called_with('/payments/..%2Fservice-availability%2F/')
+        mocked_api_session.get.assert_called_with('/payments/..%2Fservice-availability%2F/', timeout=mock.ANY)
 
     @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
     def test_success_confirmation(self):
@@ -768,6 +798,103 @@ class DebitCardConfirmationTestCase(DebitCardFlowTestCase):
 
         self.assertEqual(len(mail.outbox), 0)
 
+    def set_session_processor_id(self, processor_id):
+        session = self.client.session
+        session['processor_id'] = processor_id
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+    def get_confirmation_looking_up_govuk_payment_on_threads(self, session_processor_id):
+        self.choose_debit_card_payment_method()
+        self.fill_in_prisoner_details()
+        self.fill_in_amount()
+        self.set_session_processor_id(session_processor_id)
+
+        govuk_lookup_threads = {}
+
+        def govuk_payment_callback(request):
+            govuk_lookup_threads[request.url.rstrip('/').rsplit('/', 1)[-1]] = threading.current_thread().name
+            return 200, {}, json.dumps({
+                'reference': self.ref,
+                'state': {'status': 'success'},
+                'email': 'sender@outside.local',
+                'settlement_summary': {
+                    'capture_submit_time': None,
+                    'captured_date': None,
+                },
+            })
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url(f'/payments/{self.ref}/'),
+                json=self.payment_data,
+                status=200,
+            )
+            for processor_id in {self.processor_id, session_processor_id}:
+                rsps.add_callback(
+                    rsps.GET,
+                    govuk_url(f'/payments/{processor_id}/'),
+                    callback=govuk_payment_callback,
+                    content_type='application/json',
+                )
+            rsps.add(
+                rsps.PATCH,
+                api_url(f'/payments/{self.ref}/'),
+                json={
+                    **self.payment_data,
+                    'email': 'sender@outside.local',
+                },
+                status=200,
+            )
+            with self.patch_prisoner_details_check(), self.patch_prisoner_balance_check():
+                response = self.client.get(
+                    self.url,
+                    {'payment_ref': self.ref},
+                    follow=False,
+                )
+        self.assertContains(response, 'success')
+        return govuk_lookup_threads
+
+    def test_govuk_payment_looked_up_alongside_mtp_payment(self):
+        """
+        Test that if the GOV.UK payment id is known from the session, it is looked up on another thread
+        """
+        govuk_lookup_threads = self.get_confirmation_looking_up_govuk_payment_on_threads(self.processor_id)
+        self.assertEqual(len(govuk_lookup_threads), 1)
+        self.assertTrue(govuk_lookup_threads[self.processor_id].startswith('lookup'))
+
+    def test_govuk_payment_looked_up_again_if_session_does_not_match(self):
+        """
+        Test that if the GOV.UK payment id in the session is not the one linked to the MTP payment,
+        the linked GOV.UK payment is looked up instead
+        """
+        govuk_lookup_threads = self.get_confirmation_looking_up_govuk_payment_on_threads('4')
+        self.assertEqual(govuk_lookup_threads[self.processor_id], threading.current_thread().name)
+
+    def test_waiting_for_govuk_payment_lookup_limited_by_deadline(self):
+        """
+        Test that waiting for a GOV.UK payment lookup running on another thread stops when the request has no time left
+        """
+        view = DebitCardConfirmationView()
+        view.govuk_payment_lookup = self.processor_id, Future()
+        with mock.patch('send_money.views.get_remaining_time', return_value=0.01), \
+                self.assertRaises(DeadlineExceeded):
+            view.get_govuk_payment(mock.Mock(), self.processor_id)
+
+    @override_settings(GOVUK_PAY_TIMEOUT=0.01)
+    def test_waiting_for_govuk_payment_lookup_limited_without_deadline(self):
+        """
+        Test that waiting for a GOV.UK payment lookup running on another thread is limited by the lookup's timeout
+        when the request has no deadline
+        """
+        view = DebitCardConfirmationView()
+        view.govuk_payment_lookup = self.processor_id, Future()
+        with mock.patch('send_money.views.get_remaining_time', return_value=None), \
+                self.assertRaises(DeadlineExceeded):
+            view.get_govuk_payment(mock.Mock(), self.processor_id)
+
     @override_settings(ENVIRONMENT='prod')  # because non-prod environments don't send to @outside.local
     def test_automatically_captures_payment(self):
         """
@@ -4,6 +4,7 @@ from xml.etree import ElementTree
 
 from django.conf import settings
 from django.test import override_settings
+from django.test.utils import override_script_prefix
 from django.urls import reverse, reverse_lazy
 from django.utils.cache import get_max_age
 from django.utils.translation import override as override_lang
@@ -145,6 +146,15 @@ class PlainViewTestCase(BaseTestCase):
                 response = self.client.get(reverse(view_name))
                 self.assertGreaterEqual(get_max_age(response), 3600, msg=f'{view_name} should be cacheable')
 
+    def test_cached_footer_links_follow_script_prefix(self):
+        terms_url = reverse('terms')
+        privacy_url = reverse('privacy')
+        response = self.client.get(privacy_url)
+        self.assertContains(response, f'href="{terms_url}"')
+        with override_script_prefix('/send-money/'):
+            response = self.client.get(privacy_url)
+        self.assertContains(response, f'href="/send-money{terms_url}"')
+
     def test_feedback_views_are_uncacheable(self):
         view_names = [
             'help_area:submit_ticket', 'help_area:feedback_success',
@@ -0,0 +1,77 @@
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from django.urls import get_resolver
+from requests.exceptions import ConnectionError
+
+from send_money.forms import DebitCardAmountForm, PrisonerDetailsForm
+from send_money.utils import _cached_reverse
+from send_money.warmup import (
+    compile_templates, connect_to_api, freeze_objects, iter_url_names, load_prison_list, resolve_urls,
+    warm_up, warm_up_worker,
+)
+
+
+class WarmUpTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for form_class in (PrisonerDetailsForm, DebitCardAmountForm):
+            self.addCleanup(setattr, form_class, 'shared_api_session', None)
+
+    def test_url_names_found(self):
+        url_names = set(iter_url_names(get_resolver().url_patterns))
+        self.assertIn('terms', url_names)
+        self.assertIn('send_money:send_money_debit', url_names)
+        self.assertIn('help_area:help', url_names)
+
+    def test_urls_resolved_in_each_language(self):
+        _cached_reverse.cache_clear()
+        count = resolve_urls()
+        self.assertGreater(count, 0)
+        self.assertEqual(_cached_reverse.cache_info().currsize, count)
+
+    def test_templates_compiled(self):
+        with mock.patch('django.template.engine.Engine.get_template') as mocked_get_template:
+            count = compile_templates()
+        template_names = {call[0][0] for call in mocked_get_template.call_args_list}
+        self.assertEqual(len(template_names), count)
+        self.assertIn('send_money/debit-card-amount.html', template_names)
+        self.assertIn('help_area/help.html', template_names)
+
+    def test_connections_opened(self):
+        with mock.patch('send_money.forms.get_api_session') as mocked_get_api_session:
+            self.assertEqual(connect_to_api(), 2)
+        self.assertEqual(mocked_get_api_session.call_count, 2)
+        self.assertIsNotNone(PrisonerDetailsForm.shared_api_session)
+        self.assertIsNotNone(DebitCardAmountForm.shared_api_session)
+
+    def test_connection_errors_do_not_stop_warm_up(self):
+        with mock.patch('send_money.forms.get_api_session', side_effect=ConnectionError), \
+                self.assertLogs('mtp', level='WARNING'):
+            self.assertEqual(connect_to_api(), 0)
+
+    def test_objects_frozen(self):
+        with mock.patch('gc.freeze') as mocked_freeze:
+            freeze_objects()
+        mocked_freeze.assert_called_once_with()
+
+    @mock.patch('gc.freeze')
+    @mock.patch('help_area.views.PrisonListView.get_prison_list', return_value=['HMP Prison'])
+    def test_warm_up_reports_duration(self, *_):
+        with mock.patch('send_money.forms.get_api_session'), self.assertLogs('mtp', level='INFO') as logs:
+            self.assertGreater(warm_up(), 0)
+            self.assertGreater(warm_up_worker(), 0)
+        self.assertIn('Warmed up application', logs.output[0])
+        self.assertIn('compile_templates', logs.output[0])
+        self.assertIn('Warmed up worker', logs.output[1])
+        self.assertIn('load_prison_list: 1 in', logs.output[1])
+
+    @override_settings(WARM_UP_API_TIMEOUT=0.01)
+    def test_slow_prison_list_does_not_hold_up_warm_up(self):
+        loading = threading.Event()
+        self.addCleanup(loading.set)
+        with mock.patch('help_area.views.PrisonListView.get_prison_list',
+                        side_effect=lambda: loading.wait() and []), \
+                self.assertLogs('mtp', level='WARNING'):
+            self.assertEqual(load_prison_list(), 0)
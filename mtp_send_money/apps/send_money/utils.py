@@ -1,23 +1,32 @@
 import datetime
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
+import functools
+import json
 import logging
 import re
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.signals import setting_changed
 from django.core.validators import RegexValidator
+from django.dispatch import receiver
+from django.urls import get_script_prefix, reverse
 from django.utils import formats
 from django.utils.cache import patch_cache_control
 from django.utils.dateformat import format as format_date
 from django.utils.dateparse import parse_date
 from django.utils.encoding import force_text
-from django.utils.translation import gettext_lazy as _
+from django.utils.translation import get_language, gettext, gettext_lazy as _
 from django.views.generic import TemplateView
 from mtp_common.auth import api_client, urljoin
 import requests
 from requests.exceptions import Timeout
 
+from send_money.circuit_breakers import CircuitOpenError, mtp_api_circuit_breaker
+from send_money.deadlines import timed_call
+
 logger = logging.getLogger('mtp')
+SERVICE_CHARGE_SPEC_VERSION = 1
 prisoner_number_re = re.compile(r'^[a-z]\d\d\d\d[a-z]{2}$', re.IGNORECASE)
 
 
@@ -31,10 +40,13 @@ def get_api_session():
 def check_payment_service_available():
     # service is deemed unavailable only if status is explicitly false, not if it cannot be determined
     try:
-        response = requests.get(api_url('/service-availability/'), timeout=5)
+        response = mtp_api_circuit_breaker().call(
+            timed_call, 'mtp_api', settings.SERVICE_AVAILABILITY_TIMEOUT,
+            requests.get, api_url('/service-availability/'),
+        )
         gov_uk_status = response.json().get('gov_uk_pay', {})
         return gov_uk_status.get('status', True), gov_uk_status.get('message_to_users')
-    except (Timeout, ValueError):
+    except (CircuitOpenError, Timeout, ValueError):
         return True, None
 
 
@@ -59,6 +71,82 @@ def format_percentage(number, decimals=1, trim_zeros=True):
     return percentage_text + '%'
 
 
+class ServiceCharge:
+    """
+    Service charge parameters precomputed from settings as integers so that charges on whole pence amounts
+    can be calculated with integer arithmetic; results are identical to `get_service_charge`
+    """
+    __slots__ = ('percentage_factor', 'fixed_term', 'denominator')
+
+    # limits within which the Decimal calculation is exact and so the integer one matches it
+    max_pence = 10 ** 10
+    max_parameter = Decimal('10000')
+    max_parameter_places = 6
+
+    def __init__(self, percentage, fixed):
+        percentage_numerator, percentage_denominator = percentage.as_integer_ratio()
+        fixed_numerator, fixed_denominator = fixed.as_integer_ratio()
+        # charge in tenths of pennies = (pence * percentage_factor + fixed_term) / denominator
+        self.percentage_factor = percentage_numerator * fixed_denominator
+        self.fixed_term = 10000 * fixed_numerator * percentage_denominator
+        self.denominator = 10 * percentage_denominator * fixed_denominator
+
+    @classmethod
+    def from_settings(cls):
+        """
+        @return: ServiceCharge or None if the settings cannot be used with integer arithmetic
+        """
+        percentage, fixed = settings.SERVICE_CHARGE_PERCENTAGE, settings.SERVICE_CHARGE_FIXED
+        for parameter in (percentage, fixed):
+            if not isinstance(parameter, Decimal) or not parameter.is_finite() or \
+                    parameter < 0 or parameter >= cls.max_parameter or \
+                    -parameter.as_tuple().exponent > cls.max_parameter_places:
+                return None
+        return cls(percentage, fixed)
+
+    def get_spec(self):
+        """
+        Parameters for calculating the charge in the browser with the same integer arithmetic;
+        amounts are limited so that intermediate values are exact in javascript numbers
+        """
+        max_safe_integer = 2 ** 53 - 1
+        return {
+            'percentageFactor': self.percentage_factor,
+            'fixedTerm': self.fixed_term,
+            'denominator': self.denominator,
+            'maxPence': min(
+                self.max_pence - 1,
+                (max_safe_integer - self.fixed_term) // max(self.percentage_factor, 1),
+            ),
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def get_service_charge_parameters():
+    return ServiceCharge.from_settings()
+
+
+@functools.lru_cache(maxsize=None)
+def get_service_charge_spec():
+    """
+    Versioned service charge specification as compact JSON, generated once from settings
+    and included in the amount page so that the browser shows charges exactly as calculated on the server
+    """
+    spec = {'version': SERVICE_CHARGE_SPEC_VERSION}
+    parameters = get_service_charge_parameters()
+    if parameters is not None:
+        # otherwise the browser does not show charges as it cannot calculate them exactly
+        spec.update(parameters.get_spec())
+    return json.dumps(spec, separators=(',', ':'), sort_keys=True)
+
+
+@receiver(setting_changed)
+def clear_service_charge_parameters(*, setting, **kwargs):
+    if setting in ('SERVICE_CHARGE_PERCENTAGE', 'SERVICE_CHARGE_FIXED'):
+        get_service_charge_parameters.cache_clear()
+        get_service_charge_spec.cache_clear()
+
+
 def currency_format(amount, trim_empty_pence=False):
     """
     Formats a number into currency format
@@ -170,6 +258,64 @@ def site_url(path):
     return urljoin(settings.SITE_URL, path)
 
 
+@functools.lru_cache(maxsize=None)
+def _cached_reverse(url_name, language, script_prefix):
+    return reverse(url_name)
+
+
+def cached_reverse(url_name):
+    """
+    Reverses a url name without arguments once per process for each language and script prefix
+    as these determine the url in i18n patterns
+    """
+    return _cached_reverse(url_name, get_language(), get_script_prefix())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_support_links(language, script_prefix):
+    return (
+        {
+            'url': cached_reverse('terms'),
+            'title': gettext('Terms and conditions'),
+        },
+        {
+            'url': cached_reverse('cookies'),
+            'title': gettext('Cookies'),
+        },
+        {
+            'url': cached_reverse('help_area:help'),
+            'title': gettext('Help'),
+        },
+    )
+
+
+def get_support_links():
+    """
+    Returns the footer links translated into the active language; built once per process for each language
+    """
+    return _get_support_links(get_language(), get_script_prefix())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_help_url(language, script_prefix):
+    return site_url(cached_reverse('help_area:help'))
+
+
+def get_help_url():
+    """
+    Returns the absolute url of the help page in the active language
+    """
+    return _get_help_url(get_language(), get_script_prefix())
+
+
+@receiver(setting_changed)
+def clear_url_caches(*, setting, **kwargs):
+    if setting in ('ROOT_URLCONF', 'LANGUAGES', 'LANGUAGE_CODE', 'LOCALE_PATHS', 'SITE_URL'):
+        _cached_reverse.cache_clear()
+        _get_support_links.cache_clear()
+        _get_help_url.cache_clear()
+
+
 def get_link_by_rel(data, rel):
     if rel in data['_links']:
         return data['_links'][rel]['href']
@@ -1,32 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import decimal
 import logging
 import random
+import threading
 
 from django.conf import settings
 from django.http import HttpResponseBadRequest
 from django.shortcuts import redirect, render
-from django.urls import reverse
 from django.utils.translation import gettext, gettext_lazy as _
 from django.views.generic import FormView, TemplateView, View
 from oauthlib.oauth2 import OAuth2Error
 from requests.exceptions import RequestException
 
 from send_money import forms as send_money_forms
+from send_money.deadlines import DeadlineExceeded, bind_deadline, get_remaining_time
 from send_money.exceptions import GovUkPaymentStatusException
 from send_money.models import PaymentMethodBankTransferEnabled as PaymentMethod
 from send_money.payments import is_active_payment, GovUkPaymentStatus, PaymentClient
 from send_money.utils import (
+    cached_reverse,
     get_link_by_rel,
+    get_service_charge_spec,
     get_service_charge,
     site_url,
 )
 
 logger = logging.getLogger('mtp')
 
+lookup_executor = None
+lookup_executor_lock = threading.Lock()
+
 
 def build_view_url(request, url_name):
     url_name = '%s:%s' % (request.resolver_match.namespace, url_name)
-    return reverse(url_name)
+    return cached_reverse(url_name)
 
 
 def clear_session_view(request):
@@ -38,6 +45,22 @@ def clear_session_view(request):
     return redirect(build_view_url(request, UserAgreementView.url_name))
 
 
+def submit_lookup(func, *args):
+    """
+    Starts an upstream lookup in a background thread under the current request's deadline
+    so that it can proceed alongside other lookups that it does not depend on
+    """
+    global lookup_executor
+
+    if lookup_executor is None:
+        with lookup_executor_lock:
+            if lookup_executor is None:
+                lookup_executor = ThreadPoolExecutor(
+                    max_workers=settings.LOOKUP_THREADS, thread_name_prefix='lookup',
+                )
+    return lookup_executor.submit(bind_deadline(func), *args)
+
+
 def get_payment_delayed_capture_rollout_percentage():
     """
     TODO: remove following delayed capture release
@@ -79,13 +102,16 @@ def should_be_capture_delayed():
 
 class SendMoneyView(View):
     previous_view = None
+    # all the views that come before this one, first to last; derived from previous_view when the class is defined
+    previous_views = ()
     payment_method = None
 
-    @classmethod
-    def get_previous_views(cls, view):
-        if view.previous_view:
-            yield from cls.get_previous_views(view.previous_view)
-            yield view.previous_view
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.previous_view:
+            cls.previous_views = getattr(cls.previous_view, 'previous_views', ()) + (cls.previous_view,)
+        else:
+            cls.previous_views = ()
 
     @classmethod
     def is_service_charged(cls):
@@ -100,7 +126,7 @@ class SendMoneyView(View):
         self.valid_form_data = {}
 
     def dispatch(self, request, *args, **kwargs):
-        for view in self.get_previous_views(self):
+        for view in self.previous_views:
             if not hasattr(view, 'form_class') or not view.is_form_enabled():
                 continue
             form = view.form_class.unserialise_from_session(request)
@@ -122,13 +148,12 @@ class SendMoneyFormView(SendMoneyView, FormView):
         return True
 
     def get_context_data(self, **kwargs):
-        context_data = super().get_context_data(**kwargs)
-        if self.request.method == 'GET':
+        if self.request.method == 'GET' and 'form' not in kwargs:
             form = self.form_class.unserialise_from_session(self.request)
             if form.is_valid():
-                # valid form found in session so restore it
-                context_data['form'] = form
-        return context_data
+                # valid form found in session so restore it instead of building a blank one
+                kwargs['form'] = form
+        return super().get_context_data(**kwargs)
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
@@ -204,6 +229,7 @@ class DebitCardAmountView(DebitCardFlow, SendMoneyFormView):
             kwargs.update({
                 'service_charge_percentage': settings.SERVICE_CHARGE_PERCENTAGE,
                 'service_charge_fixed': settings.SERVICE_CHARGE_FIXED,
+                'service_charge_spec': get_service_charge_spec(),
                 'sample_amount': 20,  # in pounds
             })
         return super().get_context_data(**kwargs)
@@ -284,6 +310,8 @@ class DebitCardPaymentView(DebitCardFlow):
 
             govuk_payment = payment_client.create_govuk_payment(payment_ref, new_govuk_payment)
             if govuk_payment:
+                # allows confirmation view to look up GOV.UK payment without waiting for MTP payment
+                request.session['processor_id'] = govuk_payment['payment_id']
                 return redirect(get_link_by_rel(govuk_payment, 'next_url'))
         except OAuth2Error:
             logger.exception('Authentication error')
@@ -299,6 +327,7 @@ class DebitCardConfirmationView(TemplateView):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.status = GovUkPaymentStatus.error
+        self.govuk_payment_lookup = None
 
     def get_template_names(self):
         if self.status == GovUkPaymentStatus.success:
@@ -307,12 +336,47 @@ class DebitCardConfirmationView(TemplateView):
             return ['send_money/debit-card-on-hold.html']
         return ['send_money/debit-card-error.html']
 
+    def start_govuk_payment_lookup(self):
+        """
+        Starts checking gov.uk payment status alongside the MTP payment if its id is known from the session.
+        NB: a lookup already running cannot be stopped so GOV.UK Pay is still called if the MTP payment
+        turns out to be taken or no longer active; this is rare because the id is only in the session
+        of a sender returning from GOV.UK Pay, before the payment is completed
+        """
+        processor_id = self.request.session.get('processor_id')
+        if processor_id:
+            self.govuk_payment_lookup = processor_id, submit_lookup(PaymentClient().get_govuk_payment, processor_id)
+
+    def get_govuk_payment(self, payment_client, govuk_id):
+        """
+        Returns the result of the lookup already started if it was for the MTP payment's processor_id
+        waiting no longer than the request's remaining time or, without a deadline, the lookup's own timeout
+        """
+        if self.govuk_payment_lookup:
+            processor_id, future = self.govuk_payment_lookup
+            if processor_id == govuk_id:
+                timeout = get_remaining_time()
+                if timeout is None:
+                    timeout = settings.GOVUK_PAY_TIMEOUT
+                try:
+                    return future.result(timeout=timeout)
+                except FutureTimeoutError:
+                    raise DeadlineExceeded('GOV.UK Pay lookup did not finish in time')
+        return payment_client.get_govuk_payment(govuk_id)
+
+    def cancel_govuk_payment_lookup(self):
+        # not needed if MTP payment was already taken or is not valid
+        if self.govuk_payment_lookup:
+            self.govuk_payment_lookup[1].cancel()
+
     def get(self, request, *args, **kwargs):
         payment_ref = self.request.GET.get('payment_ref')
         if not payment_ref:
             return clear_session_view(request)
         kwargs['short_payment_ref'] = payment_ref[:8].upper()
         try:
+            self.start_govuk_payment_lookup()
+
             # check payment status
             payment_client = PaymentClient()
             payment = payment_client.get_payment(payment_ref)
@@ -337,7 +401,7 @@ class DebitCardConfirmationView(TemplateView):
             else:
                 # check gov.uk payment status
                 govuk_id = payment['processor_id']
-                govuk_payment = payment_client.get_govuk_payment(govuk_id)
+                govuk_payment = self.get_govuk_payment(payment_client, govuk_id)
 
                 self.status = payment_client.complete_payment_if_necessary(payment, govuk_payment)
 
@@ -392,6 +456,8 @@ class DebitCardConfirmationView(TemplateView):
         except GovUkPaymentStatusException:
             logger.exception('GOV.UK Pay returned unexpected status for ref %s', payment_ref)
             self.status = GovUkPaymentStatus.error
+        finally:
+            self.cancel_govuk_payment_lookup()
 
         response = super().get(request, *args, **kwargs)
         request.session.flush()
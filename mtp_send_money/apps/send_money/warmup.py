@@ -0,0 +1,147 @@
+import gc
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.template import engines
+from django.urls import NoReverseMatch, URLResolver, get_resolver
+from django.utils import translation
+from oauthlib.oauth2 import OAuth2Error
+from requests.exceptions import RequestException
+
+from send_money.utils import cached_reverse
+
+logger = logging.getLogger('mtp')
+
+
+def iter_url_names(url_patterns, namespace=None):
+    for url_pattern in url_patterns:
+        if isinstance(url_pattern, URLResolver):
+            if url_pattern.namespace:
+                sub_namespace = f'{namespace}:{url_pattern.namespace}' if namespace else url_pattern.namespace
+            else:
+                sub_namespace = namespace
+            yield from iter_url_names(url_pattern.url_patterns, sub_namespace)
+        elif url_pattern.name:
+            yield f'{namespace}:{url_pattern.name}' if namespace else url_pattern.name
+
+
+def compile_templates():
+    """
+    Loads every template in the project's template directory so that the cached loader keeps them compiled
+    """
+    engine = engines['django'].engine
+    count = 0
+    for template_dir in engine.dirs:
+        for path, _, file_names in os.walk(template_dir):
+            for file_name in file_names:
+                engine.get_template(os.path.relpath(os.path.join(path, file_name), template_dir))
+                count += 1
+    return count
+
+
+def resolve_urls():
+    """
+    Reverses every url name that takes no arguments in each language
+    """
+    url_names = set(iter_url_names(get_resolver().url_patterns))
+    count = 0
+    for language, _ in settings.LANGUAGES:
+        with translation.override(language):
+            for url_name in url_names:
+                try:
+                    cached_reverse(url_name)
+                except NoReverseMatch:
+                    # needs arguments
+                    continue
+                count += 1
+    return count
+
+
+def load_translations():
+    """
+    Loads the translation catalogue of each language
+    """
+    for language, _ in settings.LANGUAGES:
+        with translation.override(language):
+            translation.gettext('Send money to someone in prison')
+    return len(settings.LANGUAGES)
+
+
+def load_prison_list():
+    """
+    Caches the list of prisons shown in the help area; the lookup is made on another thread
+    which is waited for at most WARM_UP_API_TIMEOUT seconds so that a slow API does not hold up the worker
+    """
+    from help_area.views import PrisonListView
+
+    loaded = []
+    thread = threading.Thread(
+        target=lambda: loaded.append(len(PrisonListView.get_prison_list() or ())),
+        name='warm-up', daemon=True,
+    )
+    thread.start()
+    thread.join(settings.WARM_UP_API_TIMEOUT)
+    if thread.is_alive():
+        logger.warning('Prison list still loading after %ss of warming up' % settings.WARM_UP_API_TIMEOUT)
+    return loaded[0] if loaded else 0
+
+
+def freeze_objects():
+    """
+    Moves all objects created so far into the garbage collector's permanent generation so that collections
+    in forked workers do not write to, and so copy, the memory pages holding them
+    """
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
+
+
+def connect_to_api():
+    """
+    Authenticates the sessions shared by forms that look up prisoner details so that
+    the first requests do not wait for an access token and a new connection
+    """
+    from send_money.forms import DebitCardAmountForm, PrisonerDetailsForm
+
+    count = 0
+    for form_class in (PrisonerDetailsForm, DebitCardAmountForm):
+        try:
+            form_class.get_api_session()
+        except (RequestException, OAuth2Error):
+            logger.warning('Could not connect to API while warming up', exc_info=True)
+            continue
+        count += 1
+    return count
+
+
+def run_stages(description, stages):
+    started_at = time.perf_counter()
+    timings = []
+    for stage in stages:
+        stage_started_at = time.perf_counter()
+        count = stage()
+        timings.append(f'{stage.__name__}: {count} in {(time.perf_counter() - stage_started_at) * 1000:.0f}ms')
+    duration = time.perf_counter() - started_at
+    logger.info('%s in %.0fms (%s)' % (description, duration * 1000, ', '.join(timings)))
+    return duration
+
+
+def warm_up():
+    """
+    Prepares the application before serving requests; run once before workers are forked
+    so that the memory used is shared copy-on-write
+    """
+    return run_stages('Warmed up application', (
+        compile_templates, resolve_urls, load_translations, freeze_objects,
+    ))
+
+
+def warm_up_worker():
+    """
+    Prepares connections and data loaded from the API in each worker after forking
+    as sockets cannot be shared between processes and the master should not wait for the API
+    """
+    return run_stages('Warmed up worker', (connect_to_api, load_prison_list))
@@ -1,6 +1,8 @@
 'use strict';
 
 export var ServiceCharge = {
+  specVersion: 1,
+
   init: function (selector) {
     selector = selector || '.mtp-service-charge';
     var instance = this;
@@ -10,18 +12,21 @@ export var ServiceCharge = {
       var $input = $container.find('.mtp-amount-input');
       var $charges = $container.find('.mtp-service-charge__service-charge');
       var $total = $container.find('.mtp-service-charge__total');
-      var proportionalCharge = Number($container.data('percentage-charge')) / 100;
-      var fixedCharge = Number($container.data('fixed-charge'));
+      // the specification is generated from settings by the server; jQuery parses the JSON attribute
+      var spec = $container.data('charge-spec');
+      if (!spec || spec.version !== instance.specVersion || !spec.denominator) {
+        spec = null;
+      }
 
       var update = function () {
         var valid = false;
-        var amount = $input.val();
-        if (/^ *\d+(\.\d{2})? *$/.test(amount)) {
-          amount = Number(amount);
-          if (amount > 0) {
-            var serviceCharge = this.round(amount * proportionalCharge + fixedCharge);
+        var amount = /^ *(\d+)(?:\.(\d{2}))? *$/.exec($input.val());
+        if (spec && amount) {
+          amount = Number(amount[1]) * 100 + Number(amount[2] || 0);
+          if (amount > 0 && amount <= spec.maxPence) {
+            var serviceCharge = this.calculate(spec, amount);
             $charges.text(this.formatAsPrice(serviceCharge));
-            $total.text(this.formatAsPrice(amount + this.round(serviceCharge)));
+            $total.text(this.formatAsPrice(amount + serviceCharge));
             valid = true;
           }
         }
@@ -36,15 +41,16 @@ export var ServiceCharge = {
     });
   },
 
-  formatAsPrice: function (amount) {
-    return '£' + amount.toFixed(2).replace(/\B(?=(\d{3})+(?!\d))/g, ',');
+  formatAsPrice: function (pence) {
+    return '£' + (pence / 100).toFixed(2).replace(/\B(?=(\d{3})+(?!\d))/g, ',');
   },
 
-  // Applies the rounding algorithm we use:
-  // 1. discard all decimal digits after the 3rd place (excluded)
-  // 2. round up
-  round: function (amount) {
-    amount = amount * 100;
-    return Math.ceil(Number(amount.toString().replace(/(\.\d)\d*/, '$1'))) / 100;
+  // Applies the rounding algorithm used by the server to an amount in pence:
+  // 1. discard fractions of a tenth of a penny
+  // 2. round up to whole pence
+  calculate: function (spec, pence) {
+    var numerator = pence * spec.percentageFactor + spec.fixedTerm;
+    var tenthsOfPennies = (numerator - numerator % spec.denominator) / spec.denominator;
+    return Math.ceil(tenthsOfPennies / 10);
   }
 };
@@ -143,12 +143,23 @@ TEMPLATES = [
         },
     },
 ]
+# compile templates, resolve urls and load translations before uwsgi forks workers
+# and connect to the API and load the prison list in each worker before it serves requests,
+# waiting at most a few seconds for the API
+WARM_UP = os.environ.get('WARM_UP', 'False') == 'True'
+WARM_UP_API_TIMEOUT = 3
 
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'mtp',
-    }
+    },
+    # outlives individual runs of the incomplete payment reconciliation but is local to each pod
+    'reconciliation': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('RECONCILIATION_CACHE_PATH', '/tmp/mtp-reconciliation'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
 }
 
 # logging settings
@@ -213,6 +224,7 @@ TEST_RUNNER = 'mtp_common.test_utils.runner.TestRunner'
 
 # authentication
 SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+SESSION_SERIALIZER = 'send_money.session.CompactSessionSerializer'
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 AUTHENTICATION_BACKENDS = (
     'mtp_common.auth.backends.MojBackend',
@@ -239,6 +251,29 @@ PAYMENT_DELAYED_CAPTURE_ROLLOUT_PERCENTAGE = os.environ.get('PAYMENT_DELAYED_CAP
 CHECK_INCOMPLETE_PAYMENT_DELAY = int(  # in minutes
     os.environ.get('CHECK_INCOMPLETE_PAYMENT_DELAY', 30),
 )
+# path to write incomplete payment reconciliation metrics to in prometheus text format; blank to disable
+RECONCILIATION_METRICS_FILE = os.environ.get('RECONCILIATION_METRICS_FILE', '')
+# when sharded, every instance reconciles a slice of incomplete payments holding a lease on it;
+# leases are held in a cache shared by all instances (named by RECONCILIATION_LEASE_CACHE and added to CACHES,
+# e.g. memcached or redis) or in lock files which only exclude processes on a single host
+RECONCILIATION_SHARDED = os.environ.get('RECONCILIATION_SHARDED', 'False') == 'True'
+RECONCILIATION_LEASE_BACKEND = os.environ.get('RECONCILIATION_LEASE_BACKEND', 'file')
+RECONCILIATION_LEASE_CACHE = os.environ.get('RECONCILIATION_LEASE_CACHE', '')
+RECONCILIATION_LEASE_PATH = os.environ.get('RECONCILIATION_LEASE_PATH', '/tmp')
+RECONCILIATION_LEASE_TIMEOUT = 60 * 60  # seconds
+# cache that holds captured payments that are not expected to have settled yet;
+# it is only a hint to skip GOV.UK Pay lookups so need not be shared between pods
+RECONCILIATION_CACHE = 'reconciliation'
+# seconds after capture before GOV.UK Pay is expected to know the capture date
+RECONCILIATION_SETTLEMENT_DELAY = int(os.environ.get('RECONCILIATION_SETTLEMENT_DELAY', 60 * 60))
+# seconds after which a reconciliation run stops checking payments, most urgent ones are checked first; 0 for no limit
+RECONCILIATION_TIME_LIMIT = int(os.environ.get('RECONCILIATION_TIME_LIMIT', 0))
+# long-running reconciliation worker: seconds between the start of runs and threads checking payments
+RECONCILIATION_WORKER_INTERVAL = int(os.environ.get('RECONCILIATION_WORKER_INTERVAL', 15 * 60))
+RECONCILIATION_WORKER_CONCURRENCY = int(os.environ.get('RECONCILIATION_WORKER_CONCURRENCY', 1))
+# completed payments are updated in groups of this size using the MTP API's bulk update endpoint,
+# falling back to one request per payment if it is not available; 1 to update each immediately
+RECONCILIATION_UPDATE_BATCH_SIZE = int(os.environ.get('RECONCILIATION_UPDATE_BATCH_SIZE', 1))
 
 SERVICE_CHARGE_PERCENTAGE = Decimal(
     os.environ.get('SERVICE_CHARGE_PERCENTAGE', '0')
@@ -273,6 +308,38 @@ CONFIRMATION_EXPIRES = 60  # minutes
 GOVUK_PAY_URL = os.environ.get('GOVUK_PAY_URL', '')
 GOVUK_PAY_AUTH_TOKEN = os.environ.get('GOVUK_PAY_AUTH_TOKEN', '')
 
+# timeouts for outbound calls (in seconds) are derived from recently observed latency;
+# these are the maximums and all calls made while handling one request share a total budget
+GOVUK_PAY_TIMEOUT = int(os.environ.get('GOVUK_PAY_TIMEOUT', '15'))
+API_TIMEOUT = int(os.environ.get('API_TIMEOUT', '15'))
+SERVICE_AVAILABILITY_TIMEOUT = 5
+REQUEST_DEADLINE = int(os.environ.get('REQUEST_DEADLINE', '10'))
+ADAPTIVE_TIMEOUT_PERCENTILE = 99
+ADAPTIVE_TIMEOUT_MULTIPLIER = 3
+ADAPTIVE_TIMEOUT_MINIMUM = 2
+ADAPTIVE_TIMEOUT_MINIMUM_SAMPLES = 20
+# threads per worker process for upstream lookups made alongside each other while handling one request;
+# at least as many as uwsgi threads so that requests do not queue behind each other's lookups
+LOOKUP_THREADS = int(os.environ.get('LOOKUP_THREADS', '10'))
+
+# calls to GOV.UK Pay and the MTP API fail fast once this proportion of at least the minimum number of calls
+# made within the window (in seconds) have failed; one call is let through to probe after the reset timeout
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.environ.get('CIRCUIT_BREAKER_FAILURE_RATE', '0.5'))
+CIRCUIT_BREAKER_MINIMUM_CALLS = int(os.environ.get('CIRCUIT_BREAKER_MINIMUM_CALLS', '10'))
+CIRCUIT_BREAKER_WINDOW = int(os.environ.get('CIRCUIT_BREAKER_WINDOW', '60'))
+CIRCUIT_BREAKER_RESET_TIMEOUT = int(os.environ.get('CIRCUIT_BREAKER_RESET_TIMEOUT', '30'))
+
+# calls to GOV.UK Pay are throttled to this many per second (0 disables throttling) allowing short bursts;
+# naming a cache shared between processes (e.g. memcached) also limits the rate across all of them.
+# when GOV.UK Pay responds with 429, calls pause for as long as Retry-After asks (up to the maximum pause)
+# and the call is retried unless the wait would exceed the maximum (in seconds) or the request's remaining time
+GOVUK_PAY_RATE_LIMIT = float(os.environ.get('GOVUK_PAY_RATE_LIMIT', '0'))
+GOVUK_PAY_RATE_LIMIT_BURST = int(os.environ.get('GOVUK_PAY_RATE_LIMIT_BURST', '10'))
+GOVUK_PAY_RATE_LIMIT_CACHE = os.environ.get('GOVUK_PAY_RATE_LIMIT_CACHE', '')
+GOVUK_PAY_RATE_LIMIT_RETRIES = int(os.environ.get('GOVUK_PAY_RATE_LIMIT_RETRIES', '2'))
+GOVUK_PAY_RATE_LIMIT_MAX_WAIT = float(os.environ.get('GOVUK_PAY_RATE_LIMIT_MAX_WAIT', '5'))
+GOVUK_PAY_RATE_LIMIT_MAX_PAUSE = float(os.environ.get('GOVUK_PAY_RATE_LIMIT_MAX_PAUSE', '60'))
+
 EMAIL_BACKEND = 'anymail.backends.mailgun.EmailBackend'
 ANYMAIL = {
     'MAILGUN_API_KEY': os.environ.get('MAILGUN_ACCESS_KEY', ''),
@@ -1,10 +1,8 @@
 """
 Docker settings
 """
-from mtp_common.stack import get_current_pod
-
 from .base import *  # noqa
-from .base import ENVIRONMENT, os
+from .base import ENVIRONMENT, TEMPLATES, os
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY')
@@ -12,6 +10,19 @@ SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY')
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get('DEBUG') == 'True'
 
+WARM_UP = os.environ.get('WARM_UP', 'True') == 'True'
+GOVUK_PAY_RATE_LIMIT = float(os.environ.get('GOVUK_PAY_RATE_LIMIT', '10'))
+
+if not DEBUG:
+    # compile templates once per process
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 ALLOWED_HOSTS = [
     'localhost',
     '.service.gov.uk',
@@ -19,9 +30,17 @@ ALLOWED_HOSTS = [
     '.svc.cluster.local',
 ]
 
-current_pod = get_current_pod()
-if current_pod and current_pod.status.pod_ip:
-    ALLOWED_HOSTS.append(current_pod.status.pod_ip)
+# the pod's own address is allowed for probes; it is taken from the environment when provided
+# because otherwise every process loads the kubernetes client and queries the cluster as it starts
+pod_ip = os.environ.get('POD_IP')
+if not pod_ip and os.environ.get('POD_NAME'):
+    from mtp_common.stack import get_current_pod
+
+    current_pod = get_current_pod()
+    if current_pod:
+        pod_ip = current_pod.status.pod_ip
+if pod_ip:
+    ALLOWED_HOSTS.append(pod_ip)
 
 OAUTHLIB_INSECURE_TRANSPORT = os.environ.get('OAUTHLIB_INSECURE_TRANSPORT') == 'True'
 if not OAUTHLIB_INSECURE_TRANSPORT:
@@ -13,3 +13,27 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mtp_send_money.settings.docker')
 
 application = get_wsgi_application()
+
+
+def warm_up_application():
+    from django.conf import settings
+
+    if not settings.WARM_UP:
+        return
+
+    from send_money.warmup import warm_up, warm_up_worker
+
+    # with `lazy-apps = 0` this runs in the uwsgi master so workers share the prepared memory
+    warm_up()
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        # not running in uwsgi
+        postfork = None
+    if postfork:
+        postfork(warm_up_worker)
+    else:
+        warm_up_worker()
+
+
+warm_up_application()